@@ -1,19 +1,21 @@
 from __future__ import annotations
 
+import asyncio
 import base64
 import json
 import os
 from io import BytesIO
-from pathlib import Path
-from typing import Dict, Optional
+from typing import Any, Callable, Dict, Generator, Optional, Union
 
 import weave
-from openai import OpenAI
 from PIL import Image
 
-BASE_DIR = Path(__file__).resolve().parent.parent
-REFERENCE_SUMMARY_PATH = BASE_DIR / "notes" / "reference_particle_flow_summary.txt"
-GLSL_RULES_PATH = BASE_DIR / "notes" / "glsl_rules_condensed.txt"
+from backend.discovery_cache import discovery_key, get_discovery_cache
+from backend.llm_client import ChatCall, acomplete, complete
+from backend.prompts import PromptAsset, get_prompt_registry
+from backend.shader_patch import EDIT_MODES, PatchResult, apply_edits, normalize_edits, record_patch
+
+EDIT_MODE = os.getenv("EDIT_MODE", "auto")  # rewrite | patch | auto (patch once iterations turn to refinement)
 
 INTERFACE_CONTRACT = (
     "Shader interface contract (must follow exactly):\n"
@@ -73,16 +75,16 @@ def _init_weave() -> None:
 _init_weave()
 
 
-def _load_reference_summary() -> str:
-    if REFERENCE_SUMMARY_PATH.exists():
-        return REFERENCE_SUMMARY_PATH.read_text(encoding="utf-8").strip()
-    return ""
+def _reference_asset(reference_text: str | None) -> PromptAsset | str:
+    return reference_text or get_prompt_registry().asset("reference_summary")
+
 
+def _text(part: PromptAsset | str) -> str:
+    return part.text if isinstance(part, PromptAsset) else part
 
-def _load_glsl_rules() -> str:
-    if GLSL_RULES_PATH.exists():
-        return GLSL_RULES_PATH.read_text(encoding="utf-8").strip()
-    return ""
+
+def _rules_block(rules: PromptAsset) -> str:
+    return f"\n{rules.text}\n" if rules.text else ""
 
 
 def _image_to_data_url(img: Image.Image) -> str:
@@ -92,81 +94,160 @@ def _image_to_data_url(img: Image.Image) -> str:
     return f"data:image/png;base64,{b64}"
 
 
-def _call_json_model(*, client: OpenAI, model: str, messages: list[dict]) -> Dict[str, object]:
-    response = client.chat.completions.create(
-        model=model,
-        messages=messages,
-        response_format={"type": "json_object"},
-        temperature=0.4,
-    )
-    raw = response.choices[0].message.content or "{}"
+_JSON_SYSTEM = {"role": "system", "content": "Return JSON only. Output must be valid JSON."}
+
+
+def _messages(prefix: str, *dynamic: str) -> list[dict]:
+    # Static text first and byte-identical across calls, so provider-side prompt caching can hit.
+    return [_JSON_SYSTEM, {"role": "system", "content": prefix}, *({"role": "user", "content": d} for d in dynamic)]
+
+
+# What an entry point does, independent of sync/async: a ready result (no API key), one ChatCall, or a
+# generator that yields each ChatCall it needs, is sent the parsed reply and returns the result.
+Steps = Generator[ChatCall, Any, Dict[str, object]]
+Work = Union[ChatCall, Dict[str, object], Steps]
+
+
+def _steps(work: ChatCall | Steps) -> Steps:
+    if isinstance(work, ChatCall):
+        return (yield work)
+    return (yield from work)
+
+
+def _run(work: Work) -> Dict[str, object]:
+    """Drive `work` with blocking calls; `_arun` is the same loop with awaited calls."""
+    if isinstance(work, dict):
+        return work
+    steps = _steps(work)
+    # send() hands each reply back and returns the next ChatCall; the generator's return value arrives
+    # as StopIteration.value.
     try:
-        return json.loads(raw)
-    except json.JSONDecodeError:
-        return {}
+        call = next(steps)
+        while True:
+            call = steps.send(complete(call))
+    except StopIteration as done:
+        return done.value
 
 
-@weave.op()
-def generate_shader(
+async def _arun(work: Work) -> Dict[str, object]:
+    if isinstance(work, dict):
+        return work
+    steps = _steps(work)
+    try:
+        call = next(steps)
+        while True:
+            call = steps.send(await acomplete(call))
+    except StopIteration as done:
+        return done.value
+
+
+def _sampling(temperature: float | None) -> Dict[str, float]:
+    return {} if temperature is None else {"temperature": temperature}
+
+
+def _shader_result(fallback: str) -> Callable[[Dict[str, object]], Dict[str, object]]:
+    def parse(data: Dict[str, object]) -> Dict[str, object]:
+        fragment_shader = data.get("fragment_shader")
+        if not isinstance(fragment_shader, str) or "#version" not in fragment_shader:
+            fragment_shader = fallback
+
+        notes = data.get("notes", "") if isinstance(data.get("notes"), str) else ""
+        return {"fragment_shader": fragment_shader, "notes": notes}
+
+    return parse
+
+
+def _generate_shader_call(
     *,
     iteration: int,
     total_iterations: int,
     weights: Dict[str, float],
     prev_scores: Optional[Dict[str, float]],
     prev_shader: Optional[str],
-) -> Dict[str, object]:
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
+) -> ChatCall | Dict[str, object]:
+    if not os.getenv("OPENAI_API_KEY"):
         return {"fragment_shader": DEFAULT_FRAGMENT_SHADER, "notes": "OPENAI_API_KEY not set"}
 
-    client = OpenAI(api_key=api_key)
     model = os.getenv("OPENAI_MODEL", "gpt-4.1-mini")
 
+    prefix = get_prompt_registry().prefix(
+        "generate",
+        lambda: (
+            "You are a shader generation assistant. Return JSON only.\n"
+            "Goal: produce a full GLSL fragment shader that runs with the provided vertex shader.\n"
+            "Focus on procedural/noise-driven texture synthesis. No constraints beyond validity.\n"
+            f"{INTERFACE_CONTRACT}\n"
+            "Return JSON with keys: fragment_shader, notes.\n"
+            "notes should be a short string explaining the change."
+        ),
+    )
     prompt = (
-        "You are a shader generation assistant. Return JSON only.\n"
-        "Goal: produce a full GLSL fragment shader that runs with the provided vertex shader.\n"
-        "Focus on procedural/noise-driven texture synthesis. No constraints beyond validity.\n"
-        f"{INTERFACE_CONTRACT}\n"
-        "Return JSON with keys: fragment_shader, notes.\n"
         f"Iteration {iteration + 1} of {total_iterations}.\n"
         f"Weights: {json.dumps(weights)}\n"
         f"Previous scores: {json.dumps(prev_scores or {})}\n"
-        f"Previous shader: {json.dumps(prev_shader or '')}\n\n"
-        "notes should be a short string explaining the change."
+        f"Previous shader: {json.dumps(prev_shader or '')}\n"
     )
 
-    data = _call_json_model(
-        client=client,
-        model=model,
-        messages=[
-            {"role": "system", "content": "Return JSON only. Output must be valid JSON."},
-            {"role": "user", "content": prompt},
-        ],
+    shader_result = _shader_result(DEFAULT_FRAGMENT_SHADER)
+
+    def parse(data: Dict[str, object]) -> Dict[str, object]:
+        if not data:
+            return {"fragment_shader": DEFAULT_FRAGMENT_SHADER, "notes": "JSON parse failed"}
+        return shader_result(data)
+
+    return ChatCall(model=model, messages=_messages(prefix, prompt), parse=parse, kind="generate")
+
+
+@weave.op()
+def generate_shader(
+    *,
+    iteration: int,
+    total_iterations: int,
+    weights: Dict[str, float],
+    prev_scores: Optional[Dict[str, float]],
+    prev_shader: Optional[str],
+) -> Dict[str, object]:
+    return _run(
+        _generate_shader_call(
+            iteration=iteration,
+            total_iterations=total_iterations,
+            weights=weights,
+            prev_scores=prev_scores,
+            prev_shader=prev_shader,
+        )
     )
 
-    if not data:
-        return {"fragment_shader": DEFAULT_FRAGMENT_SHADER, "notes": "JSON parse failed"}
 
-    fragment_shader = data.get("fragment_shader")
-    if not isinstance(fragment_shader, str) or "#version" not in fragment_shader:
-        fragment_shader = DEFAULT_FRAGMENT_SHADER
+def _ensure_str(val: object) -> str:
+    if isinstance(val, str):
+        return val
+    if isinstance(val, dict):
+        return json.dumps(val, indent=2)
+    if isinstance(val, list):
+        return json.dumps(val, indent=2)
+    return str(val) if val else ""
 
-    notes = data.get("notes", "") if isinstance(data.get("notes"), str) else ""
-    return {"fragment_shader": fragment_shader, "notes": notes}
+
+def _discovery_result(data: Dict[str, object]) -> Dict[str, object]:
+    return {
+        "gap_analysis": _ensure_str(data.get("gap_analysis", "")),
+        "initial_prompt": _ensure_str(data.get("initial_prompt", "")),
+        "edit_prompt": _ensure_str(data.get("edit_prompt", "")),
+        "notes": _ensure_str(data.get("notes", "")),
+    }
 
 
-@weave.op()
-def run_discovery(*, reference_text: str | None, target_img: Image.Image | None = None) -> Dict[str, object]:
-    """Phase A: read the reference text + look at the target image, produce gap analysis + tailored prompts."""
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
-        return {"gap_analysis": "", "initial_prompt": "", "edit_prompt": "", "notes": "OPENAI_API_KEY not set"}
+def _discovery_call(
+    *, reference_text: str | None, target_img: Image.Image | None = None
+) -> tuple[str, ChatCall | Dict[str, object]]:
+    """The discovery cache key ("" when nothing should be stored) and the call, or a ready/cached result."""
+    if not os.getenv("OPENAI_API_KEY"):
+        return "", {"gap_analysis": "", "initial_prompt": "", "edit_prompt": "", "notes": "OPENAI_API_KEY not set"}
 
-    ref = reference_text or _load_reference_summary()
+    ref_part = _reference_asset(reference_text)
+    ref = _text(ref_part)
     if not ref:
-        return {"gap_analysis": "", "initial_prompt": "", "edit_prompt": "", "notes": "No reference text provided"}
-
-    client = OpenAI(api_key=api_key)
+        return "", {"gap_analysis": "", "initial_prompt": "", "edit_prompt": "", "notes": "No reference text provided"}
 
     image_context = (
         "\nYou are also given a TARGET IMAGE — this is the visual goal the shader must reproduce.\n"
@@ -178,148 +259,172 @@ def run_discovery(*, reference_text: str | None, target_img: Image.Image | None
         else ""
     )
 
-    prompt = (
-        "You are a shader analysis assistant. Return JSON only.\n\n"
-        "I will give you a REFERENCE SHADER / TECHNIQUE description. "
-        "Read it carefully and completely.\n"
-        f"{image_context}\n"
-        "Your job:\n"
-        "1. UNDERSTAND what visual effect the reference produces.\n"
-        "2. Classify the techniques into three buckets relative to the TARGET:\n"
-        "   - SIMILAR: techniques we can reuse directly to recreate the target\n"
-        "   - DIFFERENT: things the reference does that don't match the target and need to change\n"
-        "   - BRIDGE NEEDED: adaptations required to get from the reference toward the target\n"
-        "3. Based on your analysis, generate TWO tailored prompts:\n"
-        "   a) initial_prompt: instructions for generating the FIRST shader. "
-        "Be specific about which techniques to borrow, what to simplify, and what new techniques to add. "
-        "Reference concrete functions/patterns from the reference text.\n"
-        "   b) edit_prompt: instructions for EDITING a shader based on critique feedback. "
-        "Describe the visual priorities and what aspects matter most for convergence.\n\n"
-        f"{INTERFACE_CONTRACT}\n"
-        "Return JSON with keys: gap_analysis (string with SIMILAR/DIFFERENT/BRIDGE NEEDED sections), "
-        "initial_prompt (string), edit_prompt (string), notes (short summary string).\n\n"
-        f"REFERENCE TEXT:\n{ref}\n"
+    prompt = get_prompt_registry().prefix(
+        "discovery:image" if target_img is not None else "discovery",
+        lambda: (
+            "You are a shader analysis assistant. Return JSON only.\n\n"
+            "I will give you a REFERENCE SHADER / TECHNIQUE description. "
+            "Read it carefully and completely.\n"
+            f"{image_context}\n"
+            "Your job:\n"
+            "1. UNDERSTAND what visual effect the reference produces.\n"
+            "2. Classify the techniques into three buckets relative to the TARGET:\n"
+            "   - SIMILAR: techniques we can reuse directly to recreate the target\n"
+            "   - DIFFERENT: things the reference does that don't match the target and need to change\n"
+            "   - BRIDGE NEEDED: adaptations required to get from the reference toward the target\n"
+            "3. Based on your analysis, generate TWO tailored prompts:\n"
+            "   a) initial_prompt: instructions for generating the FIRST shader. "
+            "Be specific about which techniques to borrow, what to simplify, and what new techniques to add. "
+            "Reference concrete functions/patterns from the reference text.\n"
+            "   b) edit_prompt: instructions for EDITING a shader based on critique feedback. "
+            "Describe the visual priorities and what aspects matter most for convergence.\n\n"
+            f"{INTERFACE_CONTRACT}\n"
+            "Return JSON with keys: gap_analysis (string with SIMILAR/DIFFERENT/BRIDGE NEEDED sections), "
+            "initial_prompt (string), edit_prompt (string), notes (short summary string).\n\n"
+            f"REFERENCE TEXT:\n{ref}\n"
+        ),
+        ref_part,
     )
 
+    model = os.getenv("OPENAI_VISION_MODEL", "gpt-4o-mini") if target_img is not None else os.getenv("OPENAI_MODEL", "gpt-4.1-mini")
+
+    # Same reference text, target pixels and model give the same analysis; reuse it across runs.
+    cache = get_discovery_cache()
+    key = discovery_key(reference_text=ref, target_img=target_img, model=model) if cache is not None else ""
+    if cache is not None:
+        cached = cache.get(key)
+        if cached is not None:
+            return "", {**cached, "cached": True}
+
     if target_img is not None:
-        vision_model = os.getenv("OPENAI_VISION_MODEL", "gpt-4o-mini")
         target_url = _image_to_data_url(target_img)
-        content: list[dict] = [
+        content: list[dict] | str = [
             {"type": "text", "text": prompt},
             {"type": "image_url", "image_url": {"url": target_url}},
         ]
-        response = client.chat.completions.create(
-            model=vision_model,
-            messages=[
-                {"role": "system", "content": "Return JSON only. Output must be valid JSON."},
-                {"role": "user", "content": content},
-            ],
-            response_format={"type": "json_object"},
-            temperature=0.4,
-        )
-        raw = response.choices[0].message.content or "{}"
-        try:
-            data = json.loads(raw)
-        except json.JSONDecodeError:
-            data = {}
     else:
-        model = os.getenv("OPENAI_MODEL", "gpt-4.1-mini")
-        data = _call_json_model(
-            client=client,
-            model=model,
-            messages=[
-                {"role": "system", "content": "Return JSON only. Output must be valid JSON."},
-                {"role": "user", "content": prompt},
-            ],
-        )
+        content = prompt
 
-    def _ensure_str(val: object) -> str:
-        if isinstance(val, str):
-            return val
-        if isinstance(val, dict):
-            return json.dumps(val, indent=2)
-        if isinstance(val, list):
-            return json.dumps(val, indent=2)
-        return str(val) if val else ""
+    call = ChatCall(
+        model=model, messages=[_JSON_SYSTEM, {"role": "user", "content": content}], parse=_discovery_result, kind="discovery"
+    )
+    return key, call
 
-    return {
-        "gap_analysis": _ensure_str(data.get("gap_analysis", "")),
-        "initial_prompt": _ensure_str(data.get("initial_prompt", "")),
-        "edit_prompt": _ensure_str(data.get("edit_prompt", "")),
-        "notes": _ensure_str(data.get("notes", "")),
-    }
+
+def _store_discovery(key: str, result: Dict[str, object]) -> None:
+    cache = get_discovery_cache()
+    if key and cache is not None and (result["initial_prompt"] or result["edit_prompt"]):
+        cache.put(key, result)
 
 
 @weave.op()
-def generate_initial_shader(
+def run_discovery(*, reference_text: str | None, target_img: Image.Image | None = None) -> Dict[str, object]:
+    """Phase A: read the reference text + look at the target image, produce gap analysis + tailored prompts."""
+    key, call = _discovery_call(reference_text=reference_text, target_img=target_img)
+    result = _run(call)
+    _store_discovery(key, result)
+    return result
+
+
+@weave.op()
+async def arun_discovery(*, reference_text: str | None, target_img: Image.Image | None = None) -> Dict[str, object]:
+    # Hashing and PNG-encoding the target and the SQLite lookup and store stay off the event loop.
+    key, call = await asyncio.to_thread(_discovery_call, reference_text=reference_text, target_img=target_img)
+    result = await _arun(call)
+    await asyncio.to_thread(_store_discovery, key, result)
+    return result
+
+
+def _initial_shader_call(
     *,
     target_description: str | None,
     reference_text: str | None = None,
     discovery_context: str | None = None,
-) -> Dict[str, object]:
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
+    temperature: float | None = None,
+) -> ChatCall | Dict[str, object]:
+    if not os.getenv("OPENAI_API_KEY"):
         return {"fragment_shader": DEFAULT_FRAGMENT_SHADER, "notes": "OPENAI_API_KEY not set"}
 
-    reference_summary = reference_text or _load_reference_summary()
-    glsl_rules = _load_glsl_rules()
-    client = OpenAI(api_key=api_key)
+    reference = _reference_asset(reference_text)
+    rules = get_prompt_registry().asset("glsl_rules")
     model = os.getenv("OPENAI_MODEL", "gpt-4.1-mini")
 
-    rules_block = f"\n{glsl_rules}\n" if glsl_rules else ""
-
-    if discovery_context:
-        prompt = (
+    guided = bool(discovery_context)
+    prefix = get_prompt_registry().prefix(
+        "initial:guided" if guided else "initial",
+        lambda: (
             "You are a shader generation assistant. Return JSON only.\n"
             "Goal: generate an initial single-pass GLSL fragment shader that visually\n"
             "matches the target image as closely as possible.\n"
             "Do NOT map or sample the source image UVs as the primary structure.\n"
             "Use procedural structure; the source image is only a loose color/texture guide.\n"
-            f"{INTERFACE_CONTRACT}\n"
-            f"{rules_block}"
+            + (
+                ""
+                if guided
+                else "Simplify the multipass Shadertoy reference into a single-pass shader.\n"
+                "Capture the core effect (soft particle flow + glow impression).\n"
+                "Avoid Shadertoy buffers; do everything in one fragment shader.\n"
+            )
+            + f"{INTERFACE_CONTRACT}\n"
+            f"{_rules_block(rules)}"
             "Return JSON with keys: fragment_shader, notes.\n"
-            f"Target description: {target_description or 'N/A'}\n\n"
-            f"DISCOVERY-GUIDED INSTRUCTIONS (follow these closely):\n{discovery_context}\n\n"
-            f"Reference summary:\n{reference_summary}\n"
-            "notes should be a short string explaining the approach."
-        )
-    else:
-        prompt = (
-            "You are a shader generation assistant. Return JSON only.\n"
-            "Goal: generate an initial single-pass GLSL fragment shader that visually\n"
-            "matches the target image as closely as possible.\n"
-            "Do NOT map or sample the source image UVs as the primary structure.\n"
-            "Use procedural structure; the source image is only a loose color/texture guide.\n"
-            "Simplify the multipass Shadertoy reference into a single-pass shader.\n"
-            "Capture the core effect (soft particle flow + glow impression).\n"
-            "Avoid Shadertoy buffers; do everything in one fragment shader.\n"
-            f"{INTERFACE_CONTRACT}\n"
-            f"{rules_block}"
-            "Return JSON with keys: fragment_shader, notes.\n"
-            f"Target description: {target_description or 'N/A'}\n"
-            f"Reference summary:\n{reference_summary}\n"
-            "notes should be a short string explaining the approach."
-        )
+            "notes should be a short string explaining the approach.\n\n"
+            f"Reference summary:\n{_text(reference)}\n"
+        ),
+        rules,
+        reference,
+    )
 
-    data = _call_json_model(
-        client=client,
+    prompt = f"Target description: {target_description or 'N/A'}\n"
+    if guided:
+        prompt += f"\nDISCOVERY-GUIDED INSTRUCTIONS (follow these closely):\n{discovery_context}\n"
+
+    return ChatCall(
         model=model,
-        messages=[
-            {"role": "system", "content": "Return JSON only. Output must be valid JSON."},
-            {"role": "user", "content": prompt},
-        ],
+        messages=_messages(prefix, prompt),
+        parse=_shader_result(DEFAULT_FRAGMENT_SHADER),
+        kind="initial",
+        **_sampling(temperature),
     )
 
-    fragment_shader = data.get("fragment_shader")
-    if not isinstance(fragment_shader, str) or "#version" not in fragment_shader:
-        fragment_shader = DEFAULT_FRAGMENT_SHADER
 
-    notes = data.get("notes", "") if isinstance(data.get("notes"), str) else ""
-    return {"fragment_shader": fragment_shader, "notes": notes}
+@weave.op()
+def generate_initial_shader(
+    *,
+    target_description: str | None,
+    reference_text: str | None = None,
+    discovery_context: str | None = None,
+    temperature: float | None = None,
+) -> Dict[str, object]:
+    return _run(
+        _initial_shader_call(
+            target_description=target_description,
+            reference_text=reference_text,
+            discovery_context=discovery_context,
+            temperature=temperature,
+        )
+    )
 
 
 @weave.op()
-def edit_shader(
+async def agenerate_initial_shader(
+    *,
+    target_description: str | None,
+    reference_text: str | None = None,
+    discovery_context: str | None = None,
+    temperature: float | None = None,
+) -> Dict[str, object]:
+    return await _arun(
+        _initial_shader_call(
+            target_description=target_description,
+            reference_text=reference_text,
+            discovery_context=discovery_context,
+            temperature=temperature,
+        )
+    )
+
+
+def _edit_shader_call(
     *,
     current_shader: str,
     critique_text: str,
@@ -328,110 +433,275 @@ def edit_shader(
     discovery_context: str | None = None,
     iteration: int = 0,
     total_iterations: int = 1,
-) -> Dict[str, object]:
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
+    temperature: float | None = None,
+) -> ChatCall | Dict[str, object]:
+    if not os.getenv("OPENAI_API_KEY"):
         return {"fragment_shader": current_shader, "notes": "OPENAI_API_KEY not set"}
 
-    reference_summary = reference_text or _load_reference_summary()
-    glsl_rules = _load_glsl_rules()
-    client = OpenAI(api_key=api_key)
+    reference = _reference_asset(reference_text)
+    rules = get_prompt_registry().asset("glsl_rules")
     model = os.getenv("OPENAI_MODEL", "gpt-4.1-mini")
 
-    rules_block = f"\n{glsl_rules}\n" if glsl_rules else ""
-
-    early = iteration < total_iterations // 2
-    pacing = (
-        "This is an EARLY iteration — prioritize bold structural changes over fine-tuning."
-        if early
-        else "This is a LATE iteration — prioritize refinement and subtle adjustments over large rewrites."
-    )
-
-    if discovery_context:
-        prompt = (
+    prefix = get_prompt_registry().prefix(
+        "edit",
+        lambda: (
             "You are a shader editing assistant. Return JSON only.\n"
             "Goal: modify the shader to better match the target image.\n"
             "Do NOT map or sample the source image UVs as the primary structure.\n"
             "Use procedural structure; the source image is only a loose color/texture guide.\n"
             "Apply the critique, keep the interface contract unchanged.\n"
             f"{INTERFACE_CONTRACT}\n"
-            f"{rules_block}"
-            f"Iteration {iteration + 1} of {total_iterations}. {pacing}\n"
-            f"Target description: {target_description or 'N/A'}\n"
-            f"Critique:\n{critique_text}\n\n"
-            f"DISCOVERY-GUIDED PRIORITIES (use these to decide what to fix first):\n{discovery_context}\n\n"
-            f"Reference summary:\n{reference_summary}\n"
+            f"{_rules_block(rules)}"
             "Return JSON with keys: fragment_shader, notes.\n"
-            "notes should be a short string explaining the change."
-        )
-    else:
-        prompt = (
+            "notes should be a short string explaining the change.\n\n"
+            f"Reference summary:\n{_text(reference)}\n"
+        ),
+        rules,
+        reference,
+    )
+
+    prompt = _edit_context(
+        critique_text=critique_text,
+        target_description=target_description,
+        discovery_context=discovery_context,
+        iteration=iteration,
+        total_iterations=total_iterations,
+    )
+
+    return ChatCall(
+        model=model,
+        messages=_messages(prefix, prompt),
+        parse=_shader_result(current_shader),
+        kind="edit",
+        **_sampling(temperature),
+    )
+
+
+def _edit_patch_call(
+    *,
+    current_shader: str,
+    critique_text: str,
+    target_description: str | None,
+    reference_text: str | None = None,
+    discovery_context: str | None = None,
+    iteration: int = 0,
+    total_iterations: int = 1,
+    temperature: float | None = None,
+) -> ChatCall | Dict[str, object]:
+    if not os.getenv("OPENAI_API_KEY"):
+        return {"fragment_shader": current_shader, "notes": "OPENAI_API_KEY not set"}
+
+    reference = _reference_asset(reference_text)
+    rules = get_prompt_registry().asset("glsl_rules")
+    model = os.getenv("OPENAI_MODEL", "gpt-4.1-mini")
+
+    prefix = get_prompt_registry().prefix(
+        "edit_patch",
+        lambda: (
             "You are a shader editing assistant. Return JSON only.\n"
-            "Goal: modify the shader to better match the target image.\n"
+            "Goal: modify the CURRENT SHADER to better match the target image.\n"
             "Do NOT map or sample the source image UVs as the primary structure.\n"
             "Use procedural structure; the source image is only a loose color/texture guide.\n"
             "Apply the critique, keep the interface contract unchanged.\n"
             f"{INTERFACE_CONTRACT}\n"
-            f"{rules_block}"
-            f"Iteration {iteration + 1} of {total_iterations}. {pacing}\n"
-            f"Target description: {target_description or 'N/A'}\n"
-            f"Critique:\n{critique_text}\n"
-            f"Reference summary:\n{reference_summary}\n"
-            "Return JSON with keys: fragment_shader, notes.\n"
-            "notes should be a short string explaining the change."
-        )
+            f"{_rules_block(rules)}"
+            "Do NOT return the whole shader. Return search/replace edits against the CURRENT SHADER:\n"
+            "- each `search` is copied verbatim from the current shader (a few whole lines) and occurs exactly once\n"
+            "- each `replace` is the new text for those lines\n"
+            "- edits are applied in order; keep them as small as the change allows\n"
+            'Return JSON with keys: edits (list of {"search": string, "replace": string}), notes.\n'
+            "notes should be a short string explaining the change.\n\n"
+            f"Reference summary:\n{_text(reference)}\n"
+        ),
+        rules,
+        reference,
+    )
+
+    prompt = _edit_context(
+        critique_text=critique_text,
+        target_description=target_description,
+        discovery_context=discovery_context,
+        iteration=iteration,
+        total_iterations=total_iterations,
+    )
 
-    data = _call_json_model(
-        client=client,
+    def parse(data: Dict[str, object]) -> Dict[str, object]:
+        notes = data.get("notes", "") if isinstance(data.get("notes"), str) else ""
+        return {"edits": normalize_edits(data.get("edits")), "notes": notes}
+
+    return ChatCall(
         model=model,
-        messages=[
-            {"role": "system", "content": "Return JSON only. Output must be valid JSON."},
-            {"role": "user", "content": prompt},
-        ],
+        messages=_messages(prefix, prompt, f"CURRENT SHADER:\n{current_shader}"),
+        parse=parse,
+        kind="edit_patch",
+        **_sampling(temperature),
     )
 
-    fragment_shader = data.get("fragment_shader")
-    if not isinstance(fragment_shader, str) or "#version" not in fragment_shader:
-        fragment_shader = current_shader
 
-    notes = data.get("notes", "") if isinstance(data.get("notes"), str) else ""
-    return {"fragment_shader": fragment_shader, "notes": notes}
+def _edit_context(
+    *,
+    critique_text: str,
+    target_description: str | None,
+    discovery_context: str | None,
+    iteration: int,
+    total_iterations: int,
+) -> str:
+    early = iteration < total_iterations // 2
+    pacing = (
+        "This is an EARLY iteration — prioritize bold structural changes over fine-tuning."
+        if early
+        else "This is a LATE iteration — prioritize refinement and subtle adjustments over large rewrites."
+    )
+    # Run-constant context before the per-iteration critique keeps the cacheable prefix as long as possible.
+    prompt = f"Target description: {target_description or 'N/A'}\n"
+    if discovery_context:
+        prompt += f"\nDISCOVERY-GUIDED PRIORITIES (use these to decide what to fix first):\n{discovery_context}\n\n"
+    prompt += f"Iteration {iteration + 1} of {total_iterations}. {pacing}\nCritique:\n{critique_text}\n"
+    return prompt
+
+
+def _edit_mode(mode: str | None, iteration: int, total_iterations: int) -> str:
+    mode = mode or EDIT_MODE
+    if mode not in EDIT_MODES:
+        mode = "rewrite"
+    if mode == "auto":
+        return "rewrite" if iteration < total_iterations // 2 else "patch"
+    return mode
+
+
+def _patched(current_shader: str, call: ChatCall, data: Dict[str, object]) -> tuple[Dict[str, object] | None, Dict[str, object]]:
+    """Apply a patch reply; returns (result or None to fall back, edit report)."""
+    patch: PatchResult = apply_edits(current_shader, data["edits"])
+    record_patch(patch)
+    report = {"mode": "patch", "edits": len(data["edits"]), "applied": patch.applied, "failed": patch.failed}
+    if not patch.ok:
+        print(f"[agent] patch edit rejected ({patch.failed[:2]}); falling back to a full rewrite")
+        return None, {**report, "patch_usage": call.usage}
+    return {"fragment_shader": patch.source, "notes": data["notes"], "edit": {**report, "fallback": False, "usage": call.usage}}, report
+
+
+def _rewrite_report(call: ChatCall | Dict[str, object], patch_report: Dict[str, object] | None) -> Dict[str, object]:
+    usage = call.usage if isinstance(call, ChatCall) else {}
+    if patch_report is None:
+        return {"mode": "rewrite", "fallback": False, "usage": usage}
+    return {**patch_report, "fallback": True, "usage": usage}
+
+
+def _edit_steps(*, current_shader: str, mode: str | None, **kwargs: Any) -> Steps:
+    """Patch first when the mode calls for it, falling back to a full rewrite if the patch does not apply."""
+    patch_report = None
+    if _edit_mode(mode, kwargs["iteration"], kwargs["total_iterations"]) == "patch":
+        call = _edit_patch_call(current_shader=current_shader, **kwargs)
+        if isinstance(call, dict):
+            return call
+        result, patch_report = _patched(current_shader, call, (yield call))
+        if result is not None:
+            return result
+    call = _edit_shader_call(current_shader=current_shader, **kwargs)
+    data = call if isinstance(call, dict) else (yield call)
+    return {**data, "edit": _rewrite_report(call, patch_report)}
 
 
 @weave.op()
-def fix_compile_errors(*, shader: str, compile_error: str) -> Dict[str, object]:
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
+def edit_shader(
+    *,
+    current_shader: str,
+    critique_text: str,
+    target_description: str | None,
+    reference_text: str | None = None,
+    discovery_context: str | None = None,
+    iteration: int = 0,
+    total_iterations: int = 1,
+    mode: str | None = None,
+    temperature: float | None = None,
+) -> Dict[str, object]:
+    """Edit the shader from a critique, as search/replace patches or a full rewrite (EDIT_MODE).
+
+    A patch that does not apply cleanly falls back to a full rewrite; the
+    result's `edit` entry reports the mode, fallback and per-call usage.
+    """
+    return _run(
+        _edit_steps(
+            current_shader=current_shader,
+            critique_text=critique_text,
+            target_description=target_description,
+            reference_text=reference_text,
+            discovery_context=discovery_context,
+            iteration=iteration,
+            total_iterations=total_iterations,
+            mode=mode,
+            temperature=temperature,
+        )
+    )
+
+
+@weave.op()
+async def aedit_shader(
+    *,
+    current_shader: str,
+    critique_text: str,
+    target_description: str | None,
+    reference_text: str | None = None,
+    discovery_context: str | None = None,
+    iteration: int = 0,
+    total_iterations: int = 1,
+    mode: str | None = None,
+    temperature: float | None = None,
+) -> Dict[str, object]:
+    return await _arun(
+        _edit_steps(
+            current_shader=current_shader,
+            critique_text=critique_text,
+            target_description=target_description,
+            reference_text=reference_text,
+            discovery_context=discovery_context,
+            iteration=iteration,
+            total_iterations=total_iterations,
+            mode=mode,
+            temperature=temperature,
+        )
+    )
+
+
+def _fix_compile_errors_call(
+    *, shader: str, compile_error: str, few_shot_examples: str | None = None
+) -> ChatCall | Dict[str, object]:
+    if not os.getenv("OPENAI_API_KEY"):
         return {"fragment_shader": shader, "notes": "OPENAI_API_KEY not set"}
 
-    client = OpenAI(api_key=api_key)
     model = os.getenv("OPENAI_MODEL", "gpt-4.1-mini")
 
-    glsl_rules = _load_glsl_rules()
-    rules_block = f"\n{glsl_rules}\n" if glsl_rules else ""
-
-    prompt = (
-        "You are a shader repair assistant. Return JSON only.\n"
-        "Fix compile errors without changing the visual intent.\n"
-        f"{INTERFACE_CONTRACT}\n"
-        f"{rules_block}"
-        f"Compile error:\n{compile_error}\n"
-        "Return JSON with keys: fragment_shader, notes.\n"
+    rules = get_prompt_registry().asset("glsl_rules")
+    prefix = get_prompt_registry().prefix(
+        "fix",
+        lambda: (
+            "You are a shader repair assistant. Return JSON only.\n"
+            "Fix compile errors without changing the visual intent.\n"
+            f"{INTERFACE_CONTRACT}\n"
+            f"{_rules_block(rules)}"
+            "Return JSON with keys: fragment_shader, notes.\n"
+        ),
+        rules,
     )
+    prompt = f"{few_shot_examples or ''}Compile error:\n{compile_error}\n"
 
-    data = _call_json_model(
-        client=client,
+    return ChatCall(
         model=model,
-        messages=[
-            {"role": "system", "content": "Return JSON only. Output must be valid JSON."},
-            {"role": "user", "content": prompt},
-            {"role": "user", "content": shader},
-        ],
+        messages=_messages(prefix, prompt, shader),
+        parse=_shader_result(shader),
+        kind="fix",
     )
 
-    fragment_shader = data.get("fragment_shader")
-    if not isinstance(fragment_shader, str) or "#version" not in fragment_shader:
-        fragment_shader = shader
 
-    notes = data.get("notes", "") if isinstance(data.get("notes"), str) else ""
-    return {"fragment_shader": fragment_shader, "notes": notes}
+@weave.op()
+def fix_compile_errors(*, shader: str, compile_error: str, few_shot_examples: str | None = None) -> Dict[str, object]:
+    return _run(_fix_compile_errors_call(shader=shader, compile_error=compile_error, few_shot_examples=few_shot_examples))
+
+
+@weave.op()
+async def afix_compile_errors(
+    *, shader: str, compile_error: str, few_shot_examples: str | None = None
+) -> Dict[str, object]:
+    return await _arun(
+        _fix_compile_errors_call(shader=shader, compile_error=compile_error, few_shot_examples=few_shot_examples)
+    )
@@ -1,9 +1,15 @@
 from __future__ import annotations
 
-import base64
-import json
-from io import BytesIO
+import asyncio
+import importlib.util
+import math
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, replace
 from pathlib import Path
+from typing import AsyncIterator, Literal
 
 from dotenv import load_dotenv
 
@@ -11,22 +17,61 @@ from dotenv import load_dotenv
 BASE_DIR = Path(__file__).resolve().parent.parent
 load_dotenv(BASE_DIR / ".env")
 
-from fastapi import FastAPI, File, UploadFile
-from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
+from fastapi import FastAPI, File, Request, UploadFile
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
+import numpy as np
 from PIL import Image
 from pydantic import BaseModel, Field
 
 from backend.agent import (
     DEFAULT_FRAGMENT_SHADER,
-    edit_shader,
-    fix_compile_errors,
-    generate_initial_shader,
-    run_discovery,
+    aedit_shader,
+    afix_compile_errors,
+    agenerate_initial_shader,
+    arun_discovery,
 )
-from backend.metrics import compute_lpips_multi
-from backend.render import render_iteration_frames
-from backend.vision import critique_images
+from backend.batch import (
+    BATCH_INPUT_ROOT,
+    Batch,
+    BatchError,
+    BatchItem,
+    batch_stats,
+    ingest,
+    is_live,
+    load_items,
+    start_batch,
+)
+from backend.discovery_cache import get_discovery_cache
+from backend.error_cache import get_error_cache
+from backend.glsl_repair import GLSL_REPAIR_MAX_PASSES, arepair_shader, repair_stats
+from backend.llm_client import aclose_openai_clients, close_openai_clients, start_usage_meter
+from backend.metrics import configure_torch_threads, warmup_lpips
+from backend.persist import RENDER_PERSIST, get_frame_writer, persist_frames
+from backend.prefilter import (
+    PREFILTER_SKIP_DEGENERATE,
+    PrefilterResult,
+    degenerate_critique,
+    prefilter_frames,
+    score_prefiltered,
+)
+from backend.prompts import get_prompt_registry
+from backend.render import CompileResult
+from backend.runs import CHECKPOINT, Event, RunJob, format_event, get_job, get_run_store, runs_snapshot
+from backend.scheduler import QueueFull, RunTicket, get_run_scheduler, scheduler_snapshot, stage
+from backend.render_pool import (
+    arender_frames_array,
+    avalidate_shader,
+    get_render_pool,
+    shutdown_render_pool,
+    warmup_renderer,
+)
+from backend.shader_patch import patch_stats
+from backend.stopping import StopPolicy, StopTracker, parse_similarity, stop_stats
+from backend.targets import PreparedTarget, prepare_target
+from backend.tuning import TUNE_ENABLED, atune_shader, tune_stats
+from backend.uploads import UploadError, UploadLimitMiddleware, get_upload_store
+from backend.vision import acritique_images
 import weave
 
 ASSETS_DIR = BASE_DIR / "assets"
@@ -34,11 +79,54 @@ UPLOADS_DIR = ASSETS_DIR / "uploads"
 RENDERS_DIR = ASSETS_DIR / "renders"
 FRONTEND_DIR = BASE_DIR / "frontend"
 DEFAULT_IMAGE_PATH = UPLOADS_DIR / "test1.png"
+COMPILE_REPAIR_ATTEMPTS = int(os.getenv("COMPILE_REPAIR_ATTEMPTS", "2"))
+SERVER_WARMUP = os.getenv("SERVER_WARMUP") in {"1", "true", "TRUE"}
+SCORING_WORKERS = int(os.getenv("SCORING_WORKERS", "2"))
+DISCONNECT_POLL_S = 0.25
+BEAM_WIDTH = int(os.getenv("BEAM_WIDTH", "1"))
+BEAM_TEMPERATURE = float(os.getenv("BEAM_TEMPERATURE", "0.9"))
 
 for p in (UPLOADS_DIR, RENDERS_DIR):
     p.mkdir(parents=True, exist_ok=True)
 
 app = FastAPI(title="La Shader is Shading")
+app.add_middleware(UploadLimitMiddleware)
+
+app.state.warmup = {"enabled": SERVER_WARMUP, "done": False}
+
+# Prefilter + LPIPS run here so torch inference never blocks the event loop.
+_scoring_executor = ThreadPoolExecutor(max_workers=max(SCORING_WORKERS, 1), thread_name_prefix="scoring")
+
+
+@app.on_event("startup")
+def _warmup() -> None:
+    """Configure torch threads and, with SERVER_WARMUP=1, load LPIPS + GL before accepting traffic."""
+    app.state.warmup["torch_threads"] = configure_torch_threads()
+    if not SERVER_WARMUP:
+        return
+
+    start = time.perf_counter()
+    try:
+        app.state.warmup["lpips_ms"] = warmup_lpips()
+    except Exception as exc:
+        app.state.warmup["lpips_error"] = str(exc)
+    try:
+        app.state.warmup["render_ms"] = warmup_renderer(DEFAULT_FRAGMENT_SHADER)
+    except Exception as exc:
+        app.state.warmup["render_error"] = str(exc)
+    app.state.warmup["total_ms"] = (time.perf_counter() - start) * 1000
+    app.state.warmup["done"] = True
+    print(f"[warmup] {app.state.warmup}")
+
+
+@app.on_event("shutdown")
+async def _shutdown_render_pool() -> None:
+    await aclose_openai_clients()
+    await asyncio.to_thread(shutdown_render_pool)
+    get_frame_writer().close()
+    close_openai_clients()
+    _scoring_executor.shutdown(wait=False, cancel_futures=True)
+
 
 app.mount("/static", StaticFiles(directory=FRONTEND_DIR), name="static")
 app.mount("/assets", StaticFiles(directory=ASSETS_DIR), name="assets")
@@ -56,22 +144,77 @@ def health() -> JSONResponse:
     else:
         lpips_error = ""
 
+    pool = get_render_pool()
+    discovery_cache = get_discovery_cache()
+    error_cache = get_error_cache()
+
     return JSONResponse(
         {
             "status": "ok",
             "lpips_available": lpips_available,
             "lpips_error": lpips_error,
+            "render_pool": pool.snapshot() if pool is not None else None,
+            "discovery_cache": discovery_cache.snapshot() if discovery_cache is not None else None,
+            "error_cache": error_cache.snapshot() if error_cache is not None else None,
+            "glsl_repair": repair_stats(),
+            "shader_patch": patch_stats(),
+            "tuning": tune_stats(),
+            "stopping": stop_stats(),
+            "uploads": get_upload_store().snapshot(),
+            "scheduler": scheduler_snapshot(),
+            "runs": runs_snapshot(),
+            "batches": batch_stats(),
+            "prompts": get_prompt_registry().snapshot(),
+            "warmup": app.state.warmup,
         }
     )
 
 
 class RunRequest(BaseModel):
-    image_id: str | None = Field(None, description="Upload id returned by /api/upload")
+    image_id: str | None = Field(None, description="Upload id returned by /api/upload; omit for the default image")
     iterations: int = Field(8, ge=1, le=20)
     num_frames: int = Field(1, ge=1, le=30, description="Frames to render per iteration")
     reference_text: str | None = Field(
         None, description="Optional reference text overriding the default summary"
     )
+    beam_width: int | None = Field(
+        None, ge=1, le=8, description="Edit candidates per iteration, rendered in parallel and ranked by LPIPS (BEAM_WIDTH)"
+    )
+    edit_mode: Literal["rewrite", "patch", "auto"] | None = Field(
+        None, description="Edit protocol: full rewrite, search/replace patches, or patches once refinement starts (EDIT_MODE)"
+    )
+    tune: bool | None = Field(
+        None, description="Tune numeric literals with renders and LPIPS only during refinement iterations (TUNE_ENABLED)"
+    )
+    lpips_target: float | None = Field(
+        None, ge=0, description="Stop once the best LPIPS is at or below this; 0 disables (STOP_LPIPS_TARGET)"
+    )
+    patience: int | None = Field(
+        None, ge=0, le=20, description="Stop after this many iterations without a min_delta LPIPS gain; 0 disables (STOP_PATIENCE)"
+    )
+    min_delta: float | None = Field(None, ge=0, description="LPIPS drop that counts as progress for patience (STOP_MIN_DELTA)")
+    similarity_target: float | None = Field(
+        None, ge=0, le=10, description="Stop once the critique's SIMILARITY SCORE reaches this; 0 disables (STOP_SIMILARITY_TARGET)"
+    )
+    time_budget_s: float | None = Field(
+        None, ge=0, description="Wall-clock budget; no iteration starts that would likely overrun it (RUN_TIME_BUDGET_S)"
+    )
+    token_budget: int | None = Field(
+        None, ge=0, description="OpenAI token budget across all calls of the run, checked the same way (RUN_TOKEN_BUDGET)"
+    )
+    detach: bool = Field(
+        False, description="Keep running when the client disconnects; follow it via /api/runs/{id}/events"
+    )
+
+
+class BatchRequest(BaseModel):
+    directory: str | None = Field(None, description="Directory of images, relative to BATCH_INPUT_ROOT")
+    manifest: str | None = Field(
+        None, description="JSONL manifest ({path|image_id, ...RunRequest fields}) or text list of paths, relative to BATCH_INPUT_ROOT"
+    )
+    image_ids: list[str] = Field(default_factory=list, description="Ids of images already sent to /api/upload")
+    run: RunRequest | None = Field(None, description="Settings for every image; manifest lines can override them")
+    concurrency: int | None = Field(None, ge=1, le=16, description="Images in flight at once (BATCH_CONCURRENCY)")
 
 
 @app.get("/", response_class=HTMLResponse)
@@ -86,73 +229,293 @@ def landing() -> str:
 
 @app.post("/api/upload")
 async def upload_image(file: UploadFile = File(...)) -> JSONResponse:
-    contents = await file.read()
-    app.state.latest_upload = contents
-    app.state.latest_upload_mime = file.content_type or "image/png"
+    try:
+        upload = await get_upload_store().save(file)
+    except UploadError as exc:
+        return JSONResponse({"error": str(exc)}, status_code=exc.status_code)
+    finally:
+        await file.close()
+
+    return JSONResponse({
+        "image_id": upload.image_id,
+        "url": upload.url,
+        "size": upload.size,
+        "deduplicated": upload.deduplicated,
+    })
+
+
+async def _repair_shader(shader: str, check: CompileResult) -> tuple[str, CompileResult, dict]:
+    """Deterministic rewrites, then known fixes (no LLM call), then the LLM with past fixes as few-shot examples."""
+    cache = get_error_cache()
+    repair = {"source": "none", "categories": check.categories, "rules": [], "llm_calls": 0, "examples": 0}
+    if GLSL_REPAIR_MAX_PASSES > 0:
+        ruled = await arepair_shader(shader, check)
+        repair["rules"] = ruled.applied
+        repair["rules_ms"] = round(ruled.elapsed_ms, 2)
+        shader, check = ruled.source, ruled.check
+        if check.ok:
+            repair["source"] = "rules"
+            return shader, check, repair
+
+    # Every cache call is a SQLite read or an autocommitted write, so all of them run off the event loop.
+    fixes = await asyncio.to_thread(cache.lookup, check) if cache is not None else []
+    if cache is not None:
+        await asyncio.to_thread(cache.count, "lookups")
+        for fix_id, patched in cache.mechanical_fixes(shader, fixes):
+            patched_check = await avalidate_shader(patched)
+            if patched_check.ok:
+                await asyncio.to_thread(cache.record_success, fix_id)
+                await asyncio.to_thread(cache.count, "mechanical_hits")
+                repair["source"] = "cache"
+                return patched, patched_check, repair
+        await asyncio.to_thread(cache.count, "few_shot_hits" if fixes else "misses")
+
+    examples = cache.get_few_shot_examples(fixes) if cache is not None else ""
+    repair["examples"] = min(len(fixes), 3)
+    candidate = shader
+    for _ in range(COMPILE_REPAIR_ATTEMPTS):
+        repaired = await afix_compile_errors(shader=candidate, compile_error=check.log, few_shot_examples=examples or None)
+        repair["llm_calls"] += 1
+        fixed = repaired.get("fragment_shader", candidate)
+        fixed_check = await avalidate_shader(fixed)
+        if fixed_check.ok:
+            if cache is not None:
+                await asyncio.to_thread(cache.store, check, candidate, fixed)
+            repair["source"] = "llm"
+            candidate, check = fixed, fixed_check
+            break
+        candidate, check = fixed, fixed_check
+    if cache is not None:
+        await asyncio.to_thread(cache.count, "llm_calls", repair["llm_calls"])
+    return candidate, check, repair
+
+
+@dataclass
+class _Candidate:
+    agent_out: dict
+    fragment_shader: str
+    shader_code: str
+    compile_error: str
+    compile_errors: list[dict]
+    repair: dict | None
+    frames: np.ndarray
+    prefilter: PrefilterResult
+
+
+async def _build_candidate(agent_out: dict, target: PreparedTarget, num_frames: int, last_good_shader: str) -> _Candidate:
+    """Validate (repairing if needed), render and prefilter one agent reply."""
+    fragment_shader = agent_out.get("fragment_shader", DEFAULT_FRAGMENT_SHADER)
+    compile_error = ""
+    compile_errors: list[dict] = []
+
+    # Compile-only fast path: repair against the cached context before paying for a render.
+    candidate = fragment_shader
+    check = await avalidate_shader(candidate)
+    repair = None
+    if not check.ok:
+        compile_error = check.log
+        compile_errors = [asdict(e) for e in check.errors]
+        candidate, check, repair = await _repair_shader(candidate, check)
+        if not check.ok:
+            candidate = last_good_shader
+
+    shader_code = candidate
+    try:
+        frames = await arender_frames_array(input_img=target, fragment_shader=candidate, num_frames=num_frames)
+    except Exception as exc:
+        # Compiled but failed at draw time (e.g. hit the render timeout).
+        compile_error = compile_error or str(exc)
+        shader_code = last_good_shader
+        frames = await arender_frames_array(input_img=target, fragment_shader=last_good_shader, num_frames=num_frames)
 
-    return JSONResponse({"image_id": "latest"})
+    loop = asyncio.get_running_loop()
+    prefilter = await loop.run_in_executor(_scoring_executor, prefilter_frames, target, frames)
+    return _Candidate(agent_out, fragment_shader, shader_code, compile_error, compile_errors, repair, frames, prefilter)
 
 
-def _sse(event: str, data: dict) -> str:
-    """Format a server-sent event."""
-    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+def _beam_rank(cand: _Candidate, scored: tuple) -> tuple:
+    """Lower is better: LPIPS when it ran, else the prefilter score; candidates that failed to compile go last."""
+    best_lpips, best_idx, _ = scored
+    value = best_lpips if best_lpips is not None else cand.prefilter.score[best_idx]
+    return (bool(cand.compile_error), best_lpips is None, value)
 
 
-@app.post("/api/run")
-async def run_loop(payload: RunRequest):
-    input_img = None
-    input_image_ref = None
+async def _score(target: PreparedTarget, frames: np.ndarray, prefilter: PrefilterResult) -> tuple:
+    """score_prefiltered on the scoring executor, within the shared `lpips` stage limit."""
+    async with stage("lpips"):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_scoring_executor, score_prefiltered, target, frames, prefilter)
 
-    if payload.image_id == "latest" and getattr(app.state, "latest_upload", None):
-        try:
-            input_img = Image.open(BytesIO(app.state.latest_upload))
-            mime = getattr(app.state, "latest_upload_mime", "image/png")
-            b64 = base64.b64encode(app.state.latest_upload).decode("ascii")
-            input_image_ref = f"data:{mime};base64,{b64}"
-        except Exception:
-            input_img = None
 
-    if input_img is None:
-        if not DEFAULT_IMAGE_PATH.exists():
-            return JSONResponse({"error": "default image not found"}, status_code=404)
-        input_img = Image.open(DEFAULT_IMAGE_PATH)
-        input_image_ref = "/assets/uploads/test1.png"
+async def _tune_candidate(
+    cand: _Candidate, scored: tuple, target: PreparedTarget, num_frames: int
+) -> tuple[dict, _Candidate | None, tuple | None]:
+    """Tune the rendered shader's literals; return the tuned candidate only if it beats `cand` at full frame count."""
+    result = await atune_shader(target, cand.shader_code, executor=_scoring_executor)
+    event = result.to_event()
+    if not result.improved:
+        return event, None, None
+    frames = await arender_frames_array(input_img=target, fragment_shader=result.source, num_frames=num_frames)
+    loop = asyncio.get_running_loop()
+    prefilter = await loop.run_in_executor(_scoring_executor, prefilter_frames, target, frames)
+    tuned_scored = await _score(target, frames, prefilter)
+    tuned = replace(cand, shader_code=result.source, compile_error="", frames=frames, prefilter=prefilter)
+    event["lpips_score"] = tuned_scored[0]
+    if _beam_rank(tuned, tuned_scored) >= _beam_rank(cand, scored):
+        event["reason"] = "no gain at full frame count"
+        return event, None, None
+    return event, tuned, tuned_scored
+
+
+async def _critique_frame(target: PreparedTarget, frames: np.ndarray, prefilter: PrefilterResult, index: int) -> str:
+    if PREFILTER_SKIP_DEGENERATE and prefilter.all_degenerate:
+        return degenerate_critique(prefilter.degenerate[index])
+    return await acritique_images(target_img=target, output_img=Image.fromarray(frames[index]))
 
-    ref_text = payload.reference_text
-    num_iterations = payload.iterations
-    num_frames = payload.num_frames
 
-    def event_stream():
-        nonlocal input_img
+def _render_url(path: Path) -> str:
+    return f"/assets/renders/{path.relative_to(RENDERS_DIR).as_posix()}"
 
-        # --- emit input image ---
-        yield _sse("input_image", {"input_image": input_image_ref})
 
-        # --- Phase A: Discovery ---
-        discovery = run_discovery(reference_text=ref_text, target_img=input_img)
-        discovery_initial = discovery.get("initial_prompt", "")
-        discovery_edit = discovery.get("edit_prompt", "")
+async def _wait_for_disconnect(request: Request) -> None:
+    while not await request.is_disconnected():
+        await asyncio.sleep(DISCONNECT_POLL_S)
 
-        yield _sse("discovery", {
+
+async def _until_disconnect(request: Request, events: AsyncIterator[str]) -> AsyncIterator[str]:
+    """Relay `events`, closing them as soon as the client goes away.
+
+    Starlette only notices a disconnect on its next send, which for a run
+    can be minutes of LLM, render and LPIPS work away.
+    """
+    watcher = asyncio.ensure_future(_wait_for_disconnect(request))
+    step: asyncio.Future | None = None
+    try:
+        while True:
+            step = asyncio.ensure_future(anext(events))
+            await asyncio.wait({step, watcher}, return_when=asyncio.FIRST_COMPLETED)
+            if not step.done():
+                return
+            try:
+                chunk = step.result()
+            except StopAsyncIteration:
+                return
+            yield chunk
+    finally:
+        watcher.cancel()
+        if step is not None and not step.done():
+            # The follower unwinds in its own task; an owning stream cancels its run unless detached.
+            step.cancel()
+            print("[run] client disconnected")
+        else:
+            await events.aclose()
+
+
+async def _when_admitted(ticket: RunTicket, events: AsyncIterator[tuple[str, dict]]) -> AsyncIterator[tuple[str, dict]]:
+    """Report the run's queue position until the scheduler admits it, then run it; frees the slot on exit."""
+    try:
+        queued = ticket.position > 0
+        while (position := ticket.position) > 0:
+            snapshot = get_run_scheduler().snapshot()
+            yield ("queue", {
+                "run_id": ticket.run_id,
+                "position": position,
+                "queue_depth": snapshot["queue_depth"],
+                "running": snapshot["running"],
+            })
+            await ticket.wait_changed()
+        if queued:
+            yield ("queue", {"run_id": ticket.run_id, "position": 0, "waited_ms": round(ticket.waited_ms, 1)})
+        async for item in events:
+            yield item
+    finally:
+        ticket.release()
+        await events.aclose()
+
+
+async def _pipeline(
+    run_id: str,
+    payload: RunRequest,
+    input_img: Image.Image,
+    prepared: PreparedTarget | None,
+    input_image_ref: str,
+    checkpoint: dict | None = None,
+) -> AsyncIterator[tuple[str, dict]]:
+    """Discovery, then the iteration loop, as (event, data) pairs.
+
+    Yields CHECKPOINT items after discovery and after each iteration; given
+    a stored checkpoint, discovery and the iterations it already completed
+    are skipped and the loop state is restored from it. The loop ends early
+    when the stopping policy says so; `done` carries the reason.
+    """
+    ref_text = payload.reference_text
+    num_iterations = payload.iterations
+    num_frames = payload.num_frames
+    beam_width = payload.beam_width or BEAM_WIDTH
+    tune = TUNE_ENABLED if payload.tune is None else payload.tune
+    checkpoint = checkpoint or {}
+    state = checkpoint.get("state") or {}
+    # Budgets count discovery too: its tokens and time are part of what the run costs.
+    usage = start_usage_meter()
+    stopping = StopTracker(
+        StopPolicy.from_request(
+            lpips_target=payload.lpips_target,
+            patience=payload.patience,
+            min_delta=payload.min_delta,
+            similarity_target=payload.similarity_target,
+            time_budget_s=payload.time_budget_s,
+            token_budget=payload.token_budget,
+        ),
+        state.get("stopping"),
+    )
+
+    # --- Phase A: Discovery (kept from the checkpoint when resuming) ---
+    discovery = checkpoint.get("discovery")
+    if discovery is None:
+        yield ("input_image", {"input_image": input_image_ref})
+        discovery = await arun_discovery(reference_text=ref_text, target_img=input_img)
+        yield ("discovery", {
             "gap_analysis": discovery.get("gap_analysis", ""),
             "notes": discovery.get("notes", ""),
+            "cached": bool(discovery.get("cached", False)),
         })
-
-        # --- Phase B: Iteration loop ---
-        best = {"score": None, "render_path": "", "shader_code": "", "metric": ""}
-        prev_shader = None
-        prev_critique = None
-        last_good_shader = DEFAULT_FRAGMENT_SHADER
-
-        for i in range(num_iterations):
-            if i == 0:
-                agent_out = generate_initial_shader(
+        yield (CHECKPOINT, {"discovery": discovery})
+    discovery_initial = discovery.get("initial_prompt", "")
+    discovery_edit = discovery.get("edit_prompt", "")
+
+    # --- Phase B: Iteration loop ---
+    # Resize the target once; renderer, LPIPS and critique share its cached encodings.
+    target = prepared or await asyncio.to_thread(prepare_target, input_img)
+    # Frames go under the run's own directory so concurrent runs never overwrite each other's iter_XX files.
+    render_dir = RENDERS_DIR / run_id
+    render_dir.mkdir(parents=True, exist_ok=True)
+    best = state.get("best") or {"score": None, "render_path": "", "shader_code": "", "metric": ""}
+    prev_shader = state.get("prev_shader")
+    prev_critique = state.get("prev_critique")
+    last_good_shader = state.get("last_good_shader") or DEFAULT_FRAGMENT_SHADER
+    start = checkpoint.get("completed", 0) if state else 0
+    if start:
+        yield ("resume", {"run_id": run_id, "from_iteration": start + 1, "best_score": best["score"]})
+
+    for i in range(start, num_iterations):
+        stopping.set_tokens(usage.tokens)
+        if stopping.before_iteration():
+            break
+        # Beam candidates after the first sample hotter so they explore different edits.
+        temperatures = [None] + [BEAM_TEMPERATURE] * (beam_width - 1)
+        if i == 0:
+            agent_outs = await asyncio.gather(*(
+                agenerate_initial_shader(
                     target_description=None,
                     reference_text=ref_text,
                     discovery_context=discovery_initial,
+                    temperature=temperature,
                 )
-            else:
-                agent_out = edit_shader(
+                for temperature in temperatures
+            ))
+        else:
+            agent_outs = await asyncio.gather(*(
+                aedit_shader(
                     current_shader=prev_shader or last_good_shader,
                     critique_text=prev_critique or "No critique available.",
                     target_description=None,
@@ -160,102 +523,472 @@ async def run_loop(payload: RunRequest):
                     discovery_context=discovery_edit,
                     iteration=i,
                     total_iterations=num_iterations,
+                    mode=payload.edit_mode,
+                    temperature=temperature,
                 )
-            fragment_shader = agent_out.get("fragment_shader", DEFAULT_FRAGMENT_SHADER)
-            compile_error = ""
-            try:
-                render_paths, shader_code, render_imgs, input_img = render_iteration_frames(
-                    input_img=input_img,
-                    iteration=i,
-                    total_iterations=num_iterations,
-                    fragment_shader=fragment_shader,
-                    output_dir=RENDERS_DIR,
-                    num_frames=num_frames,
-                )
-                last_good_shader = fragment_shader
-            except Exception as exc:
-                compile_error = str(exc)
-                repaired = fix_compile_errors(shader=fragment_shader, compile_error=compile_error)
-                repaired_shader = repaired.get("fragment_shader", last_good_shader)
-                try:
-                    render_paths, shader_code, render_imgs, input_img = render_iteration_frames(
-                        input_img=input_img,
-                        iteration=i,
-                        total_iterations=num_iterations,
-                        fragment_shader=repaired_shader,
-                        output_dir=RENDERS_DIR,
-                        num_frames=num_frames,
-                    )
-                    last_good_shader = repaired_shader
-                except Exception:
-                    render_paths, shader_code, render_imgs, input_img = render_iteration_frames(
-                        input_img=input_img,
-                        iteration=i,
-                        total_iterations=num_iterations,
-                        fragment_shader=last_good_shader,
-                        output_dir=RENDERS_DIR,
-                        num_frames=num_frames,
-                    )
-
-            best_lpips, best_frame_idx, all_lpips = compute_lpips_multi(input_img, render_imgs)
-            best_render_img = render_imgs[best_frame_idx]
-            critique_text = critique_images(target_img=input_img, output_img=best_render_img)
-
+                for temperature in temperatures
+            ))
+        # Identical replies would render and score the same frames twice.
+        unique_outs = list({out.get("fragment_shader"): out for out in reversed(agent_outs)}.values())[::-1]
+        candidates = await asyncio.gather(*(
+            _build_candidate(out, target, num_frames, last_good_shader) for out in unique_outs
+        ))
+
+        persist_best_only = RENDER_PERSIST == "best"
+        beam = None
+        if len(candidates) == 1:
+            cand = candidates[0]
+            # Frames stay in memory for scoring; disk writes overlap with LPIPS and critique.
+            render_paths, pending_writes = ([], []) if persist_best_only else await asyncio.to_thread(
+                persist_frames, cand.frames, iteration=i, output_dir=render_dir
+            )
+
+            # The cheap tier picks the critique frame up front, so the VLM call runs alongside
+            # LPIPS on the prefilter's top-k instead of after it.
+            critique_frame_idx = cand.prefilter.ranked[0]
+            yield ("render", {
+                "iteration": i + 1,
+                "num_frames": num_frames,
+                "compile_error": cand.compile_error,
+                "prefilter": cand.prefilter.to_event(),
+                "critique_frame_index": critique_frame_idx,
+            })
+
+            score_task = asyncio.ensure_future(_score(target, cand.frames, cand.prefilter))
+            critique_task = asyncio.ensure_future(_critique_frame(target, cand.frames, cand.prefilter, critique_frame_idx))
+            pending = {score_task, critique_task}
             try:
-                weave.log(
+                while pending:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    if score_task in done:
+                        best_lpips, best_frame_idx, all_lpips = score_task.result()
+                        if persist_best_only:
+                            render_paths, pending_writes = await asyncio.to_thread(
+                                persist_frames, cand.frames, iteration=i, output_dir=render_dir, indices=[best_frame_idx]
+                            )
+                        yield ("score", {
+                            "iteration": i + 1,
+                            "lpips_score": best_lpips,
+                            "lpips_scores": all_lpips,
+                            "best_frame_index": best_frame_idx,
+                        })
+                    if critique_task in done:
+                        critique_text = critique_task.result()
+                        yield ("critique", {
+                            "iteration": i + 1,
+                            "critique": critique_text,
+                            "critique_frame_index": critique_frame_idx,
+                        })
+            finally:
+                for task in pending:
+                    task.cancel()
+        else:
+            yield ("render", {
+                "iteration": i + 1,
+                "num_frames": num_frames,
+                "beam_width": len(candidates),
+                "compile_error": candidates[0].compile_error,
+                "compile_errors_by_candidate": [c.compile_error for c in candidates],
+            })
+
+            # Every candidate's top-k goes through LPIPS; only the winner is critiqued.
+            scored = await asyncio.gather(*(
+                _score(target, c.frames, c.prefilter) for c in candidates
+            ))
+            order = sorted(range(len(candidates)), key=lambda k: _beam_rank(candidates[k], scored[k]))
+            winner = order[0]
+            cand = candidates[winner]
+            best_lpips, best_frame_idx, all_lpips = scored[winner]
+            critique_frame_idx = best_frame_idx
+            beam = {
+                "width": len(candidates),
+                "requested": beam_width,
+                "winner": winner,
+                "ranking": order,
+                "candidates": [
                     {
-                        "iteration": i + 1,
-                        "lpips_score": best_lpips,
-                        "lpips_scores": all_lpips,
-                        "best_frame_index": best_frame_idx,
-                        "num_frames": num_frames,
-                        "compile_error": compile_error,
-                        "render_paths": [str(p) for p in render_paths],
+                        "lpips_score": scored[k][0],
+                        "best_frame_index": scored[k][1],
+                        "compile_error": bool(c.compile_error),
+                        "repair": c.repair["source"] if c.repair else None,
+                        "edit": (c.agent_out.get("edit") or {}).get("mode"),
+                        "notes": c.agent_out.get("notes", ""),
                     }
-                )
-            except Exception:
-                pass
-
-            iter_data = {
+                    for k, c in enumerate(candidates)
+                ],
+            }
+            render_paths, pending_writes = await asyncio.to_thread(
+                persist_frames,
+                cand.frames,
+                iteration=i,
+                output_dir=render_dir,
+                **({"indices": [best_frame_idx]} if persist_best_only else {}),
+            )
+            yield ("score", {
                 "iteration": i + 1,
                 "lpips_score": best_lpips,
                 "lpips_scores": all_lpips,
                 "best_frame_index": best_frame_idx,
-                "render_paths": [f"/assets/renders/{p.name}" for p in render_paths],
-                "render_path": f"/assets/renders/{render_paths[best_frame_idx].name}",
-                "shader_code": shader_code,
-                "compile_error": compile_error,
+                "beam": beam,
+            })
+
+            critique_text = await _critique_frame(target, cand.frames, cand.prefilter, critique_frame_idx)
+            yield ("critique", {
+                "iteration": i + 1,
                 "critique": critique_text,
-                "agent_notes": agent_out.get("notes", ""),
-            }
-            yield _sse("iteration", iter_data)
-
-            rank_value = best_lpips
-            rank_metric = "lpips"
-            rank_is_lower = True
-
-            if rank_value is None:
-                should_replace = False
-            elif best["score"] is None:
-                should_replace = True
-            elif rank_is_lower and rank_value < best["score"]:
-                should_replace = True
-            elif not rank_is_lower and rank_value > best["score"]:
-                should_replace = True
-            else:
-                should_replace = False
-
-            if should_replace:
-                best = {
-                    "score": rank_value,
-                    "render_path": f"/assets/renders/{render_paths[best_frame_idx].name}",
-                    "shader_code": shader_code,
-                    "metric": rank_metric,
+                "critique_frame_index": critique_frame_idx,
+            })
+        await asyncio.gather(*(asyncio.wrap_future(write) for write in pending_writes))
+
+        prefilter = cand.prefilter
+        shader_code = cand.shader_code
+        compile_error = cand.compile_error
+        last_good_shader = cand.shader_code
+
+        best_path = ""
+        if render_paths:
+            best_path = render_paths[0 if persist_best_only else best_frame_idx]
+            best_path = _render_url(best_path)
+
+        try:
+            weave.log(
+                {
+                    "iteration": i + 1,
+                    "lpips_score": best_lpips,
+                    "lpips_scores": all_lpips,
+                    "best_frame_index": best_frame_idx,
+                    "num_frames": num_frames,
+                    "compile_error": compile_error,
+                    "prefilter": prefilter.to_event(),
+                    "render_paths": [str(p) for p in render_paths],
                 }
-            prev_shader = fragment_shader
-            prev_critique = critique_text
+            )
+        except Exception:
+            pass
+
+        iter_data = {
+            "iteration": i + 1,
+            "lpips_score": best_lpips,
+            "lpips_scores": all_lpips,
+            "best_frame_index": best_frame_idx,
+            "critique_frame_index": critique_frame_idx,
+            "prefilter": prefilter.to_event(),
+            "render_paths": [_render_url(p) for p in render_paths],
+            "render_path": best_path,
+            "shader_code": shader_code,
+            "compile_error": compile_error,
+            "compile_errors": cand.compile_errors,
+            "repair": cand.repair,
+            "critique": critique_text,
+            "agent_notes": cand.agent_out.get("notes", ""),
+            "edit": cand.agent_out.get("edit"),
+            "beam": beam,
+            "similarity": parse_similarity(critique_text),
+        }
+        yield ("iteration", iter_data)
+
+        rank_value = best_lpips
+        rank_metric = "lpips"
+        rank_is_lower = True
+
+        if rank_value is None:
+            should_replace = False
+        elif best["score"] is None:
+            should_replace = True
+        elif rank_is_lower and rank_value < best["score"]:
+            should_replace = True
+        elif not rank_is_lower and rank_value > best["score"]:
+            should_replace = True
+        else:
+            should_replace = False
+
+        if should_replace:
+            best = {
+                "score": rank_value,
+                "render_path": best_path,
+                "shader_code": shader_code,
+                "metric": rank_metric,
+            }
+        prev_shader = cand.fragment_shader
+        prev_critique = critique_text
+
+        # Refinement iterations: numeric literals are tuned with renders + LPIPS alone, no LLM call.
+        if tune and i >= num_iterations // 2:
+            tune_event, tuned, tuned_scored = await _tune_candidate(
+                cand, (best_lpips, best_frame_idx, all_lpips), target, num_frames
+            )
+            tune_event.update({"iteration": i + 1, "accepted": tuned is not None})
+            if tuned is not None:
+                tuned_lpips, tuned_idx, _ = tuned_scored
+                tuned_paths, tuned_writes = await asyncio.to_thread(
+                    persist_frames, tuned.frames, iteration=i, output_dir=render_dir, indices=[tuned_idx], stem="tuned"
+                )
+                await asyncio.gather(*(asyncio.wrap_future(write) for write in tuned_writes))
+                tuned_path = _render_url(tuned_paths[0])
+                tune_event.update({"render_path": tuned_path, "shader_code": tuned.shader_code})
+                if tuned_lpips is not None and (best["score"] is None or tuned_lpips < best["score"]):
+                    best = {
+                        "score": tuned_lpips,
+                        "render_path": tuned_path,
+                        "shader_code": tuned.shader_code,
+                        "metric": "lpips",
+                    }
+                # The next edit starts from the tuned values; the critique still applies to its structure.
+                last_good_shader = prev_shader = tuned.shader_code
+            yield ("tune", tune_event)
+
+        stopping.set_tokens(usage.tokens)
+        stop_reason = stopping.observe(best["score"], critique_text)
+
+        # Everything the next iteration needs, so an interrupted run resumes here.
+        yield (CHECKPOINT, {
+            "completed": i + 1,
+            "state": {
+                "best": best,
+                "prev_shader": prev_shader,
+                "prev_critique": prev_critique,
+                "last_good_shader": last_good_shader,
+                "stopping": stopping.to_state(),
+            },
+        })
+        if stop_reason:
+            break
+
+    stopping.set_tokens(usage.tokens)
+    yield ("best", best)
+    yield ("done", stopping.to_event(num_iterations))
+
+
+async def _resolve_image(image_id: str | None) -> tuple[Image.Image, PreparedTarget | None, str] | JSONResponse:
+    if image_id:
+        try:
+            decoded = await asyncio.to_thread(get_upload_store().decode, image_id)
+        except Exception as exc:
+            return JSONResponse({"error": f"upload {image_id} could not be decoded: {exc}"}, status_code=422)
+        if decoded is None:
+            return JSONResponse({"error": f"unknown image_id {image_id}"}, status_code=404)
+        return decoded.image, decoded.target, decoded.upload.url
+    if not DEFAULT_IMAGE_PATH.exists():
+        return JSONResponse({"error": "default image not found"}, status_code=404)
+    return Image.open(DEFAULT_IMAGE_PATH), None, "/assets/uploads/test1.png"
+
+
+async def _launch_job(
+    run_id: str,
+    payload: RunRequest,
+    image: tuple[Image.Image, PreparedTarget | None, str],
+    ticket: RunTicket,
+    checkpoint: dict | None = None,
+    detach: bool = False,
+) -> RunJob:
+    """Record the run (or rewind it to its checkpoint) and start it as a server-side job."""
+    input_img, prepared, input_image_ref = image
+    store = get_run_store()
+    if checkpoint is None:
+        await asyncio.to_thread(store.create, run_id, payload.model_dump(), input_image_ref)
+        history = []
+    else:
+        await asyncio.to_thread(store.set_status, run_id, "running")
+        history = await asyncio.to_thread(store.rewind, run_id)
+
+    job = RunJob(run_id, store, history, detached=detach)
+    await job.append("run", {"run_id": run_id, "detached": detach, "resumed": checkpoint is not None})
+    job.start(_when_admitted(ticket, _pipeline(run_id, payload, input_img, prepared, input_image_ref, checkpoint)))
+    return job
+
+
+def _checkpoint_of(record: dict) -> dict:
+    return {"discovery": record["discovery"], "state": record["state"], "completed": record["completed"]}
+
+
+async def _start_run(
+    run_id: str,
+    payload: RunRequest,
+    image: tuple[Image.Image, PreparedTarget | None, str],
+    request: Request,
+    checkpoint: dict | None = None,
+    detach: bool = False,
+):
+    """Admit the run, start it as a server-side job and stream its events to this request."""
+    # Admission happens before streaming starts, so a full queue is a plain 429 the client can retry.
+    try:
+        ticket = get_run_scheduler().admit(run_id)
+    except QueueFull as exc:
+        return JSONResponse(
+            {"error": str(exc), "retry_after": exc.retry_after},
+            status_code=429,
+            headers={"Retry-After": str(math.ceil(exc.retry_after))},
+        )
+    job = await _launch_job(run_id, payload, image, ticket, checkpoint, detach)
+    return StreamingResponse(
+        _until_disconnect(request, job.follow(owner=True)),
+        media_type="text/event-stream",
+        headers={"X-Run-Id": run_id},
+    )
+
+
+async def run_to_completion(run_id: str, settings: dict) -> tuple[str, list[Event]]:
+    """Run `run_id` with no client attached and wait for it; batches run each image this way.
+
+    A run the store already has is resumed from its checkpoint, or just read
+    back if it finished, so re-running a batch never repeats finished work.
+    Admission goes through the same queue as interactive runs, but a full
+    queue is waited out rather than refused.
+    """
+    payload = RunRequest(**{**settings, "detach": True})
+    store = get_run_store()
+    job = get_job(run_id)
+    if job is None:
+        record = await asyncio.to_thread(store.get, run_id)
+        if record is not None and record["status"] == "done":
+            return "done", await asyncio.to_thread(store.events, run_id)
+        image = await _resolve_image(payload.image_id)
+        if isinstance(image, JSONResponse):
+            raise LookupError(f"image {payload.image_id} could not be loaded")
+        while True:
+            try:
+                ticket = get_run_scheduler().admit(run_id)
+                break
+            except QueueFull as exc:
+                await asyncio.sleep(exc.retry_after)
+        job = await _launch_job(
+            run_id, payload, image, ticket, _checkpoint_of(record) if record is not None else None, detach=True
+        )
+    await job.task
+    return job.status, job.events
+
+
+@app.post("/api/run")
+async def run_loop(payload: RunRequest, request: Request):
+    image = await _resolve_image(payload.image_id)
+    if isinstance(image, JSONResponse):
+        return image
+    return await _start_run(uuid.uuid4().hex[:12], payload, image, request, detach=payload.detach)
+
+
+@app.get("/api/runs/{run_id}")
+def get_run(run_id: str) -> JSONResponse:
+    record = get_run_store().get(run_id)
+    if record is None:
+        return JSONResponse({"error": f"unknown run {run_id}"}, status_code=404)
+    record["live"] = get_job(run_id) is not None
+    return JSONResponse(record)
+
+
+@app.get("/api/runs/{run_id}/events")
+async def run_events(run_id: str, request: Request, since: int = 0):
+    """Replay a run's events after `since` (or `Last-Event-ID`); follows a live run until it finishes."""
+    last_event_id = request.headers.get("last-event-id", "")
+    if last_event_id.isdigit():
+        since = max(since, int(last_event_id))
+    job = get_job(run_id)
+    if job is not None:
+        return StreamingResponse(_until_disconnect(request, job.follow(since)), media_type="text/event-stream")
+
+    store = get_run_store()
+    if await asyncio.to_thread(store.get, run_id) is None:
+        return JSONResponse({"error": f"unknown run {run_id}"}, status_code=404)
+    events = await asyncio.to_thread(store.events, run_id, since)
+
+    async def replay() -> AsyncIterator[str]:
+        for seq, event, data in events:
+            yield format_event(seq, event, data)
+
+    return StreamingResponse(replay(), media_type="text/event-stream")
+
+
+@app.post("/api/runs/{run_id}/resume")
+async def resume_run(run_id: str, request: Request, detach: bool | None = None):
+    """Continue an interrupted or failed run from its last completed iteration."""
+    record = await asyncio.to_thread(get_run_store().get, run_id)
+    if record is None:
+        return JSONResponse({"error": f"unknown run {run_id}"}, status_code=404)
+    if get_job(run_id) is not None:
+        return JSONResponse({"error": "run is still running"}, status_code=409)
+    if record["status"] == "done":
+        return JSONResponse({"error": "run already finished"}, status_code=409)
+
+    payload = RunRequest(**record["payload"])
+    image = await _resolve_image(payload.image_id)
+    if isinstance(image, JSONResponse):
+        return image
+    return await _start_run(
+        run_id, payload, image, request, _checkpoint_of(record), detach=payload.detach if detach is None else detach
+    )
+
+
+def _batch_input(relative: str) -> Path:
+    path = (BATCH_INPUT_ROOT / relative).resolve()
+    if not path.is_relative_to(BATCH_INPUT_ROOT.resolve()):
+        raise BatchError("path is outside BATCH_INPUT_ROOT")
+    return path
+
+
+@app.post("/api/batches")
+async def create_batch(payload: BatchRequest) -> JSONResponse:
+    """Start a batch over a directory, a manifest and/or uploaded image ids; poll /api/batches/{id} for progress."""
+    run = payload.run.model_dump(exclude_unset=True) if payload.run is not None else {}
+    run.pop("image_id", None)
+    try:
+        items: list[BatchItem] = []
+        for source in (payload.directory, payload.manifest):
+            if source:
+                items.extend(await asyncio.to_thread(load_items, _batch_input(source)))
+        items.extend(BatchItem(index=0, source=image_id, image_id=image_id) for image_id in payload.image_ids)
+        if not items:
+            raise BatchError("give a directory, a manifest or image_ids")
+        for index, item in enumerate(items):
+            item.index = index
+            RunRequest(**{**run, **item.settings})
+    except BatchError as exc:
+        return JSONResponse({"error": str(exc)}, status_code=exc.status_code)
+    except ValueError as exc:
+        return JSONResponse({"error": str(exc)}, status_code=422)
+
+    await asyncio.to_thread(ingest, items, BATCH_INPUT_ROOT)
+    batch = await asyncio.to_thread(Batch.create, items, run, payload.concurrency)
+    start_batch(batch, run_to_completion)
+    return JSONResponse(
+        {
+            "batch_id": batch.batch_id,
+            "items": len(items),
+            "rejected": [{"index": item.index, "source": item.source, "error": item.error} for item in items if item.error],
+        },
+        status_code=202,
+    )
 
-        yield _sse("best", best)
-        yield _sse("done", {})
 
-    return StreamingResponse(event_stream(), media_type="text/event-stream")
+@app.get("/api/batches/{batch_id}")
+async def get_batch(batch_id: str) -> JSONResponse:
+    batch = await asyncio.to_thread(Batch.load, batch_id)
+    if batch is None:
+        return JSONResponse({"error": f"unknown batch {batch_id}"}, status_code=404)
+    progress = await asyncio.to_thread(batch.progress, is_live(batch_id))
+    return JSONResponse({**progress, "results_url": f"/api/batches/{batch_id}/results"})
+
+
+@app.get("/api/batches/{batch_id}/results")
+async def get_batch_results(batch_id: str, format: Literal["jsonl", "parquet"] = "jsonl"):
+    batch = await asyncio.to_thread(Batch.load, batch_id)
+    if batch is None:
+        return JSONResponse({"error": f"unknown batch {batch_id}"}, status_code=404)
+    path = batch.parquet_path if format == "parquet" else batch.results_path
+    if not path.exists():
+        reason = "pyarrow is not installed" if format == "parquet" and importlib.util.find_spec("pyarrow") is None else "none yet"
+        return JSONResponse({"error": f"no {format} results: {reason}"}, status_code=404)
+    return FileResponse(path, media_type="application/x-ndjson" if format == "jsonl" else "application/vnd.apache.parquet")
+
+
+@app.post("/api/batches/{batch_id}/resume")
+async def resume_batch(batch_id: str) -> JSONResponse:
+    """Continue an interrupted batch: images without a done row run again, cut-short runs resume."""
+    batch = await asyncio.to_thread(Batch.load, batch_id)
+    if batch is None:
+        return JSONResponse({"error": f"unknown batch {batch_id}"}, status_code=404)
+    if is_live(batch_id):
+        return JSONResponse({"error": "batch is still running"}, status_code=409)
+    remaining = await asyncio.to_thread(batch.remaining)
+    if not remaining:
+        return JSONResponse({"error": "batch already finished"}, status_code=409)
+    start_batch(batch, run_to_completion)
+    return JSONResponse({"batch_id": batch_id, "remaining": len(remaining)}, status_code=202)
@@ -0,0 +1,455 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any, Awaitable, Callable
+
+from backend.runs import Event
+from backend.uploads import UploadError, get_upload_store
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+BATCH_DIR = Path(os.getenv("BATCH_DIR", str(BASE_DIR / "data" / "batches")))
+BATCH_INPUT_ROOT = Path(os.getenv("BATCH_INPUT_ROOT", str(BASE_DIR / "data" / "batch_inputs")))  # the API reads inputs only under here
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "2"))  # images of one batch in flight; each is a run in the shared queue
+
+IMAGE_SUFFIXES = {".png", ".jpg", ".jpeg", ".webp", ".gif", ".bmp"}
+MANIFEST_SUFFIXES = {".jsonl", ".ndjson"}
+_BATCH_ID = re.compile(r"[0-9a-f]{12}")
+
+# (run_id, RunRequest fields) -> (final run status, the run's events)
+Execute = Callable[[str, dict[str, Any]], Awaitable[tuple[str, list[Event]]]]
+
+_stats = {"batches": 0, "items_done": 0, "items_failed": 0}
+_stats_lock = threading.Lock()
+
+
+class BatchError(Exception):
+    """Unusable batch input; `status_code` is the HTTP status to return."""
+
+    def __init__(self, message: str, status_code: int = 400) -> None:
+        super().__init__(message)
+        self.status_code = status_code
+
+
+@dataclass
+class BatchItem:
+    index: int
+    source: str  # the path or image_id as given
+    image_id: str = ""
+    settings: dict[str, Any] = field(default_factory=dict)  # RunRequest fields from the manifest line
+    error: str = ""  # why the image could not be imported; such items are never run
+
+
+def load_items(source: Path) -> list[BatchItem]:
+    """Items from a directory of images, a JSONL manifest or a text file with one path per line.
+
+    Manifest lines are `{"path": ...}` or `{"image_id": ...}` plus any
+    RunRequest fields for that image (e.g. `reference_text`). Relative paths
+    resolve against the manifest's directory.
+    """
+    if source.is_dir():
+        paths = sorted(p for p in source.iterdir() if p.is_file() and p.suffix.lower() in IMAGE_SUFFIXES)
+        if not paths:
+            raise BatchError(f"no images in {source}")
+        return [BatchItem(index=k, source=str(p)) for k, p in enumerate(paths)]
+    if not source.is_file():
+        raise BatchError(f"{source} not found", status_code=404)
+
+    items: list[BatchItem] = []
+    for line_no, line in enumerate(source.read_text().splitlines(), 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        if source.suffix.lower() in MANIFEST_SUFFIXES:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError as exc:
+                raise BatchError(f"{source.name}:{line_no}: {exc}") from exc
+            if not isinstance(entry, dict):
+                raise BatchError(f"{source.name}:{line_no}: expected a JSON object")
+        else:
+            entry = {"path": line}
+        path, image_id = entry.pop("path", None), entry.pop("image_id", None)
+        if not path and not image_id:
+            raise BatchError(f"{source.name}:{line_no}: needs a path or an image_id")
+        if path and not Path(path).is_absolute():
+            path = str(source.parent / path)
+        items.append(BatchItem(index=len(items), source=path or image_id, image_id=image_id or "", settings=entry))
+    if not items:
+        raise BatchError(f"{source.name} lists no images")
+    return items
+
+
+def ingest(items: list[BatchItem], root: Path | None = None) -> None:
+    """Copy each item's image into the upload store and set its image_id; failures stay on the item.
+
+    With `root`, paths outside it are refused (the API passes BATCH_INPUT_ROOT).
+    """
+    store = get_upload_store()
+    for item in items:
+        if item.image_id:
+            if store.get(item.image_id) is None:
+                item.error = f"unknown image_id {item.image_id}"
+            continue
+        path = Path(item.source).resolve()
+        if root is not None and not path.is_relative_to(root.resolve()):
+            item.error = "path is outside BATCH_INPUT_ROOT"
+            continue
+        try:
+            item.image_id = store.import_file(path).image_id
+        except (UploadError, OSError) as exc:
+            item.error = str(exc)
+
+
+def summarize(item: BatchItem, run_id: str, status: str, events: list[Event], error: str = "") -> dict[str, Any]:
+    """One results row from a run's events: best shader and score, per-iteration scores and critiques."""
+    row: dict[str, Any] = {
+        "index": item.index,
+        "source": item.source,
+        "image_id": item.image_id,
+        "run_id": run_id,
+        "status": status,
+        "error": error or item.error,
+        "best_score": None,
+        "metric": "",
+        "best_shader": "",
+        "best_render": "",
+        "iterations": 0,
+        "stop_reason": None,
+        "lpips_scores": [],
+        "similarities": [],
+        "critiques": [],
+        "tokens": None,
+        "elapsed_s": None,
+        "finished": round(time.time(), 3),
+    }
+    for _, event, data in events:
+        if event == "iteration":
+            row["lpips_scores"].append(data.get("lpips_score"))
+            row["similarities"].append(data.get("similarity"))
+            row["critiques"].append(data.get("critique", ""))
+        elif event == "best":
+            row.update(
+                best_score=data.get("score"),
+                metric=data.get("metric", ""),
+                best_shader=data.get("shader_code", ""),
+                best_render=data.get("render_path", ""),
+            )
+        elif event == "done":
+            row.update(stop_reason=data.get("stop_reason"), tokens=data.get("tokens"), elapsed_s=data.get("elapsed_s"))
+        elif event == "error" and not row["error"]:
+            row["error"] = data.get("error", "")
+    row["iterations"] = len(row["lpips_scores"])
+    return row
+
+
+class Batch:
+    """Many target images run offline through the normal pipeline, one detached run per image.
+
+    A batch lives in `BATCH_DIR/<batch_id>/`: `batch.json` holds the items
+    and run settings, and `results.jsonl` gets one row as each image
+    finishes. The results file is the checkpoint. Resuming runs only the
+    images without a `done` row, and an image whose run was cut short picks
+    that run up at its last completed iteration, since run ids are derived
+    from the batch id and the item index. `results.parquet` is written
+    alongside when pyarrow is installed.
+    """
+
+    def __init__(
+        self,
+        batch_id: str,
+        directory: Path,
+        items: list[BatchItem],
+        run: dict[str, Any],
+        concurrency: int,
+        created: float,
+        status: str = "pending",
+    ) -> None:
+        self.batch_id = batch_id
+        self.directory = directory
+        self.items = items
+        self.run = run
+        self.concurrency = max(concurrency, 1)
+        self.created = created
+        self.status = status
+        self._lock = threading.Lock()
+
+    @property
+    def manifest_path(self) -> Path:
+        return self.directory / "batch.json"
+
+    @property
+    def results_path(self) -> Path:
+        return self.directory / "results.jsonl"
+
+    @property
+    def parquet_path(self) -> Path:
+        return self.directory / "results.parquet"
+
+    @classmethod
+    def create(
+        cls, items: list[BatchItem], run: dict[str, Any], concurrency: int | None = None, root: Path = BATCH_DIR
+    ) -> Batch:
+        batch_id = uuid.uuid4().hex[:12]
+        batch = cls(batch_id, root / batch_id, items, run, concurrency or BATCH_CONCURRENCY, time.time())
+        batch.directory.mkdir(parents=True, exist_ok=True)
+        batch._save()
+        # Images that could not be imported are reported up front; there is nothing to run for them.
+        for item in items:
+            if item.error:
+                batch._append(summarize(item, batch.run_id(item), "failed", []))
+        with _stats_lock:
+            _stats["batches"] += 1
+        return batch
+
+    @classmethod
+    def load(cls, batch_id: str, root: Path = BATCH_DIR) -> Batch | None:
+        if not _BATCH_ID.fullmatch(batch_id or ""):
+            return None
+        path = root / batch_id / "batch.json"
+        if not path.exists():
+            return None
+        data = json.loads(path.read_text())
+        return cls(
+            batch_id,
+            path.parent,
+            [BatchItem(**item) for item in data["items"]],
+            data["run"],
+            data["concurrency"],
+            data["created"],
+            data["status"],
+        )
+
+    def _save(self) -> None:
+        data = {
+            "batch_id": self.batch_id,
+            "status": self.status,
+            "created": self.created,
+            "concurrency": self.concurrency,
+            "run": self.run,
+            "items": [asdict(item) for item in self.items],
+        }
+        tmp = self.manifest_path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(data, indent=1))
+        os.replace(tmp, self.manifest_path)
+
+    def _set_status(self, status: str) -> None:
+        self.status = status
+        self._save()
+
+    def run_id(self, item: BatchItem) -> str:
+        return f"{self.batch_id}-{item.index:04d}"
+
+    def _append(self, row: dict[str, Any]) -> None:
+        with self._lock, self.results_path.open("a") as out:
+            out.write(json.dumps(row) + "\n")
+            out.flush()
+            os.fsync(out.fileno())
+
+    def results(self) -> dict[int, dict[str, Any]]:
+        """Latest row per item; a failed item retried on resume gets a later row."""
+        rows: dict[int, dict[str, Any]] = {}
+        if not self.results_path.exists():
+            return rows
+        with self._lock:
+            lines = self.results_path.read_text().splitlines()
+        for line in lines:
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # a row cut off by a crash; its item simply runs again
+            rows[row["index"]] = row
+        return rows
+
+    def remaining(self) -> list[BatchItem]:
+        """Items still to run: everything imported that has no `done` row yet."""
+        rows = self.results()
+        return [item for item in self.items if not item.error and rows.get(item.index, {}).get("status") != "done"]
+
+    def progress(self, live: bool = False) -> dict[str, Any]:
+        rows = self.results()
+        done = sum(1 for row in rows.values() if row["status"] == "done")
+        failed = sum(1 for row in rows.values() if row["status"] != "done")
+        scores = [row["best_score"] for row in rows.values() if row["status"] == "done" and row["best_score"] is not None]
+        status = self.status
+        if status == "running" and not live:
+            status = "interrupted"  # the process running it went away
+        return {
+            "batch_id": self.batch_id,
+            "status": status,
+            "live": live,
+            "created": self.created,
+            "items": len(self.items),
+            "done": done,
+            "failed": failed,
+            "pending": len(self.items) - done - failed,
+            "mean_best_score": round(sum(scores) / len(scores), 4) if scores else None,
+            "parquet": self.parquet_path.exists(),
+        }
+
+    async def execute(self, execute: Execute) -> None:
+        """Run every image without a `done` row, `concurrency` at a time, appending a row as each finishes."""
+        pending = self.remaining()
+        queue: asyncio.Queue[BatchItem] = asyncio.Queue()
+        for item in pending:
+            queue.put_nowait(item)
+        total = len(self.items)
+        print(f"[batch] {self.batch_id}: {len(pending)} of {total} image(s) to run, {self.concurrency} at a time")
+
+        async def worker() -> None:
+            while not queue.empty():
+                item = queue.get_nowait()
+                run_id = self.run_id(item)
+                settings = {**self.run, **item.settings, "image_id": item.image_id}
+                try:
+                    status, events = await execute(run_id, settings)
+                    row = summarize(item, run_id, status, events)
+                except Exception as exc:
+                    row = summarize(item, run_id, "failed", [], f"{type(exc).__name__}: {exc}")
+                await asyncio.to_thread(self._append, row)
+                with _stats_lock:
+                    _stats["items_done" if row["status"] == "done" else "items_failed"] += 1
+                print(f"[batch] {self.batch_id}: #{item.index} {row['status']} best={row['best_score']} ({item.source})")
+
+        await asyncio.to_thread(self._set_status, "running")
+        try:
+            await asyncio.gather(*(worker() for _ in range(min(self.concurrency, len(pending)))))
+        except asyncio.CancelledError:
+            await asyncio.to_thread(self._set_status, "interrupted")
+            raise
+        await asyncio.to_thread(self.write_parquet)
+        await asyncio.to_thread(self._set_status, "done")
+
+    def write_parquet(self) -> Path | None:
+        """results.jsonl as Parquet (latest row per image), when pyarrow is installed."""
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            return None
+        rows = [row for _, row in sorted(self.results().items())]
+        if not rows:
+            return None
+        pq.write_table(pa.Table.from_pylist(rows), self.parquet_path)
+        return self.parquet_path
+
+
+_live: dict[str, asyncio.Task] = {}
+_live_lock = threading.Lock()
+
+
+def start_batch(batch: Batch, execute: Execute) -> asyncio.Task:
+    """Run `batch` as a background task on the current loop (the API's way of running one)."""
+    task = asyncio.ensure_future(batch.execute(execute))
+    with _live_lock:
+        _live[batch.batch_id] = task
+
+    def _forget(done: asyncio.Task) -> None:
+        with _live_lock:
+            if _live.get(batch.batch_id) is done:
+                del _live[batch.batch_id]
+        if not done.cancelled() and done.exception() is not None:
+            print(f"[batch] {batch.batch_id} failed: {done.exception()!r}")
+
+    task.add_done_callback(_forget)
+    return task
+
+
+def is_live(batch_id: str) -> bool:
+    with _live_lock:
+        return batch_id in _live
+
+
+def batch_stats() -> dict[str, int]:
+    with _live_lock:
+        live = len(_live)
+    with _stats_lock:
+        return {"live": live, **_stats}
+
+
+def _parse_args(argv: list[str] | None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="python -m backend.batch",
+        description="Run the shader pipeline over many images offline, writing results to JSONL (and Parquet).",
+    )
+    parser.add_argument("source", nargs="?", help="directory of images, JSONL manifest, or text file of paths")
+    parser.add_argument("--resume", metavar="BATCH_ID", help="continue an interrupted batch instead of starting one")
+    parser.add_argument("--iterations", type=int, help="iterations per image")
+    parser.add_argument("--num-frames", type=int, help="frames rendered per iteration")
+    parser.add_argument("--run", default="{}", help='other RunRequest fields as JSON, e.g. \'{"patience": 2}\'')
+    parser.add_argument("--concurrency", type=int, help=f"images in flight (default BATCH_CONCURRENCY={BATCH_CONCURRENCY})")
+    args = parser.parse_args(argv)
+    if bool(args.source) == bool(args.resume):
+        parser.error("give either a source or --resume BATCH_ID")
+    return args
+
+
+async def _amain(args: argparse.Namespace) -> int:
+    # The pipeline lives in the app module; importing it here keeps `backend.app -> backend.batch` acyclic.
+    from backend.app import RunRequest, run_to_completion
+    from backend.llm_client import aclose_openai_clients
+
+    if args.resume:
+        batch = Batch.load(args.resume)
+        if batch is None:
+            print(f"[batch] unknown batch {args.resume}", file=sys.stderr)
+            return 2
+        if args.concurrency:
+            batch.concurrency = args.concurrency
+    else:
+        run = json.loads(args.run)
+        for name, value in (("iterations", args.iterations), ("num_frames", args.num_frames)):
+            if value is not None:
+                run[name] = value
+        try:
+            items = load_items(Path(args.source))
+            for item in items:
+                RunRequest(**{**run, **item.settings})
+        except (BatchError, ValueError) as exc:
+            print(f"[batch] {exc}", file=sys.stderr)
+            return 2
+        await asyncio.to_thread(ingest, items)
+        batch = Batch.create(items, run, args.concurrency)
+        print(f"[batch] created {batch.batch_id} in {batch.directory}")
+
+    try:
+        await batch.execute(run_to_completion)
+    except asyncio.CancelledError:
+        print(f"[batch] interrupted; continue with: python -m backend.batch --resume {batch.batch_id}", file=sys.stderr)
+        raise
+    finally:
+        await aclose_openai_clients()
+    print(json.dumps(batch.progress(), indent=1))
+    print(f"[batch] results in {batch.directory}")
+    return 0
+
+
+def main(argv: list[str] | None = None) -> int:
+    from backend.llm_client import close_openai_clients
+    from backend.metrics import configure_torch_threads
+    from backend.persist import get_frame_writer
+    from backend.render_pool import shutdown_render_pool
+
+    args = _parse_args(argv)
+    configure_torch_threads()
+    try:
+        return asyncio.run(_amain(args))
+    except KeyboardInterrupt:
+        return 130
+    finally:
+        shutdown_render_pool()
+        get_frame_writer().close()
+        close_openai_clients()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
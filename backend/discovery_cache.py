@@ -0,0 +1,100 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any
+
+from PIL import Image
+
+from backend.targets import image_key
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+DISCOVERY_CACHE_PATH = Path(os.getenv("DISCOVERY_CACHE_PATH", str(BASE_DIR / "data" / "discovery_cache.sqlite3")))
+DISCOVERY_CACHE_TTL_S = float(os.getenv("DISCOVERY_CACHE_TTL_S", str(7 * 24 * 3600)))
+DISCOVERY_CACHE_MAX_ENTRIES = int(os.getenv("DISCOVERY_CACHE_MAX_ENTRIES", "256"))  # 0 disables the cache
+
+
+def discovery_key(*, reference_text: str, target_img: Image.Image | None, model: str) -> str:
+    h = hashlib.sha256()
+    h.update(f"{model}\0".encode("utf-8"))
+    h.update(reference_text.encode("utf-8"))
+    h.update(b"\0")
+    h.update((image_key(target_img) if target_img is not None else "-").encode("ascii"))
+    return h.hexdigest()
+
+
+class DiscoveryCache:
+    """SQLite store of Phase A results so repeat runs skip the discovery call.
+
+    Entries expire after `ttl` seconds; past `max_entries` the least recently
+    used rows are evicted.
+    """
+
+    def __init__(self, path: Path = DISCOVERY_CACHE_PATH, ttl: float = DISCOVERY_CACHE_TTL_S, max_entries: int = DISCOVERY_CACHE_MAX_ENTRIES) -> None:
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+        self._lock = threading.Lock()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS discovery ("
+            " key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+
+    def get(self, key: str) -> dict[str, Any] | None:
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT value, created FROM discovery WHERE key = ?", (key,)).fetchone()
+            if row is not None and now - row[1] > self.ttl:
+                self._db.execute("DELETE FROM discovery WHERE key = ?", (key,))
+                self.stats["evictions"] += 1
+                row = None
+            if row is None:
+                self.stats["misses"] += 1
+                return None
+            self._db.execute("UPDATE discovery SET last_used = ? WHERE key = ?", (now, key))
+            self.stats["hits"] += 1
+        return json.loads(row[0])
+
+    def put(self, key: str, value: dict[str, Any]) -> None:
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO discovery (key, value, created, last_used) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now, now),
+            )
+            expired = self._db.execute("DELETE FROM discovery WHERE created < ?", (now - self.ttl,)).rowcount
+            overflow = self._db.execute(
+                "DELETE FROM discovery WHERE key IN ("
+                " SELECT key FROM discovery ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (max(self.max_entries, 1),),
+            ).rowcount
+            self.stats["evictions"] += expired + overflow
+
+    def snapshot(self) -> dict[str, Any]:
+        with self._lock:
+            size = self._db.execute("SELECT COUNT(*) FROM discovery").fetchone()[0]
+            return {**self.stats, "size": size}
+
+
+_cache: DiscoveryCache | None = None
+_cache_lock = threading.Lock()
+
+
+def get_discovery_cache() -> DiscoveryCache | None:
+    """Return the shared cache, or None when DISCOVERY_CACHE_MAX_ENTRIES=0."""
+    global _cache
+    if DISCOVERY_CACHE_MAX_ENTRIES <= 0:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = DiscoveryCache()
+        return _cache
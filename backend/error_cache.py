@@ -0,0 +1,193 @@
+from __future__ import annotations
+
+import difflib
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any
+
+from backend.render import CompileResult, normalize_error
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+ERROR_CACHE_PATH = Path(os.getenv("ERROR_CACHE_PATH", str(BASE_DIR / "data" / "error_cache.sqlite3")))
+ERROR_CACHE_DISABLED = os.getenv("ERROR_CACHE_DISABLED") in {"1", "true", "TRUE"}
+ERROR_CACHE_MAX_HUNKS = 4
+ERROR_CACHE_MAX_HUNK_LINES = 8
+
+_COUNTERS = ("lookups", "mechanical_hits", "few_shot_hits", "misses", "llm_calls", "stored")
+
+
+def diff_hunks(broken: str, fixed: str) -> list[dict[str, Any]]:
+    """Line hunks that turn `broken` into `fixed`, matched on stripped lines.
+
+    Each hunk carries the preceding line as an anchor so pure insertions
+    (e.g. a missing uniform declaration) can be replayed too.
+    """
+    a = [line.strip() for line in broken.splitlines()]
+    b = fixed.splitlines()
+    matcher = difflib.SequenceMatcher(a=a, b=[line.strip() for line in b], autojunk=False)
+    hunks = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            continue
+        hunks.append({"anchor": a[i1 - 1] if i1 > 0 else "", "broken": a[i1:i2], "fixed": b[j1:j2]})
+    return hunks
+
+
+def apply_hunks(shader: str, hunks: list[dict[str, Any]]) -> str | None:
+    """Replay stored hunks on `shader`; None when any hunk does not match."""
+    lines = shader.splitlines()
+    for hunk in hunks:
+        broken, anchor = hunk["broken"], hunk["anchor"]
+        stripped = [line.strip() for line in lines]
+        n = len(broken)
+        for idx in range(len(lines) - n + 1):
+            if stripped[idx : idx + n] != broken:
+                continue
+            if anchor and (idx == 0 or stripped[idx - 1] != anchor):
+                continue
+            if not n and not anchor and idx != 0:
+                continue
+            lines[idx : idx + n] = hunk["fixed"]
+            break
+        else:
+            return None
+    patched = "\n".join(lines) + ("\n" if shader.endswith("\n") else "")
+    return patched if patched != shader else None
+
+
+class ErrorCache:
+    """Cross-run store of compile-error fixes that already worked (notes/agent_memory_plan.md).
+
+    Fixes are filed under the normalized error category. Small fixes are
+    replayed mechanically before any LLM call; the rest are injected into
+    fix_compile_errors as few-shot examples. Counters persist with the
+    store so hit/miss rates span runs.
+    """
+
+    def __init__(self, path: Path = ERROR_CACHE_PATH) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS fixes ("
+            " id INTEGER PRIMARY KEY, category TEXT NOT NULL, error_msg TEXT NOT NULL,"
+            " hunks TEXT NOT NULL, broken_snippet TEXT NOT NULL, fixed_snippet TEXT NOT NULL,"
+            " mechanical INTEGER NOT NULL, successes INTEGER NOT NULL DEFAULT 0, created REAL NOT NULL,"
+            " UNIQUE (category, hunks))"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS fixes_category ON fixes (category)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+
+    @staticmethod
+    def normalize_error(error_msg: str) -> str:
+        return normalize_error(error_msg)
+
+    def count(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO counters (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + ?",
+                (name, n, n),
+            )
+
+    def lookup(self, check: CompileResult, limit: int = 8) -> list[dict[str, Any]]:
+        categories = check.categories or ["glsl:other"]
+        marks = ",".join("?" for _ in categories)
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT id, category, error_msg, hunks, broken_snippet, fixed_snippet, mechanical FROM fixes"
+                f" WHERE category IN ({marks}) ORDER BY successes DESC, created DESC LIMIT ?",
+                (*categories, limit),
+            ).fetchall()
+        keys = ("id", "category", "error_msg", "hunks", "broken_snippet", "fixed_snippet", "mechanical")
+        return [{**dict(zip(keys, row)), "hunks": json.loads(row[3])} for row in rows]
+
+    def mechanical_fixes(self, shader: str, fixes: list[dict[str, Any]]) -> list[tuple[int, str]]:
+        """Patched shaders for every stored mechanical fix whose hunks match `shader`."""
+        out = []
+        for fix in fixes:
+            if not fix["mechanical"]:
+                continue
+            patched = apply_hunks(shader, fix["hunks"])
+            if patched is not None and all(patched != p for _, p in out):
+                out.append((fix["id"], patched))
+        return out
+
+    def get_few_shot_examples(self, fixes: list[dict[str, Any]], limit: int = 3) -> str:
+        if not fixes:
+            return ""
+        blocks = []
+        for n, fix in enumerate(fixes[:limit], start=1):
+            blocks.append(
+                f"Example {n} ({fix['category']}): \"{fix['error_msg']}\"\n"
+                f"  broken:\n{fix['broken_snippet']}\n"
+                f"  fixed:\n{fix['fixed_snippet']}"
+            )
+        return "PAST FIXES FOR SIMILAR ERRORS:\n" + "\n".join(blocks) + "\n"
+
+    def record_success(self, fix_id: int) -> None:
+        with self._lock:
+            self._db.execute("UPDATE fixes SET successes = successes + 1 WHERE id = ?", (fix_id,))
+
+    def store(self, check: CompileResult, broken_shader: str, fixed_shader: str) -> None:
+        """File a fix that compiled under the category of each error it resolved."""
+        hunks = diff_hunks(broken_shader, fixed_shader)
+        if not hunks:
+            return
+        mechanical = len(hunks) <= ERROR_CACHE_MAX_HUNKS and all(
+            max(len(h["broken"]), len(h["fixed"])) <= ERROR_CACHE_MAX_HUNK_LINES for h in hunks
+        )
+        shown = hunks[:ERROR_CACHE_MAX_HUNKS]
+        broken_snippet = "\n".join("    " + line for h in shown for line in h["broken"][:ERROR_CACHE_MAX_HUNK_LINES])
+        fixed_snippet = "\n".join("    " + line.strip() for h in shown for line in h["fixed"][:ERROR_CACHE_MAX_HUNK_LINES])
+        errors = check.errors or []
+        first_msg = {e.category: e.message for e in reversed(errors)}
+        now = time.time()
+        stored = 0
+        with self._lock:
+            for category in check.categories or ["glsl:other"]:
+                cur = self._db.execute(
+                    "INSERT OR IGNORE INTO fixes"
+                    " (category, error_msg, hunks, broken_snippet, fixed_snippet, mechanical, created)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (category, first_msg.get(category, check.log[:200]), json.dumps(hunks), broken_snippet, fixed_snippet, int(mechanical), now),
+                )
+                stored += cur.rowcount
+        if stored:
+            self.count("stored", stored)
+
+    def snapshot(self) -> dict[str, Any]:
+        with self._lock:
+            counters = dict(self._db.execute("SELECT name, value FROM counters").fetchall())
+            size = self._db.execute("SELECT COUNT(*) FROM fixes").fetchone()[0]
+        stats = {name: counters.get(name, 0) for name in _COUNTERS}
+        lookups = stats["lookups"]
+        stats["hit_rate"] = round((stats["mechanical_hits"] + stats["few_shot_hits"]) / lookups, 4) if lookups else None
+        stats["llm_calls_saved"] = stats["mechanical_hits"]
+        stats["size"] = size
+        return stats
+
+
+_cache: ErrorCache | None = None
+_cache_failed = False
+_cache_lock = threading.Lock()
+
+
+def get_error_cache() -> ErrorCache | None:
+    """Return the shared cache, or None when disabled or the store cannot be opened."""
+    global _cache, _cache_failed
+    if ERROR_CACHE_DISABLED:
+        return None
+    with _cache_lock:
+        if _cache is None and not _cache_failed:
+            try:
+                _cache = ErrorCache()
+            except Exception as exc:
+                _cache_failed = True
+                print(f"[error_cache] disabled: {exc}")
+        return _cache
@@ -0,0 +1,259 @@
+from __future__ import annotations
+
+import os
+import re
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Optional
+
+from backend.render import CompileError, CompileResult
+from backend.render_pool import avalidate_shader
+
+GLSL_REPAIR_MAX_PASSES = int(os.getenv("GLSL_REPAIR_MAX_PASSES", "3"))  # 0 disables rule-based repair
+
+# Declarations the interface contract guarantees; added back when a shader uses one without declaring it.
+_INTERFACE_DECLS = {
+    "u_input": "uniform sampler2D u_input;",
+    "u_resolution": "uniform vec2 u_resolution;",
+    "u_time": "uniform float u_time;",
+    "v_uv": "in vec2 v_uv;",
+    "f_color": "out vec4 f_color;",
+}
+_SHADERTOY_ALIASES = {
+    "iTime": "u_time",
+    "iResolution": "vec3(u_resolution, 1.0)",
+    "iChannel0": "u_input",
+}
+
+_VERSION_LINE = re.compile(r"^\s*#\s*version\b.*$", re.M)
+_PRECISION_LINE = re.compile(r"^\s*precision\s+\w+\s+\w+\s*;\s*$", re.M)
+_INT_LITERAL = re.compile(r"(?<![\w.])(\d+)(?![\w.])")
+_INT_DECL = re.compile(r"\b(?:int|uint|[iu]vec[234])\s+\w+\s*(?:=|;|\[)")
+_IDENT = re.compile(r"[`'\"](\w+)['`\"]")
+
+Rule = Callable[[str, list[CompileError]], Optional[str]]
+
+
+@dataclass
+class RepairResult:
+    source: str
+    check: CompileResult
+    applied: list[str] = field(default_factory=list)
+    passes: int = 0
+    elapsed_ms: float = 0.0
+
+
+def _declared(source: str, name: str) -> bool:
+    return re.search(rf"\b(?:uniform|in|out|varying)\s+(?:\w+\s+)*?\w+\s+{name}\s*(?:;|\[)", source) is not None
+
+
+def _used(source: str, name: str) -> bool:
+    return re.search(rf"\b{name}\b", source) is not None
+
+
+def _insert_after_header(source: str, decls: list[str]) -> str:
+    """Insert declarations after #version and any precision statements."""
+    lines = source.splitlines()
+    at = 0
+    for idx, line in enumerate(lines):
+        stripped = line.strip()
+        if _VERSION_LINE.match(line) or _PRECISION_LINE.match(line):
+            at = idx + 1
+        elif stripped and not stripped.startswith("//"):
+            break
+    lines[at:at] = decls
+    return "\n".join(lines) + ("\n" if source.endswith("\n") else "")
+
+
+def _edit_lines(source: str, errors: list[CompileError], pattern: re.Pattern, edit: Callable[[str], str]) -> str | None:
+    """Apply `edit` to every line whose compiler message matches `pattern`."""
+    lines = source.splitlines()
+    targets = {e.line for e in errors if e.line is not None and pattern.search(e.message)}
+    changed = False
+    for line_no in targets:
+        if 1 <= line_no <= len(lines):
+            new = edit(lines[line_no - 1])
+            if new != lines[line_no - 1]:
+                lines[line_no - 1] = new
+                changed = True
+    if not changed:
+        return None
+    return "\n".join(lines) + ("\n" if source.endswith("\n") else "")
+
+
+def _floatify(line: str) -> str:
+    """Turn integer literals into float literals, leaving array indices and int declarations alone."""
+    if _INT_DECL.search(line):
+        return line
+    out, depth = [], 0
+    for chunk in re.split(r"([\[\]])", line):
+        if chunk == "[":
+            depth += 1
+        elif chunk == "]":
+            depth = max(depth - 1, 0)
+        elif depth == 0:
+            chunk = _INT_LITERAL.sub(r"\1.0", chunk)
+        out.append(chunk)
+    return "".join(out)
+
+
+def _fix_version(source: str, errors: list[CompileError]) -> str | None:
+    """Exactly one `#version 330`, on the first line (drops `es`, 1.x and duplicates)."""
+    versions = _VERSION_LINE.findall(source)
+    first = source.lstrip().splitlines()[0].strip() if source.strip() else ""
+    if len(versions) == 1 and re.fullmatch(r"#\s*version\s+330(\s+core)?", first):
+        return None
+    body = _VERSION_LINE.sub("", source).lstrip("\n")
+    return "#version 330\n" + body
+
+
+def _fix_frag_color(source: str, errors: list[CompileError]) -> str | None:
+    if not _used(source, "gl_FragColor"):
+        return None
+    return re.sub(r"\bgl_FragColor\b", "f_color", source)
+
+
+def _fix_texture2d(source: str, errors: list[CompileError]) -> str | None:
+    if not re.search(r"\btexture2D\s*\(", source):
+        return None
+    return re.sub(r"\btexture2D(\s*\()", r"texture\1", source)
+
+
+def _fix_shadertoy_aliases(source: str, errors: list[CompileError]) -> str | None:
+    undeclared = {m.group(1) for e in errors if e.category == "glsl:undeclared_identifier" for m in _IDENT.finditer(e.message)}
+    names = [n for n in _SHADERTOY_ALIASES if n in undeclared or (_used(source, n) and not _declared(source, n))]
+    if not names:
+        return None
+    for name in names:
+        source = re.sub(rf"\b{name}\b", _SHADERTOY_ALIASES[name], source)
+    return source
+
+
+def _fix_interface_decls(source: str, errors: list[CompileError]) -> str | None:
+    missing = [decl for name, decl in _INTERFACE_DECLS.items() if _used(source, name) and not _declared(source, name)]
+    if not missing:
+        return None
+    return _insert_after_header(source, missing)
+
+
+def _fix_frag_color_vec3(source: str, errors: list[CompileError]) -> str | None:
+    pattern = re.compile(r"\bvec3\b.*\bvec4\b|\bvec4\b\s*=\s*\bvec3\b", re.I)
+
+    def edit(line: str) -> str:
+        return re.sub(r"\bf_color\s*=\s*(.+?);", r"f_color = vec4(\1, 1.0);", line, count=1)
+
+    return _edit_lines(source, errors, pattern, edit)
+
+
+def _fix_int_to_float(source: str, errors: list[CompileError]) -> str | None:
+    """An int literal where a float is required (strict drivers and `return 1;` in a float function)."""
+    pattern = re.compile(
+        r"^(?=.*\bint\b)(?=.*\b(?:float|vec[234])\b)"  # mentions both an int and a float type ...
+        r"(?=.*\b(?:operand|convert|assigned|initiali[sz]er|return|call)\b)"  # ... in a conversion/operator error
+        r"(?!.*type float\b.*\btype int\b)(?!.*from '?(?:\w+ )?float'? to '?(?:\w+ )?int\b)",  # but not float -> int
+        re.I,
+    )
+    return _edit_lines(source, errors, pattern, _floatify)
+
+
+def _fix_float_to_int(source: str, errors: list[CompileError]) -> str | None:
+    pattern = re.compile(r"type float\b.*\btype int\b", re.I)
+
+    def edit(line: str) -> str:
+        return re.sub(r"(\bint\s+\w+\s*=\s*|(?:^|(?<=[;{]))\s*\w+\s*=\s*)(.+?);", r"\1int(\2);", line, count=1)
+
+    return _edit_lines(source, errors, pattern, edit)
+
+
+def _fix_float_modulo(source: str, errors: list[CompileError]) -> str | None:
+    pattern = re.compile(r"operator %|'%'", re.I)
+    operand = r"([\w.]+(?:\([^()]*\))?)"
+
+    def edit(line: str) -> str:
+        return re.sub(rf"{operand}\s*%\s*{operand}", r"mod(\1, \2)", line)
+
+    return _edit_lines(source, errors, pattern, edit)
+
+
+RULES: list[tuple[str, Rule]] = [
+    ("version", _fix_version),
+    ("gl_FragColor", _fix_frag_color),
+    ("texture2D", _fix_texture2d),
+    ("shadertoy_aliases", _fix_shadertoy_aliases),
+    ("interface_decls", _fix_interface_decls),
+    ("f_color_vec3", _fix_frag_color_vec3),
+    ("int_to_float", _fix_int_to_float),
+    ("float_to_int", _fix_float_to_int),
+    ("float_modulo", _fix_float_modulo),
+]
+
+_stats = {"attempts": 0, "fixed": 0, "passes": 0}
+_stats_lock = threading.Lock()
+
+
+def apply_rules(source: str, errors: list[CompileError]) -> tuple[str, list[str]]:
+    """One pass of every rule over `source`; returns the rewritten source and the rules that fired.
+
+    Line-targeted rules run against the original error lines, so whole-source
+    rules that shift lines (header fixes) are left to the next pass.
+    """
+    applied = []
+    shifted = False
+    for name, rule in RULES:
+        if shifted and rule in (_fix_frag_color_vec3, _fix_int_to_float, _fix_float_to_int, _fix_float_modulo):
+            continue
+        before_lines = source.count("\n")
+        new = rule(source, errors)
+        if new is not None and new != source:
+            shifted = shifted or new.count("\n") != before_lines
+            source = new
+            applied.append(name)
+    return source, applied
+
+
+def _error_count(check: CompileResult) -> int:
+    return len(check.errors) or (0 if check.ok else 1)
+
+
+def _finish(result: RepairResult, start: float) -> RepairResult:
+    result.elapsed_ms = (time.perf_counter() - start) * 1000
+    with _stats_lock:
+        _stats["attempts"] += 1
+        _stats["passes"] += result.passes
+        _stats["fixed"] += int(result.check.ok)
+    return result
+
+
+async def arepair_shader(
+    source: str,
+    check: CompileResult,
+    validate: Callable[[str], Awaitable[CompileResult]] = avalidate_shader,
+    max_passes: int = GLSL_REPAIR_MAX_PASSES,
+) -> RepairResult:
+    """Rewrite mechanical GLSL mistakes and revalidate on the render pool, for at most `max_passes` rounds.
+
+    Keeps the variant with the fewest errors, so a rule that makes things
+    worse never reaches the LLM repair step.
+    """
+    start = time.perf_counter()
+    best = RepairResult(source=source, check=check)
+    current, current_check = source, check
+    trail: list[str] = []
+    for _ in range(max_passes):
+        candidate, applied = apply_rules(current, current_check.errors)
+        if not applied:
+            break
+        best.passes += 1
+        trail.extend(applied)
+        current, current_check = candidate, await validate(candidate)
+        if current_check.ok or _error_count(current_check) <= _error_count(best.check):
+            best.source, best.check, best.applied = current, current_check, list(trail)
+        if current_check.ok:
+            break
+    return _finish(best, start)
+
+
+def repair_stats() -> dict[str, int]:
+    with _stats_lock:
+        return dict(_stats)
@@ -0,0 +1,222 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import threading
+import time
+import weakref
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Callable
+
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, DefaultHttpxClient, OpenAI
+
+from backend.prompts import get_prompt_registry
+from backend.scheduler import get_rate_limiter, has_image, stage, stage_sync
+
+OPENAI_TIMEOUT_S = float(os.getenv("OPENAI_TIMEOUT_S", "120"))
+OPENAI_CONNECT_TIMEOUT_S = float(os.getenv("OPENAI_CONNECT_TIMEOUT_S", "5"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "3"))
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "32"))
+OPENAI_MAX_KEEPALIVE = int(os.getenv("OPENAI_MAX_KEEPALIVE", "16"))
+OPENAI_KEEPALIVE_EXPIRY_S = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY_S", "60"))
+
+
+def _timeout() -> httpx.Timeout:
+    return httpx.Timeout(OPENAI_TIMEOUT_S, connect=OPENAI_CONNECT_TIMEOUT_S)
+
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=OPENAI_MAX_CONNECTIONS,
+        max_keepalive_connections=OPENAI_MAX_KEEPALIVE,
+        keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY_S,
+    )
+
+
+_clients: dict[tuple[str, str | None], OpenAI] = {}
+_clients_lock = threading.Lock()
+
+
+def get_openai_client(api_key: str | None = None) -> OpenAI:
+    """Process-wide OpenAI client so every call reuses pooled keep-alive connections.
+
+    One client is kept per (api key, base URL), so rotating OPENAI_API_KEY or
+    pointing OPENAI_BASE_URL at a mock server gets a fresh pool. Retries use
+    the SDK's exponential backoff with jitter (honouring Retry-After) up to
+    OPENAI_MAX_RETRIES attempts.
+    """
+    api_key = api_key or os.getenv("OPENAI_API_KEY")
+    base_url = os.getenv("OPENAI_BASE_URL") or None
+    key = (api_key or "", base_url)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = OpenAI(
+                api_key=api_key,
+                base_url=base_url,
+                timeout=_timeout(),
+                max_retries=OPENAI_MAX_RETRIES,
+                http_client=DefaultHttpxClient(limits=_limits(), timeout=_timeout()),
+            )
+            _clients[key] = client
+        return client
+
+
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict]" = weakref.WeakKeyDictionary()
+
+
+def get_async_openai_client(api_key: str | None = None) -> AsyncOpenAI:
+    """Async counterpart of get_openai_client, pooled per running event loop.
+
+    httpx async connections belong to the loop that opened them, so each loop
+    gets its own client with the same pool, timeout and retry settings.
+    """
+    api_key = api_key or os.getenv("OPENAI_API_KEY")
+    base_url = os.getenv("OPENAI_BASE_URL") or None
+    key = (api_key or "", base_url)
+    loop = asyncio.get_running_loop()
+    with _clients_lock:
+        clients = _async_clients.setdefault(loop, {})
+        client = clients.get(key)
+        if client is None:
+            client = AsyncOpenAI(
+                api_key=api_key,
+                base_url=base_url,
+                timeout=_timeout(),
+                max_retries=OPENAI_MAX_RETRIES,
+                http_client=DefaultAsyncHttpxClient(limits=_limits(), timeout=_timeout()),
+            )
+            clients[key] = client
+        return client
+
+
+def close_openai_clients() -> None:
+    with _clients_lock:
+        clients = list(_clients.values())
+        _clients.clear()
+    for client in clients:
+        client.close()
+
+
+async def aclose_openai_clients() -> None:
+    loop = asyncio.get_running_loop()
+    with _clients_lock:
+        clients = list(_async_clients.pop(loop, {}).values())
+    for client in clients:
+        await client.close()
+
+
+class UsageMeter:
+    """Tokens spent by the ChatCalls made under one `start_usage_meter` (in practice, one run)."""
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.tokens = 0
+        self._lock = threading.Lock()
+
+    def add(self, tokens: int) -> None:
+        with self._lock:
+            self.calls += 1
+            self.tokens += tokens
+
+
+_usage_meter: ContextVar[UsageMeter | None] = ContextVar("usage_meter", default=None)
+
+
+def start_usage_meter() -> UsageMeter:
+    """Meter every ChatCall made from the current context on, including the tasks and threads it starts.
+
+    Meant for a task that runs a single job (the run's driver task), since
+    the meter stays set for the rest of that task.
+    """
+    meter = UsageMeter()
+    _usage_meter.set(meter)
+    return meter
+
+
+@dataclass
+class ChatCall:
+    """One chat completion, described once and run by either `complete` or `acomplete`.
+
+    With `json_mode` the reply is decoded to a dict ({} when it is not valid
+    JSON) before `parse` turns it into the caller's result. Token usage is
+    recorded on the prompt registry under `kind` and kept on `usage` (tokens
+    plus wall time) for callers that report per-call cost.
+    """
+
+    model: str
+    messages: list[dict]
+    temperature: float = 0.4
+    json_mode: bool = True
+    parse: Callable[[Any], Any] = field(default=lambda data: data)
+    kind: str = ""
+    usage: dict[str, Any] = field(default_factory=dict, init=False)
+
+    def _kwargs(self) -> dict[str, Any]:
+        kwargs: dict[str, Any] = {"model": self.model, "messages": self.messages, "temperature": self.temperature}
+        if self.json_mode:
+            kwargs["response_format"] = {"type": "json_object"}
+        return kwargs
+
+    def _result(self, response, start: float) -> Any:
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        self.usage = get_prompt_registry().record_usage(self.kind, getattr(response, "usage", None), elapsed_ms)
+        meter = _usage_meter.get()
+        if meter is not None:
+            meter.add(self._used_tokens())
+        raw = response.choices[0].message.content
+        if not self.json_mode:
+            return self.parse(raw or "")
+        try:
+            data = json.loads(raw or "{}")
+        except json.JSONDecodeError:
+            data = {}
+        return self.parse(data if isinstance(data, dict) else {})
+
+    def _used_tokens(self) -> int:
+        return self.usage.get("prompt_tokens", 0) + self.usage.get("completion_tokens", 0)
+
+
+def _stage_name(call: ChatCall) -> str:
+    return "vlm" if has_image(call.messages) else "llm"
+
+
+def complete(call: ChatCall, api_key: str | None = None) -> Any:
+    """Blocking `acomplete`: the same rate-limit buckets, with the llm/vlm limit held by threads."""
+    limiter = get_rate_limiter()
+    estimate = limiter.acquire_sync(call.messages)
+    try:
+        with stage_sync(_stage_name(call)):
+            start = time.perf_counter()
+            response = get_openai_client(api_key).chat.completions.create(**call._kwargs())
+    except BaseException:
+        limiter.refund(estimate)
+        raise
+    try:
+        return call._result(response, start)
+    finally:
+        limiter.settle(estimate, call._used_tokens())
+
+
+async def acomplete(call: ChatCall, api_key: str | None = None) -> Any:
+    """Run `call` under the OPENAI_RPM/OPENAI_TPM buckets and the shared llm/vlm concurrency limit.
+
+    The rate-limit wait happens before a stage slot is taken, so a throttled
+    call never holds one; a request that fails gives its token reservation back.
+    """
+    limiter = get_rate_limiter()
+    estimate = await limiter.acquire(call.messages)
+    try:
+        async with stage(_stage_name(call)):
+            start = time.perf_counter()
+            response = await get_async_openai_client(api_key).chat.completions.create(**call._kwargs())
+    except BaseException:
+        limiter.refund(estimate)
+        raise
+    try:
+        return call._result(response, start)
+    finally:
+        limiter.settle(estimate, call._used_tokens())
@@ -1,9 +1,14 @@
 from __future__ import annotations
 
-from typing import Optional
+import os
+import time
+from typing import Optional, Sequence
 
+import numpy as np
 from PIL import Image
 
+from backend.targets import PreparedTarget, prepare_target
+
 try:
     import torch
     import torchvision.transforms as transforms
@@ -15,6 +20,11 @@ except Exception as exc:  # pragma: no cover - optional dependency
     lpips = None
     _LPIPS_IMPORT_ERROR = str(exc)
 
+LPIPS_BATCH_SIZE = int(os.getenv("LPIPS_BATCH_SIZE", "16"))
+# 0 keeps torch's default (one thread per core), which competes with render workers.
+LPIPS_TORCH_THREADS = int(os.getenv("LPIPS_TORCH_THREADS", "0"))
+LPIPS_TORCH_INTEROP_THREADS = int(os.getenv("LPIPS_TORCH_INTEROP_THREADS", "0"))
+
 _lpips_model = None
 
 
@@ -27,6 +37,34 @@ def _get_lpips_model():
     return _lpips_model
 
 
+def configure_torch_threads() -> dict[str, int]:
+    """Apply LPIPS_TORCH_THREADS / LPIPS_TORCH_INTEROP_THREADS; call before the first inference."""
+    if torch is None:
+        return {}
+    if LPIPS_TORCH_THREADS > 0:
+        torch.set_num_threads(LPIPS_TORCH_THREADS)
+    if LPIPS_TORCH_INTEROP_THREADS > 0:
+        try:
+            torch.set_num_interop_threads(LPIPS_TORCH_INTEROP_THREADS)
+        except RuntimeError as exc:  # only settable before any inter-op work has started
+            print(f"[lpips] interop threads not applied: {exc}")
+    return {"intra_op": torch.get_num_threads(), "inter_op": torch.get_num_interop_threads()}
+
+
+def warmup_lpips() -> Optional[float]:
+    """Load the LPIPS weights and run one dummy batch; return elapsed ms, or None if unavailable."""
+    if torch is None or lpips is None:
+        return None
+    start = time.perf_counter()
+    model = _get_lpips_model()
+    if model is None:
+        return None
+    with torch.no_grad():
+        x = torch.zeros((1, 3, 256, 256))
+        model(x, x)
+    return (time.perf_counter() - start) * 1000
+
+
 def _load_image_tensor(img: Image.Image) -> "torch.Tensor":
     if torch is None or transforms is None:
         raise RuntimeError("LPIPS dependencies not available")
@@ -41,47 +79,115 @@ def _load_image_tensor(img: Image.Image) -> "torch.Tensor":
     return transform(img.convert("RGB")).unsqueeze(0)
 
 
-def compute_lpips(input_img: Image.Image, render_img: Image.Image) -> Optional[float]:
+def _frames_tensor(frames: np.ndarray) -> "torch.Tensor":
+    """Wrap (N, H, W, 3) uint8 frames as a normalized (N, 3, H, W) tensor in [-1, 1].
+
+    torch.from_numpy shares the array's memory and the permute is a view, so
+    the only allocation is the float result. Frames already at 256x256 (the
+    renderer's output size) skip the resize entirely.
+    """
+    if torch is None:
+        raise RuntimeError("LPIPS dependencies not available")
+
+    x = torch.from_numpy(frames).permute(0, 3, 1, 2).float().div_(127.5).sub_(1.0)
+    if x.shape[-2:] != (256, 256):
+        x = torch.nn.functional.interpolate(x, size=(256, 256), mode="bilinear", antialias=True, align_corners=False)
+    return x
+
+
+def _as_frames_tensor(render_imgs: np.ndarray | Sequence[Image.Image]) -> "torch.Tensor":
+    if isinstance(render_imgs, np.ndarray):
+        return _frames_tensor(render_imgs)
+    return torch.cat([_load_image_tensor(img) for img in render_imgs])
+
+
+def _target_tensor(input_img: Image.Image | PreparedTarget) -> "torch.Tensor":
+    target = prepare_target(input_img)
+    # The cached target array is read-only; copy once so torch can share the buffer.
+    return target.derive("lpips_tensor", lambda: _frames_tensor(target.array[None].copy()))
+
+
+class LpipsScorer:
+    """LPIPS against one fixed target, with the target's features computed once.
+
+    Equivalent to `lpips.LPIPS.forward(target, frame)` per frame, but the
+    target half of the network runs only at construction and candidate frames
+    go through the backbone in batches of `batch_size`.
+    """
+
+    def __init__(self, input_img: Image.Image | PreparedTarget, model=None, batch_size: int = LPIPS_BATCH_SIZE) -> None:
+        self.model = model or _get_lpips_model()
+        self.batch_size = max(batch_size, 1)
+        with torch.no_grad():
+            self._target_feats = self._features(_target_tensor(input_img))
+
+    def _features(self, x: "torch.Tensor") -> list["torch.Tensor"]:
+        m = self.model
+        if m.version == "0.1":
+            x = m.scaling_layer(x)
+        return [lpips.normalize_tensor(out) for out in m.net.forward(x)]
+
+    def _distance(self, feats: list["torch.Tensor"]) -> "torch.Tensor":
+        m = self.model
+        val = 0
+        for kk, (f0, f1) in enumerate(zip(self._target_feats, feats)):
+            diff = (f0 - f1) ** 2
+            layer = m.lins[kk](diff) if m.lpips else diff.sum(dim=1, keepdim=True)
+            val = val + lpips.spatial_average(layer, keepdim=True)
+        return val.flatten()
+
+    def score(self, render_imgs: np.ndarray | Sequence[Image.Image]) -> list[float]:
+        scores: list[float] = []
+        with torch.no_grad():
+            x = _as_frames_tensor(render_imgs)
+            for start in range(0, x.shape[0], self.batch_size):
+                feats = self._features(x[start:start + self.batch_size])
+                scores.extend(self._distance(feats).tolist())
+        return scores
+
+
+def get_lpips_scorer(input_img: Image.Image | PreparedTarget) -> Optional[LpipsScorer]:
+    """Return the scorer cached on the target (one backbone pass per session), or None if LPIPS is unavailable."""
     if torch is None or lpips is None:
         if _LPIPS_IMPORT_ERROR:
             print(f"[lpips] unavailable: {_LPIPS_IMPORT_ERROR}")
         return None
+    if _get_lpips_model() is None:
+        return None
+    target = prepare_target(input_img)
+    return target.derive("lpips_scorer", lambda: LpipsScorer(target))
+
 
-    loss_fn = _get_lpips_model()
-    if loss_fn is None:
+def compute_lpips(input_img: Image.Image | PreparedTarget, render_img: Image.Image) -> Optional[float]:
+    scorer = get_lpips_scorer(input_img)
+    if scorer is None:
         return None
-    with torch.no_grad():
-        input_tensor = _load_image_tensor(input_img)
-        render_tensor = _load_image_tensor(render_img)
-        score = loss_fn(input_tensor, render_tensor)
-    return float(score.item())
+    return scorer.score([render_img])[0]
 
 
 def compute_lpips_multi(
-    input_img: Image.Image,
-    render_imgs: list[Image.Image],
+    input_img: Image.Image | PreparedTarget,
+    render_imgs: np.ndarray | Sequence[Image.Image],
 ) -> tuple[Optional[float], int, list[Optional[float]]]:
-    """Score each render against the target, return (best_score, best_index, all_scores)."""
-    if torch is None or lpips is None:
-        if _LPIPS_IMPORT_ERROR:
-            print(f"[lpips] unavailable: {_LPIPS_IMPORT_ERROR}")
-        return None, 0, [None] * len(render_imgs)
+    """Score each render against the target, return (best_score, best_index, all_scores).
 
-    loss_fn = _get_lpips_model()
-    if loss_fn is None:
+    `render_imgs` is either a list of PIL images or the renderer's (N, H, W, 3)
+    uint8 array, which is scored without going through PIL.
+    """
+    scorer = get_lpips_scorer(input_img)
+    if scorer is None:
         return None, 0, [None] * len(render_imgs)
 
-    input_tensor = _load_image_tensor(input_img)
-    scores: list[float] = []
-
-    with torch.no_grad():
-        for img in render_imgs:
-            render_tensor = _load_image_tensor(img)
-            score = float(loss_fn(input_tensor, render_tensor).item())
-            scores.append(score)
-
+    scores = scorer.score(render_imgs)
     best_idx = min(range(len(scores)), key=lambda i: scores[i])
     return scores[best_idx], best_idx, scores
 
 
-__all__ = ["compute_lpips", "compute_lpips_multi"]
+__all__ = [
+    "LpipsScorer",
+    "compute_lpips",
+    "compute_lpips_multi",
+    "configure_torch_threads",
+    "get_lpips_scorer",
+    "warmup_lpips",
+]
@@ -0,0 +1,115 @@
+from __future__ import annotations
+
+import os
+import queue
+import threading
+from concurrent.futures import Future
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+RENDER_CODEC = os.getenv("RENDER_CODEC", "png").lower()  # png | webp | none
+RENDER_PNG_LEVEL = int(os.getenv("RENDER_PNG_LEVEL", "1"))
+RENDER_PERSIST = os.getenv("RENDER_PERSIST", "all").lower()  # all | best
+RENDER_WRITE_QUEUE = int(os.getenv("RENDER_WRITE_QUEUE", "64"))
+
+_SUFFIXES = {"png": ".png", "webp": ".webp"}
+
+
+def frame_path(
+    output_dir: Path, *, iteration: int, frame: int, num_frames: int, codec: str = "png", stem: str = "iter"
+) -> Path:
+    suffix = _SUFFIXES.get(codec, ".png")
+    if num_frames == 1:
+        return output_dir / f"{stem}_{iteration + 1:02d}{suffix}"
+    return output_dir / f"{stem}_{iteration + 1:02d}_f{frame + 1:02d}{suffix}"
+
+
+def encode_frame(frame: Image.Image | np.ndarray, path: Path, *, codec: str = RENDER_CODEC, png_level: int = RENDER_PNG_LEVEL) -> None:
+    img = Image.fromarray(frame) if isinstance(frame, np.ndarray) else frame
+    if codec == "webp":
+        img.save(path, format="WEBP", lossless=True, quality=0, method=0)
+    else:
+        img.save(path, format="PNG", compress_level=png_level)
+
+
+class FrameWriter:
+    """Background thread that encodes render frames to disk off the iteration hot path.
+
+    The queue is bounded so a slow disk applies backpressure to the renderer
+    instead of buffering frames without limit.
+    """
+
+    def __init__(self, codec: str = RENDER_CODEC, png_level: int = RENDER_PNG_LEVEL, maxsize: int = RENDER_WRITE_QUEUE) -> None:
+        self.codec = codec
+        self.png_level = png_level
+        self.stats = {"written": 0, "failed": 0}
+        self._queue: queue.Queue = queue.Queue(maxsize=max(maxsize, 1))
+        self._thread = threading.Thread(target=self._run, name="frame-writer", daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            future, frame, path = job
+            try:
+                encode_frame(frame, path, codec=self.codec, png_level=self.png_level)
+            except Exception as exc:
+                self.stats["failed"] += 1
+                future.set_exception(exc)
+            else:
+                self.stats["written"] += 1
+                future.set_result(path)
+            finally:
+                self._queue.task_done()
+
+    def submit(self, frame: Image.Image | np.ndarray, path: Path) -> "Future[Path]":
+        future: "Future[Path]" = Future()
+        self._queue.put((future, frame, path))
+        return future
+
+    def flush(self) -> None:
+        self._queue.join()
+
+    def close(self) -> None:
+        self._queue.put(None)
+        self._thread.join(timeout=10)
+
+
+_writer: FrameWriter | None = None
+_writer_lock = threading.Lock()
+
+
+def get_frame_writer() -> FrameWriter:
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = FrameWriter()
+        return _writer
+
+
+def persist_frames(
+    frames: list[Image.Image] | list[np.ndarray],
+    *,
+    iteration: int,
+    output_dir: Path,
+    indices: list[int] | None = None,
+    stem: str = "iter",
+) -> tuple[list[Path], list[Future]]:
+    """Queue `frames` (or only `indices`) for writing; return their paths and write futures.
+
+    With RENDER_CODEC=none nothing is written and no paths are returned.
+    """
+    if RENDER_CODEC == "none":
+        return [], []
+
+    writer = get_frame_writer()
+    paths, futures = [], []
+    for f in indices if indices is not None else range(len(frames)):
+        path = frame_path(output_dir, iteration=iteration, frame=f, num_frames=len(frames), codec=writer.codec, stem=stem)
+        futures.append(writer.submit(frames[f], path))
+        paths.append(path)
+    return paths, futures
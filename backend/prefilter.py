@@ -0,0 +1,207 @@
+from __future__ import annotations
+
+import os
+from dataclasses import dataclass, field
+
+import numpy as np
+from PIL import Image
+
+from backend.metrics import compute_lpips_multi
+from backend.targets import PreparedTarget, prepare_target
+
+PREFILTER_TOP_K = int(os.getenv("PREFILTER_TOP_K", "8"))  # 0 sends every frame to LPIPS
+PREFILTER_SKIP_DEGENERATE = os.getenv("PREFILTER_SKIP_DEGENERATE", "1") not in {"0", "false", "FALSE"}
+
+_DOWNSAMPLE = 64
+_HIST_BINS = 16
+_SSIM_WINDOW = 7
+_SSIM_C1 = (0.01 * 255) ** 2
+_SSIM_C2 = (0.03 * 255) ** 2
+
+
+def _downsample(frames: np.ndarray, side: int = _DOWNSAMPLE) -> np.ndarray:
+    """Box-average (N, H, W, 3) uint8 frames to (N, side, side, 3) float32."""
+    n, h, w, c = frames.shape
+    fh, fw = h // side, w // side
+    x = frames[:, : fh * side, : fw * side].astype(np.float32)
+    return x.reshape(n, side, fh, side, fw, c).mean(axis=(2, 4))
+
+
+def _histograms(frames: np.ndarray, bins: int = _HIST_BINS) -> np.ndarray:
+    """Per-channel normalized color histograms, shape (N, 3, bins)."""
+    n = frames.shape[0]
+    idx = (frames.reshape(n, -1, 3).astype(np.int64) * bins) >> 8
+    offsets = (np.arange(n)[:, None, None] * 3 + np.arange(3)[None, None, :]) * bins
+    counts = np.bincount((idx + offsets).ravel(), minlength=n * 3 * bins).reshape(n, 3, bins)
+    return counts / counts.sum(axis=2, keepdims=True)
+
+
+def _box_filter(x: np.ndarray, k: int) -> np.ndarray:
+    """Mean over k x k windows (valid region) on the last two axes, via summed-area tables."""
+    s = np.pad(x, [(0, 0)] * (x.ndim - 2) + [(1, 0), (1, 0)]).cumsum(axis=-2).cumsum(axis=-1)
+    total = s[..., k:, k:] - s[..., :-k, k:] - s[..., k:, :-k] + s[..., :-k, :-k]
+    return total / (k * k)
+
+
+def _gray(x: np.ndarray) -> np.ndarray:
+    return x[..., 0] * 0.299 + x[..., 1] * 0.587 + x[..., 2] * 0.114
+
+
+def _ssim(ref: np.ndarray, frames: np.ndarray, k: int = _SSIM_WINDOW) -> np.ndarray:
+    """Mean SSIM of grayscale (side, side) ref against (N, side, side) frames."""
+    ref = ref[None]
+    mu_x, mu_y = _box_filter(ref, k), _box_filter(frames, k)
+    var_x = _box_filter(ref * ref, k) - mu_x ** 2
+    var_y = _box_filter(frames * frames, k) - mu_y ** 2
+    cov = _box_filter(ref * frames, k) - mu_x * mu_y
+    num = (2 * mu_x * mu_y + _SSIM_C1) * (2 * cov + _SSIM_C2)
+    den = (mu_x ** 2 + mu_y ** 2 + _SSIM_C1) * (var_x + var_y + _SSIM_C2)
+    return (num / den).mean(axis=(1, 2))
+
+
+def degenerate_reasons(mean: np.ndarray, std: np.ndarray) -> list[list[str]]:
+    """Flag frames that no amount of perceptual scoring will rescue."""
+    reasons: list[list[str]] = []
+    for m, s in zip(mean, std):
+        r = []
+        if m.max() < 3.0:
+            r.append("all black")
+        elif m.min() > 252.0:
+            r.append("all white")
+        elif s.max() < 2.0:
+            r.append("flat color")
+        reasons.append(r)
+    return reasons
+
+
+@dataclass
+class PrefilterResult:
+    mse: list[float]
+    hist: list[float]
+    ssim: list[float]
+    mean: list[list[float]]
+    std: list[float]
+    degenerate: list[list[str]]
+    score: list[float]
+    ranked: list[int]
+    top_k: list[int] = field(default_factory=list)
+
+    @property
+    def all_degenerate(self) -> bool:
+        return all(self.degenerate)
+
+    def to_event(self) -> dict:
+        def r(values):
+            return [round(float(v), 4) for v in values]
+
+        return {
+            "mse": r(self.mse),
+            "hist": r(self.hist),
+            "ssim": r(self.ssim),
+            "mean": [r(m) for m in self.mean],
+            "std": r(self.std),
+            "degenerate": self.degenerate,
+            "score": r(self.score),
+            "ranked": self.ranked,
+            "top_k": self.top_k,
+        }
+
+
+def _reference(target: PreparedTarget) -> dict[str, np.ndarray]:
+    def build() -> dict[str, np.ndarray]:
+        arr = target.array[None]
+        small = _downsample(arr)
+        return {"small": small[0], "gray": _gray(small)[0], "hist": _histograms(arr)[0]}
+
+    return target.derive("prefilter_ref", build)
+
+
+def prefilter_frames(
+    input_img: Image.Image | PreparedTarget,
+    frames: np.ndarray,
+    top_k: int = PREFILTER_TOP_K,
+) -> PrefilterResult:
+    """Cheap, vectorized tier run before LPIPS: rank frames and pick the top-k worth scoring.
+
+    The combined score (lower is better) averages downsampled MSE, color
+    histogram distance and 1 - SSIM, each in [0, 1]; degenerate frames are
+    ranked after every healthy one.
+    """
+    ref = _reference(prepare_target(input_img))
+
+    small = _downsample(frames)
+    mse = ((small - ref["small"][None]) ** 2).mean(axis=(1, 2, 3)) / (255.0 ** 2)
+    hist = 0.5 * np.abs(_histograms(frames) - ref["hist"][None]).sum(axis=2).mean(axis=1)
+    ssim = _ssim(ref["gray"], _gray(small))
+
+    flat = frames.reshape(frames.shape[0], -1, 3)
+    mean = flat.mean(axis=1)
+    std = flat.std(axis=1)
+    degenerate = degenerate_reasons(mean, std)
+
+    score = (mse + hist + (1.0 - np.clip(ssim, -1.0, 1.0)) / 2.0) / 3.0
+    ranked = sorted(range(len(score)), key=lambda i: (bool(degenerate[i]), float(score[i])))
+    keep = ranked if top_k <= 0 else ranked[:top_k]
+
+    return PrefilterResult(
+        mse=mse.tolist(),
+        hist=hist.tolist(),
+        ssim=ssim.tolist(),
+        mean=mean.tolist(),
+        std=std.mean(axis=1).tolist(),
+        degenerate=degenerate,
+        score=score.tolist(),
+        ranked=ranked,
+        top_k=sorted(keep),
+    )
+
+
+def score_prefiltered(
+    input_img: Image.Image | PreparedTarget,
+    frames: np.ndarray,
+    pre: PrefilterResult,
+) -> tuple[float | None, int, list[float | None]]:
+    """LPIPS on the prefilter's top-k only.
+
+    Returns (best_lpips, best_index, lpips_per_frame); frames that were
+    filtered out get None. When every frame is degenerate LPIPS is skipped
+    (PREFILTER_SKIP_DEGENERATE) and the cheap ranking picks the frame.
+    """
+    all_lpips: list[float | None] = [None] * len(frames)
+    if PREFILTER_SKIP_DEGENERATE and pre.all_degenerate:
+        return None, pre.ranked[0], all_lpips
+
+    keep = pre.top_k
+    best, best_pos, scores = compute_lpips_multi(input_img, frames if len(keep) == len(frames) else frames[keep])
+    if best is None:
+        return None, pre.ranked[0], all_lpips
+    for idx, score in zip(keep, scores):
+        all_lpips[idx] = score
+    return best, keep[best_pos], all_lpips
+
+
+def score_frames(
+    input_img: Image.Image | PreparedTarget,
+    frames: np.ndarray,
+    top_k: int = PREFILTER_TOP_K,
+) -> tuple[PrefilterResult, float | None, int, list[float | None]]:
+    """Run the cheap tier, then LPIPS on its top-k: (prefilter, best_lpips, best_index, lpips_per_frame)."""
+    pre = prefilter_frames(input_img, frames, top_k=top_k)
+    return (pre, *score_prefiltered(input_img, frames, pre))
+
+
+def degenerate_critique(reasons: list[str]) -> str:
+    """Deterministic critique used instead of a VLM call when every frame is degenerate."""
+    what = ", ".join(reasons) or "degenerate"
+    return (
+        "SIMILARITY SCORE: 1\n"
+        f"COLOR DELTA: The render is {what}; the target's palette is missing entirely.\n"
+        "WHAT'S WORKING:\n"
+        "- The shader compiles.\n"
+        "WHAT NEEDS TO CHANGE (structure, texture, edges only — do NOT repeat color here, it is already covered in COLOR DELTA):\n"
+        "- Every frame is uniform, so no structure reaches the output. Check that f_color is written on all paths, "
+        "that alpha is 1.0, and that no division by zero, NaN or out-of-range value collapses the result.\n"
+    )
+
+
+__all__ = ["PrefilterResult", "degenerate_critique", "prefilter_frames", "score_frames", "score_prefiltered"]
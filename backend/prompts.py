@@ -0,0 +1,147 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+REFERENCE_SUMMARY_PATH = BASE_DIR / "notes" / "reference_particle_flow_summary.txt"
+GLSL_RULES_PATH = BASE_DIR / "notes" / "glsl_rules_condensed.txt"
+
+PROMPT_ASSET_CHECK_S = float(os.getenv("PROMPT_ASSET_CHECK_S", "1.0"))  # mtime poll interval; 0 stats on every call
+PROMPT_PREFIX_CACHE_SIZE = 32
+
+_USAGE_FIELDS = ("calls", "prompt_tokens", "cached_tokens", "completion_tokens", "ms")
+
+
+def text_digest(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+@dataclass(frozen=True)
+class PromptAsset:
+    name: str
+    path: Path
+    text: str
+    sha256: str
+    mtime_ns: int
+
+
+class PromptRegistry:
+    """Prompt assets from notes/, loaded and hashed once and hot-reloaded on mtime change.
+
+    Static prompt prefixes are memoized on the hashes of the assets they are
+    built from, so a reload rebuilds them and an unchanged file never does.
+    Token usage from every chat response is tallied per prompt kind, including
+    `prompt_tokens_details.cached_tokens`, to show whether provider-side
+    prompt caching is hitting.
+    """
+
+    def __init__(self, paths: dict[str, Path], check_interval: float = PROMPT_ASSET_CHECK_S) -> None:
+        self.paths = dict(paths)
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._assets: dict[str, PromptAsset] = {}
+        self._checked: dict[str, float] = {}
+        self._prefixes: OrderedDict[tuple, str] = OrderedDict()
+        self._usage: dict[str, dict[str, float]] = {}
+        self.stats = {"loads": 0, "reloads": 0, "prefix_hits": 0, "prefix_builds": 0}
+
+    def _load(self, name: str) -> PromptAsset:
+        path = self.paths[name]
+        try:
+            mtime_ns = path.stat().st_mtime_ns
+            text = path.read_text(encoding="utf-8").strip()
+        except OSError:
+            mtime_ns, text = -1, ""
+        return PromptAsset(name=name, path=path, text=text, sha256=text_digest(text), mtime_ns=mtime_ns)
+
+    def asset(self, name: str) -> PromptAsset:
+        now = time.monotonic()
+        with self._lock:
+            current = self._assets.get(name)
+            if current is not None and now - self._checked.get(name, 0.0) < self.check_interval:
+                return current
+            self._checked[name] = now
+            if current is not None:
+                try:
+                    mtime_ns = current.path.stat().st_mtime_ns
+                except OSError:
+                    mtime_ns = -1
+                if mtime_ns == current.mtime_ns:
+                    return current
+            loaded = self._load(name)
+            self._assets[name] = loaded
+            if current is None:
+                self.stats["loads"] += 1
+            elif loaded.sha256 != current.sha256:
+                self.stats["reloads"] += 1
+                print(f"[prompts] reloaded {name} ({loaded.sha256[:12]})")
+            return loaded
+
+    def text(self, name: str) -> str:
+        return self.asset(name).text
+
+    def prefix(self, kind: str, build: Callable[[], str], *parts: PromptAsset | str) -> str:
+        """Memoized static prefix for `kind`, keyed on the content hash of each part it embeds."""
+        key = (kind, *(p.sha256 if isinstance(p, PromptAsset) else text_digest(p) for p in parts))
+        with self._lock:
+            cached = self._prefixes.get(key)
+            if cached is not None:
+                self._prefixes.move_to_end(key)
+                self.stats["prefix_hits"] += 1
+                return cached
+        built = build()
+        with self._lock:
+            self._prefixes[key] = built
+            self._prefixes.move_to_end(key)
+            while len(self._prefixes) > PROMPT_PREFIX_CACHE_SIZE:
+                self._prefixes.popitem(last=False)
+            self.stats["prefix_builds"] += 1
+        return built
+
+    def record_usage(self, kind: str, usage: Any, elapsed_ms: float = 0.0) -> dict[str, Any]:
+        """Add one response's usage to the `kind` totals and return that call's counts."""
+        details = getattr(usage, "prompt_tokens_details", None)
+        counts = {
+            "calls": 1,
+            "prompt_tokens": getattr(usage, "prompt_tokens", 0) or 0,
+            "cached_tokens": getattr(details, "cached_tokens", 0) or 0,
+            "completion_tokens": getattr(usage, "completion_tokens", 0) or 0,
+            "ms": round(elapsed_ms, 1),
+        }
+        with self._lock:
+            totals = self._usage.setdefault(kind or "other", dict.fromkeys(_USAGE_FIELDS, 0))
+            for name, value in counts.items():
+                totals[name] += value
+        return counts
+
+    def snapshot(self) -> dict[str, Any]:
+        with self._lock:
+            assets = {name: {"sha256": a.sha256[:12], "chars": len(a.text)} for name, a in self._assets.items()}
+            usage = {kind: dict(totals) for kind, totals in self._usage.items()}
+            stats = dict(self.stats)
+        for totals in usage.values():
+            prompt, calls = totals["prompt_tokens"], totals["calls"]
+            totals["ms"] = round(totals["ms"], 1)
+            totals["cached_ratio"] = round(totals["cached_tokens"] / prompt, 4) if prompt else None
+            totals["avg_completion_tokens"] = round(totals["completion_tokens"] / calls, 1) if calls else None
+            totals["avg_ms"] = round(totals["ms"] / calls, 1) if calls else None
+        return {**stats, "assets": assets, "usage": usage}
+
+
+_registry: PromptRegistry | None = None
+_registry_lock = threading.Lock()
+
+
+def get_prompt_registry() -> PromptRegistry:
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = PromptRegistry({"reference_summary": REFERENCE_SUMMARY_PATH, "glsl_rules": GLSL_RULES_PATH})
+        return _registry
@@ -1,12 +1,26 @@
 from __future__ import annotations
 
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from pathlib import Path
+from typing import Callable, Mapping, Sequence, TypeVar
 
 import moderngl
 import numpy as np
 from PIL import Image
 
-OUTPUT_SIZE = (256, 256)
+from backend.persist import frame_path
+from backend.targets import OUTPUT_SIZE, PreparedTarget, prepare_target
+
+PROGRAM_CACHE_SIZE = int(os.getenv("RENDER_PROGRAM_CACHE_SIZE", "32"))
+TEXTURE_CACHE_SIZE = int(os.getenv("RENDER_TEXTURE_CACHE_SIZE", "8"))
+RENDER_ATLAS = os.getenv("RENDER_ATLAS", "1") not in {"0", "false", "FALSE"}
 
 
 VERTEX_SHADER = """
@@ -19,71 +33,363 @@ void main() {
 }
 """
 
+FULLSCREEN_TRIANGLE = np.array([-1.0, -1.0, 3.0, -1.0, -1.0, 3.0], dtype="f4")
 
-def render_iteration_frames(
-    *,
-    input_img: Image.Image,
-    iteration: int,
-    total_iterations: int,
-    fragment_shader: str,
-    output_dir: Path,
-    num_frames: int = 1,
-) -> tuple[list[Path], str, list[Image.Image], Image.Image]:
-    input_img = input_img.convert("RGB").resize(OUTPUT_SIZE)
-    input_arr = np.asarray(input_img, dtype=np.uint8)
+T = TypeVar("T")
+Uniforms = Mapping[str, Sequence[float]]
 
-    ctx = moderngl.create_standalone_context()
-    fbo = ctx.simple_framebuffer(OUTPUT_SIZE)
-    fbo.use()
 
-    program = ctx.program(vertex_shader=VERTEX_SHADER, fragment_shader=fragment_shader)
+def shader_key(fragment_shader: str) -> str:
+    return hashlib.sha256(fragment_shader.encode("utf-8")).hexdigest()
 
-    vertices = np.array([-1.0, -1.0, 3.0, -1.0, -1.0, 3.0], dtype="f4")
-    vbo = ctx.buffer(vertices.tobytes())
-    vao = ctx.simple_vertex_array(program, vbo, "in_pos")
 
-    texture = ctx.texture(OUTPUT_SIZE, 3, input_arr.tobytes())
-    texture.use(location=0)
-    if "u_input" in program:
-        program["u_input"] = 0
-    if "u_resolution" in program:
-        program["u_resolution"] = OUTPUT_SIZE
+# (pattern, category) checked in order against each compiler message; the
+# categories follow the glsl:* keys in notes/agent_memory_plan.md.
+_ERROR_CATEGORIES = [
+    (re.compile(r"#version|version .* not supported|only valid .* in GLSL 1\.10", re.I), "glsl:version"),
+    (re.compile(r"syntax error|unexpected|parse error", re.I), "glsl:syntax"),
+    (re.compile(r"no (matching )?(overloaded )?function|no function with name", re.I), "glsl:undefined_function"),
+    (re.compile(r"undeclared|undefined variable|not declared", re.I), "glsl:undeclared_identifier"),
+    (re.compile(r"redefin|redeclar|already (been )?declared", re.I), "glsl:redefinition"),
+    (re.compile(r"does not operate on|size mismatch|wrong operand|operands? to .* must|no operation", re.I), "glsl:operator_mismatch"),
+    (re.compile(r"too (many|few) (arguments|components)|not enough data|construct", re.I), "glsl:constructor_args"),
+    (re.compile(r"incompatible types|cannot be assigned|cannot convert|implicit(ly)? conver|type mismatch", re.I), "glsl:incompatible_types"),
+    (re.compile(r"no return statement|must return a value|return type", re.I), "glsl:missing_return"),
+    (re.compile(r"link", re.I), "glsl:link"),
+]
 
-    render_paths = []
-    render_imgs = []
+# Mesa: "0:12(5): error: ...", Apple/ANGLE: "ERROR: 0:12: ...", NVIDIA: "0(12) : error C1008: ..."
+_LOG_LINE = re.compile(
+    r"^\s*(?:ERROR:\s*)?\d+[:(](?P<line>\d+)[)(:](?:\d+\))?\s*:?\s*(?:(?:preprocessor\s+)?error(?:\s+\w+)?:\s*)?(?P<msg>.+)$",
+    re.I,
+)
 
-    for f in range(num_frames):
-        t = f / max(num_frames, 1)
-        if "u_time" in program:
-            program["u_time"] = float(t)
 
-        fbo.clear(0.0, 0.0, 0.0, 1.0)
-        vao.render(mode=moderngl.TRIANGLES)
+def normalize_error(message: str) -> str:
+    """Map a single compiler message to a stable category key, e.g. glsl:undeclared_identifier."""
+    for pattern, category in _ERROR_CATEGORIES:
+        if pattern.search(message):
+            return category
+    return "glsl:other"
 
-        data = fbo.read(components=3)
-        render_img = Image.frombytes("RGB", OUTPUT_SIZE, data)
 
-        if num_frames == 1:
-            render_path = output_dir / f"iter_{iteration + 1:02d}.png"
-        else:
-            render_path = output_dir / f"iter_{iteration + 1:02d}_f{f + 1:02d}.png"
-        render_img.save(render_path)
+@dataclass
+class CompileError:
+    line: int | None
+    message: str
+    category: str
+
+
+@dataclass
+class CompileResult:
+    ok: bool
+    errors: list[CompileError] = field(default_factory=list)
+    log: str = ""
+    elapsed_ms: float = 0.0
+
+    @property
+    def categories(self) -> list[str]:
+        return list(dict.fromkeys(e.category for e in self.errors))
+
+
+def parse_compile_log(log: str) -> list[CompileError]:
+    """Extract structured errors from a moderngl compile/link exception message."""
+    errors = []
+    linker = "Linker failed" in log
+    for raw in log.splitlines():
+        raw = raw.strip()
+        if not raw or set(raw) == {"="} or raw in {"fragment_shader", "vertex_shader"}:
+            continue
+        if raw.startswith("GLSL Compiler failed") or raw.startswith("GLSL Linker failed"):
+            continue
+        m = _LOG_LINE.match(raw)
+        if m:
+            if re.search(r"\bwarning\b", raw, re.I) and not re.search(r"\berror\b", raw, re.I):
+                continue
+            message = m.group("msg").strip()
+            errors.append(CompileError(line=int(m.group("line")), message=message, category=normalize_error(message)))
+        elif re.search(r"\berror\b", raw, re.I):
+            category = "glsl:link" if linker else normalize_error(raw)
+            errors.append(CompileError(line=None, message=raw, category=category))
+    if not errors and log.strip():
+        message = log.strip().splitlines()[0]
+        category = "glsl:link" if linker else normalize_error(message)
+        errors.append(CompileError(line=None, message=message, category=category))
+    return errors
+
+
+def _create_context() -> moderngl.Context:
+    # e.g. RENDER_GL_BACKEND=egl on headless hosts without an X display
+    backend = os.getenv("RENDER_GL_BACKEND")
+    if backend:
+        return moderngl.create_standalone_context(backend=backend)
+    return moderngl.create_standalone_context()
+
+
+class ShaderRenderer:
+    """Long-lived offscreen renderer.
+
+    Owns one standalone GL context, the fullscreen-triangle VBO and the output
+    framebuffer, and keeps compiled programs in an LRU cache keyed by a hash of
+    the fragment source. Target textures are uploaded once per PreparedTarget
+    key and kept in a small LRU of their own. GL contexts are bound to the thread that created them,
+    so every GL call is marshalled onto a dedicated thread owned by the renderer.
+    """
+
+    def __init__(self, size: tuple[int, int] = OUTPUT_SIZE, cache_size: int = PROGRAM_CACHE_SIZE) -> None:
+        self.size = size
+        self.cache_size = max(cache_size, 1)
+        self.stats = {
+            "program_hits": 0,
+            "program_misses": 0,
+            "program_evictions": 0,
+            "texture_hits": 0,
+            "texture_misses": 0,
+        }
+        self._programs: "OrderedDict[str, tuple[moderngl.Program, moderngl.VertexArray]]" = OrderedDict()
+        self._textures: "OrderedDict[str, moderngl.Texture]" = OrderedDict()
+        self._atlas_fbo: moderngl.Framebuffer | None = None
+        self._atlas_rows = 0
+        self._thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shader-gl")
+        self._call(self._setup)
+
+    def _call(self, fn: Callable[..., T], *args, **kwargs) -> T:
+        return self._thread.submit(fn, *args, **kwargs).result()
+
+    def _setup(self) -> None:
+        self.ctx = _create_context()
+        self.fbo = self.ctx.simple_framebuffer(self.size)
+        self.vbo = self.ctx.buffer(FULLSCREEN_TRIANGLE.tobytes())
+        self.max_atlas_side = min(self.ctx.info["GL_MAX_RENDERBUFFER_SIZE"], self.ctx.info["GL_MAX_VIEWPORT_DIMS"][1])
+
+    def _program(self, fragment_shader: str) -> tuple[moderngl.Program, moderngl.VertexArray]:
+        key = shader_key(fragment_shader)
+        entry = self._programs.get(key)
+        if entry is not None:
+            self._programs.move_to_end(key)
+            self.stats["program_hits"] += 1
+            return entry
+
+        self.stats["program_misses"] += 1
+        program = self.ctx.program(vertex_shader=VERTEX_SHADER, fragment_shader=fragment_shader)
+        vao = self.ctx.simple_vertex_array(program, self.vbo, "in_pos")
+        self._programs[key] = (program, vao)
+
+        while len(self._programs) > self.cache_size:
+            _, (old_program, old_vao) = self._programs.popitem(last=False)
+            old_vao.release()
+            old_program.release()
+            self.stats["program_evictions"] += 1
+        return program, vao
+
+    def _validate(self, fragment_shader: str) -> CompileResult:
+        start = time.perf_counter()
+        try:
+            self._program(fragment_shader)
+        except moderngl.Error as exc:
+            log = str(exc)
+            return CompileResult(
+                ok=False,
+                errors=parse_compile_log(log),
+                log=log,
+                elapsed_ms=(time.perf_counter() - start) * 1000,
+            )
+        return CompileResult(ok=True, elapsed_ms=(time.perf_counter() - start) * 1000)
+
+    def validate(self, fragment_shader: str) -> CompileResult:
+        """Compile and link only. A valid program stays cached for the following render."""
+        return self._call(self._validate, fragment_shader)
+
+    def _texture(self, target: PreparedTarget) -> moderngl.Texture:
+        texture = self._textures.get(target.key)
+        if texture is not None:
+            self._textures.move_to_end(target.key)
+            self.stats["texture_hits"] += 1
+            return texture
+
+        self.stats["texture_misses"] += 1
+        texture = self.ctx.texture(target.size, 3, target.array.tobytes())
+        self._textures[target.key] = texture
+        while len(self._textures) > max(TEXTURE_CACHE_SIZE, 1):
+            _, old_texture = self._textures.popitem(last=False)
+            old_texture.release()
+        return texture
 
+    def _bind(
+        self, target: PreparedTarget, fragment_shader: str, uniforms: Uniforms | None = None
+    ) -> tuple[moderngl.Program, moderngl.VertexArray]:
+        program, vao = self._program(fragment_shader)
+        self._texture(target).use(location=0)
+        if "u_input" in program:
+            program["u_input"] = 0
+        if "u_resolution" in program:
+            program["u_resolution"] = self.size
+        for name, value in (uniforms or {}).items():
+            # Elements the compiler optimized away shrink the array; write only what is still there.
+            if name in program:
+                uniform = program[name]
+                data = np.asarray(value, dtype="f4").ravel()[: uniform.array_length * uniform.dimension]
+                uniform.write(data.tobytes())
+        return program, vao
+
+    def _atlas(self, rows: int) -> moderngl.Framebuffer:
+        # One atlas, grown to the largest frame count seen so far.
+        if self._atlas_fbo is None or self._atlas_rows < rows:
+            if self._atlas_fbo is not None:
+                self._atlas_fbo.release()
+            w, h = self.size
+            self._atlas_fbo = self.ctx.simple_framebuffer((w, rows * h))
+            self._atlas_rows = rows
+        return self._atlas_fbo
+
+    def _render_frames(
+        self, target: PreparedTarget, fragment_shader: str, out: np.ndarray, uniforms: Uniforms | None = None
+    ) -> np.ndarray:
+        program, vao = self._bind(target, fragment_shader, uniforms)
+        num_frames = len(out)
+
+        self.fbo.use()
+        for f in range(num_frames):
+            if "u_time" in program:
+                program["u_time"] = float(f / max(num_frames, 1))
+            self.fbo.clear(0.0, 0.0, 0.0, 1.0)
+            vao.render(mode=moderngl.TRIANGLES)
+            self.fbo.read_into(out[f], components=3)
+        return out
+
+    def _render_atlas(
+        self, target: PreparedTarget, fragment_shader: str, out: np.ndarray, uniforms: Uniforms | None = None
+    ) -> np.ndarray:
+        """Draw every time sample into one column of tiles and read them back in a single call.
+
+        Tile k sits k*H rows up from the bottom, which is exactly where frame k
+        lives in a contiguous (N, H, W, 3) buffer, so the readback lands in
+        `out` without any reshuffling.
+        """
+        program, vao = self._bind(target, fragment_shader, uniforms)
+        w, h = self.size
+        per_atlas = max(self.max_atlas_side // h, 1)
+        num_frames = len(out)
+
+        for start in range(0, num_frames, per_atlas):
+            count = min(per_atlas, num_frames - start)
+            fbo = self._atlas(min(per_atlas, num_frames))
+            fbo.use()
+            fbo.clear(0.0, 0.0, 0.0, 1.0)
+            for k in range(count):
+                if "u_time" in program:
+                    program["u_time"] = float((start + k) / max(num_frames, 1))
+                fbo.viewport = (0, k * h, w, h)
+                vao.render(mode=moderngl.TRIANGLES)
+            fbo.read_into(out[start:start + count], viewport=(0, 0, w, count * h), components=3)
+        return out
+
+    def _render(
+        self, target: PreparedTarget, fragment_shader: str, out: np.ndarray, uniforms: Uniforms | None = None
+    ) -> np.ndarray:
+        # Tiles shift gl_FragCoord, so shaders that read it are drawn one frame at a time.
+        if RENDER_ATLAS and len(out) > 1 and "gl_FragCoord" not in fragment_shader:
+            return self._render_atlas(target, fragment_shader, out, uniforms)
+        return self._render_frames(target, fragment_shader, out, uniforms)
+
+    def render_array(
+        self,
+        *,
+        input_img: Image.Image | PreparedTarget,
+        fragment_shader: str,
+        num_frames: int = 1,
+        out: np.ndarray | None = None,
+        uniforms: Uniforms | None = None,
+    ) -> np.ndarray:
+        """Render `num_frames` evenly spaced u_time samples into a (N, H, W, 3) uint8 array.
+
+        Pass a preallocated C-contiguous `out` of that shape to have the GPU
+        readback land in it directly instead of allocating per call.
+        `uniforms` sets extra float (array) uniforms by name, so one compiled
+        program can be re-rendered with new values without recompiling.
+        """
+        target = prepare_target(input_img)
+        w, h = self.size
+        if out is None:
+            out = np.empty((num_frames, h, w, 3), dtype=np.uint8)
+        elif out.shape != (num_frames, h, w, 3) or out.dtype != np.uint8 or not out.flags.c_contiguous:
+            raise ValueError(f"out must be a C-contiguous uint8 array of shape {(num_frames, h, w, 3)}")
+        return self._call(self._render, target, fragment_shader, out, uniforms)
+
+    def render(
+        self,
+        *,
+        input_img: Image.Image | PreparedTarget,
+        fragment_shader: str,
+        num_frames: int = 1,
+    ) -> list[Image.Image]:
+        """Render `num_frames` evenly spaced u_time samples of `fragment_shader`."""
+        frames = self.render_array(input_img=input_img, fragment_shader=fragment_shader, num_frames=num_frames)
+        return [Image.fromarray(frame) for frame in frames]
+
+    def _release(self) -> None:
+        for texture in self._textures.values():
+            texture.release()
+        self._textures.clear()
+        for program, vao in self._programs.values():
+            vao.release()
+            program.release()
+        self._programs.clear()
+        self.vbo.release()
+        self.fbo.release()
+        self.ctx.release()
+
+    def release(self) -> None:
+        self._call(self._release)
+        self._thread.shutdown(wait=True)
+
+
+_renderer: ShaderRenderer | None = None
+_renderer_lock = threading.Lock()
+
+
+def get_renderer() -> ShaderRenderer:
+    """Return the process-wide renderer, creating its GL context on first use."""
+    global _renderer
+    with _renderer_lock:
+        if _renderer is None:
+            _renderer = ShaderRenderer()
+        return _renderer
+
+
+def validate_shader(source: str) -> CompileResult:
+    return get_renderer().validate(source)
+
+
+def save_iteration_frames(render_imgs: list[Image.Image], *, iteration: int, output_dir: Path) -> list[Path]:
+    render_paths = []
+    for f, render_img in enumerate(render_imgs):
+        render_path = frame_path(output_dir, iteration=iteration, frame=f, num_frames=len(render_imgs))
+        render_img.save(render_path)
         render_paths.append(render_path)
-        render_imgs.append(render_img)
+    return render_paths
 
-    vao.release()
-    vbo.release()
-    texture.release()
-    fbo.release()
-    ctx.release()
 
-    return render_paths, fragment_shader, render_imgs, input_img
+def render_iteration_frames(
+    *,
+    input_img: Image.Image | PreparedTarget,
+    iteration: int,
+    total_iterations: int,
+    fragment_shader: str,
+    output_dir: Path,
+    num_frames: int = 1,
+) -> tuple[list[Path], str, list[Image.Image], Image.Image]:
+    target = prepare_target(input_img)
+    render_imgs = get_renderer().render(
+        input_img=target, fragment_shader=fragment_shader, num_frames=num_frames
+    )
+    render_paths = save_iteration_frames(render_imgs, iteration=iteration, output_dir=output_dir)
+    return render_paths, fragment_shader, render_imgs, target.image
 
 
 def render_iteration(
     *,
-    input_img: Image.Image,
+    input_img: Image.Image | PreparedTarget,
     iteration: int,
     total_iterations: int,
     fragment_shader: str,
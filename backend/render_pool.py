@@ -0,0 +1,453 @@
+from __future__ import annotations
+
+import asyncio
+import multiprocessing as mp
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from multiprocessing import shared_memory
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+from PIL import Image
+
+from backend.render import CompileResult, Uniforms, get_renderer, save_iteration_frames, validate_shader as _validate_local
+from backend.scheduler import stage
+from backend.targets import OUTPUT_SIZE, TARGET_CACHE_SIZE, PreparedTarget, prepare_target
+
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", str(min(os.cpu_count() or 1, 4))))
+RENDER_TIMEOUT_S = float(os.getenv("RENDER_TIMEOUT_S", "20"))
+RENDER_MAX_FRAMES = int(os.getenv("RENDER_MAX_FRAMES", "30"))
+WORKER_STARTUP_TIMEOUT_S = 60.0
+FRAME_SHAPE = (OUTPUT_SIZE[1], OUTPUT_SIZE[0], 3)
+
+
+class RenderTimeout(RuntimeError):
+    pass
+
+
+class RenderWorkerError(RuntimeError):
+    pass
+
+
+def _frames_view(shm: shared_memory.SharedMemory) -> np.ndarray:
+    return np.ndarray((RENDER_MAX_FRAMES, *FRAME_SHAPE), dtype=np.uint8, buffer=shm.buf)
+
+
+def _worker_main(conn, lp_num_threads: int, shm_name: str) -> None:
+    # llvmpipe reads this when the first context is created; split cores across workers
+    if lp_num_threads > 0:
+        os.environ.setdefault("LP_NUM_THREADS", str(lp_num_threads))
+
+    # Owned (and unlinked) by the parent; spawned children share its resource tracker.
+    shm = shared_memory.SharedMemory(name=shm_name)
+    shared_frames = _frames_view(shm)
+    try:
+        get_renderer()
+    except Exception as exc:
+        conn.send(("error", str(exc)))
+        return
+    conn.send(("ready", None))
+
+    targets: "OrderedDict[str, PreparedTarget]" = OrderedDict()
+    while True:
+        try:
+            msg = conn.recv()
+        except EOFError:
+            break
+        if msg is None:
+            break
+
+        op, args = msg
+        try:
+            if op == "render":
+                target_key, fragment_shader, num_frames, uniforms = args
+                target = targets.get(target_key)
+                if target is None:
+                    conn.send(("need_target", None))
+                    continue
+                if num_frames <= RENDER_MAX_FRAMES:
+                    # Readback goes straight into shared memory; only the frame count crosses the pipe.
+                    get_renderer().render_array(
+                        input_img=target,
+                        fragment_shader=fragment_shader,
+                        num_frames=num_frames,
+                        out=shared_frames[:num_frames],
+                        uniforms=uniforms,
+                    )
+                    conn.send(("shm", num_frames))
+                else:
+                    frames = get_renderer().render_array(
+                        input_img=target, fragment_shader=fragment_shader, num_frames=num_frames, uniforms=uniforms
+                    )
+                    conn.send(("ok", frames))
+            elif op == "validate":
+                conn.send(("ok", get_renderer().validate(args)))
+            elif op == "target":
+                target_key, array = args
+                targets[target_key] = PreparedTarget(target_key, Image.fromarray(array))
+                while len(targets) > max(TARGET_CACHE_SIZE, 1):
+                    targets.popitem(last=False)
+                conn.send(("ok", None))
+            else:
+                conn.send(("error", f"unknown op: {op}"))
+        except Exception as exc:
+            conn.send(("error", str(exc)))
+
+
+class _Worker:
+    def __init__(self, index: int, lp_num_threads: int) -> None:
+        self.index = index
+        self.lp_num_threads = lp_num_threads
+        self.restarts = 0
+        self.process = None
+        self.conn = None
+        self.ready = False
+        self.shm = shared_memory.SharedMemory(create=True, size=RENDER_MAX_FRAMES * int(np.prod(FRAME_SHAPE)))
+        self.frames = _frames_view(self.shm)
+        self._start()
+
+    def _start(self) -> None:
+        ctx = mp.get_context("spawn")
+        parent_conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(
+            target=_worker_main,
+            args=(child_conn, self.lp_num_threads, self.shm.name),
+            name=f"render-worker-{self.index}",
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+        self.conn = parent_conn
+        self.ready = False
+
+    def _await_ready(self) -> None:
+        # Interpreter + GL context startup is not charged to the first job's timeout.
+        if self.ready:
+            return
+        if not self.conn.poll(WORKER_STARTUP_TIMEOUT_S):
+            self.restart()
+            raise RenderWorkerError("render worker failed to start in time")
+        status, value = self.conn.recv()
+        if status != "ready":
+            raise RenderWorkerError(f"render worker failed to start: {value}")
+        self.ready = True
+
+    def restart(self) -> None:
+        if self.process is not None and self.process.is_alive():
+            self.process.kill()
+        if self.process is not None:
+            self.process.join(timeout=5)
+        if self.conn is not None:
+            self.conn.close()
+        self.restarts += 1
+        self._start()
+
+    def call(self, op: str, args: Any, timeout: float) -> Any:
+        try:
+            self._await_ready()
+            self.conn.send((op, args))
+            if not self.conn.poll(timeout):
+                self.restart()
+                raise RenderTimeout(f"render exceeded {timeout:.1f}s wall-clock limit; worker restarted")
+            status, value = self.conn.recv()
+        except (EOFError, BrokenPipeError, ConnectionResetError) as exc:
+            self.restart()
+            raise RenderWorkerError(f"render worker died: {exc!r}") from exc
+        if status == "error":
+            raise RuntimeError(value)
+        if status == "need_target":
+            raise KeyError(args[0])
+        if status == "shm":
+            return self.frames[:value].copy()
+        return value
+
+    def stop(self) -> None:
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(timeout=2)
+        if self.process.is_alive():
+            self.process.kill()
+        self.conn.close()
+        del self.frames
+        self.shm.close()
+        self.shm.unlink()
+
+
+class RenderPool:
+    """Process pool that renders shaders out of the server process.
+
+    Each worker owns its own ShaderRenderer (GL context + program cache). Jobs
+    are served FIFO from one shared queue, so concurrent runs interleave
+    fairly. A job that exceeds its wall-clock budget (e.g. an unbounded loop
+    in an LLM-written shader) gets its worker killed and respawned.
+    """
+
+    def __init__(self, workers: int = RENDER_WORKERS, timeout: float = RENDER_TIMEOUT_S) -> None:
+        self.timeout = timeout
+        self._jobs: queue.Queue = queue.Queue()
+        self.stats = {"jobs": 0, "timeouts": 0, "crashes": 0}
+        self._stats_lock = threading.Lock()
+
+        lp_num_threads = max((os.cpu_count() or 1) // max(workers, 1), 1)
+        self._workers = [_Worker(i, lp_num_threads) for i in range(workers)]
+        self._known_targets: list[set[str]] = [set() for _ in self._workers]
+        self._threads = [
+            threading.Thread(target=self._serve, args=(i,), name=f"render-dispatch-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for t in self._threads:
+            t.start()
+
+    def _count(self, key: str) -> None:
+        with self._stats_lock:
+            self.stats[key] += 1
+
+    def _render_on(
+        self,
+        index: int,
+        target: PreparedTarget,
+        fragment_shader: str,
+        num_frames: int,
+        uniforms: Uniforms | None,
+        timeout: float,
+    ) -> np.ndarray:
+        worker = self._workers[index]
+        known = self._known_targets[index]
+        restarts = worker.restarts
+        try:
+            for _ in range(2):
+                if target.key not in known:
+                    worker.call("target", (target.key, target.array), timeout)
+                    known.add(target.key)
+                try:
+                    return worker.call("render", (target.key, fragment_shader, num_frames, uniforms), timeout)
+                except KeyError:
+                    known.discard(target.key)
+            raise RenderWorkerError("render worker lost the target texture")
+        finally:
+            if worker.restarts != restarts:
+                known.clear()
+
+    def _serve(self, index: int) -> None:
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                break
+            future, op, args, timeout = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            self._count("jobs")
+            try:
+                if op == "render":
+                    result = self._render_on(index, *args, timeout)
+                else:
+                    result = self._workers[index].call(op, args, timeout)
+            except RenderTimeout as exc:
+                self._count("timeouts")
+                future.set_exception(exc)
+            except RenderWorkerError as exc:
+                self._count("crashes")
+                future.set_exception(exc)
+            except Exception as exc:
+                future.set_exception(exc)
+            else:
+                future.set_result(result)
+
+    def submit(
+        self,
+        *,
+        input_img: Image.Image | PreparedTarget,
+        fragment_shader: str,
+        num_frames: int = 1,
+        timeout: float | None = None,
+        uniforms: Uniforms | None = None,
+    ) -> "Future[np.ndarray]":
+        """Queue a render; the future resolves to a (N, H, W, 3) uint8 array."""
+        future: "Future[np.ndarray]" = Future()
+        uniforms = {name: [float(v) for v in np.ravel(value)] for name, value in uniforms.items()} if uniforms else None
+        args = (prepare_target(input_img), fragment_shader, num_frames, uniforms)
+        self._jobs.put((future, "render", args, timeout or self.timeout))
+        return future
+
+    def render_array(self, **kwargs) -> np.ndarray:
+        return self.submit(**kwargs).result()
+
+    def render(self, **kwargs) -> list[Image.Image]:
+        return [Image.fromarray(frame) for frame in self.render_array(**kwargs)]
+
+    def submit_validate(self, fragment_shader: str, timeout: float | None = None) -> "Future[CompileResult]":
+        future: "Future[CompileResult]" = Future()
+        self._jobs.put((future, "validate", fragment_shader, timeout or self.timeout))
+        return future
+
+    def validate(self, fragment_shader: str, timeout: float | None = None) -> CompileResult:
+        """Compile-only check on whichever worker is free; the render may land on another one and compile again."""
+        return self.submit_validate(fragment_shader, timeout).result()
+
+    def warmup(self, fragment_shader: str) -> None:
+        """Start every worker (interpreter + GL context) and compile `fragment_shader` on each.
+
+        One job per worker is queued at once; an idle dispatcher blocks on its
+        own worker's startup, so the jobs spread across all workers.
+        """
+        futures = []
+        for _ in self._workers:
+            future: "Future[CompileResult]" = Future()
+            self._jobs.put((future, "validate", fragment_shader, WORKER_STARTUP_TIMEOUT_S))
+            futures.append(future)
+        for future in futures:
+            future.result()
+
+    def queue_depth(self) -> int:
+        return self._jobs.qsize()
+
+    def snapshot(self) -> dict[str, Any]:
+        with self._stats_lock:
+            stats = dict(self.stats)
+        return {
+            **stats,
+            "workers": len(self._workers),
+            "alive": sum(1 for w in self._workers if w.process.is_alive()),
+            "restarts": sum(w.restarts for w in self._workers),
+            "queue_depth": self.queue_depth(),
+        }
+
+    def shutdown(self) -> None:
+        for _ in self._threads:
+            self._jobs.put(None)
+        for t in self._threads:
+            t.join(timeout=5)
+        for worker in self._workers:
+            worker.stop()
+
+
+_pool: RenderPool | None = None
+_pool_lock = threading.Lock()
+
+
+def get_render_pool() -> RenderPool | None:
+    """Return the shared pool, or None when RENDER_WORKERS=0 (render in-process, without RENDER_TIMEOUT_S)."""
+    global _pool
+    if RENDER_WORKERS <= 0:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = RenderPool()
+        return _pool
+
+
+def shutdown_render_pool() -> None:
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown()
+            _pool = None
+
+
+def warmup_renderer(fragment_shader: str) -> float:
+    """Bring up the pool (or the in-process context) before traffic; return elapsed ms."""
+    start = time.perf_counter()
+    pool = get_render_pool()
+    if pool is None:
+        _validate_local(fragment_shader)
+    else:
+        pool.warmup(fragment_shader)
+    return (time.perf_counter() - start) * 1000
+
+
+def validate_shader(source: str) -> CompileResult:
+    """Drop-in for backend.render.validate_shader that compiles on the pool."""
+    pool = get_render_pool()
+    if pool is None:
+        return _validate_local(source)
+    return pool.validate(source)
+
+
+def render_frames_array(
+    *,
+    input_img: Image.Image | PreparedTarget,
+    fragment_shader: str,
+    num_frames: int = 1,
+    timeout: float | None = None,
+) -> np.ndarray:
+    """Render in memory on the pool (or in-process when RENDER_WORKERS=0) into a (N, H, W, 3) array."""
+    pool = get_render_pool()
+    if pool is None:
+        return get_renderer().render_array(input_img=input_img, fragment_shader=fragment_shader, num_frames=num_frames)
+    return pool.render_array(input_img=input_img, fragment_shader=fragment_shader, num_frames=num_frames, timeout=timeout)
+
+
+async def avalidate_shader(source: str) -> CompileResult:
+    """Awaitable validate_shader; cancelling it drops the job if no worker has picked it up yet."""
+    pool = get_render_pool()
+    if pool is None:
+        return await asyncio.to_thread(_validate_local, source)
+    return await asyncio.wrap_future(pool.submit_validate(source))
+
+
+async def arender_frames_array(
+    *,
+    input_img: Image.Image | PreparedTarget,
+    fragment_shader: str,
+    num_frames: int = 1,
+    timeout: float | None = None,
+    uniforms: Uniforms | None = None,
+) -> np.ndarray:
+    """Awaitable render_frames_array; cancelling it drops the job if no worker has picked it up yet.
+
+    Renders from every run share the `render` stage limit, so one run's beam or
+    tuning batch can't fill the pool queue ahead of everyone else.
+    """
+    async with stage("render"):
+        pool = get_render_pool()
+        if pool is None:
+            return await asyncio.to_thread(
+                get_renderer().render_array,
+                input_img=input_img,
+                fragment_shader=fragment_shader,
+                num_frames=num_frames,
+                uniforms=uniforms,
+            )
+        future = pool.submit(
+            input_img=input_img, fragment_shader=fragment_shader, num_frames=num_frames, timeout=timeout, uniforms=uniforms
+        )
+        return await asyncio.wrap_future(future)
+
+
+def render_frames(
+    *,
+    input_img: Image.Image | PreparedTarget,
+    fragment_shader: str,
+    num_frames: int = 1,
+    timeout: float | None = None,
+) -> list[Image.Image]:
+    frames = render_frames_array(
+        input_img=input_img, fragment_shader=fragment_shader, num_frames=num_frames, timeout=timeout
+    )
+    return [Image.fromarray(frame) for frame in frames]
+
+
+def render_iteration_frames(
+    *,
+    input_img: Image.Image | PreparedTarget,
+    iteration: int,
+    total_iterations: int,
+    fragment_shader: str,
+    output_dir: Path,
+    num_frames: int = 1,
+    timeout: float | None = None,
+) -> tuple[list[Path], str, list[Image.Image], Image.Image]:
+    """Drop-in for backend.render.render_iteration_frames that renders on the pool."""
+    target = prepare_target(input_img)
+    render_imgs = render_frames(
+        input_img=target, fragment_shader=fragment_shader, num_frames=num_frames, timeout=timeout
+    )
+    render_paths = save_iteration_frames(render_imgs, iteration=iteration, output_dir=output_dir)
+    return render_paths, fragment_shader, render_imgs, target.image
@@ -0,0 +1,284 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, AsyncIterator
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+RUNS_DB_PATH = Path(os.getenv("RUNS_DB_PATH", str(BASE_DIR / "data" / "runs.sqlite3")))
+RUNS_MAX_ENTRIES = int(os.getenv("RUNS_MAX_ENTRIES", "500"))  # oldest runs (and their events) beyond this are pruned
+
+RUN_STATUSES = ("running", "done", "failed", "interrupted")
+CHECKPOINT = "checkpoint"  # pseudo-event a run yields to save resumable state; stored, never streamed
+
+Event = tuple[int, str, dict]
+
+
+def format_event(seq: int, event: str, data: dict) -> str:
+    """SSE frame with `id:` set to the event's sequence number, for `Last-Event-ID` / `?since=` replay."""
+    return f"id: {seq}\nevent: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+class RunStore:
+    """SQLite record of every run: its request, event log and a checkpoint after each completed iteration.
+
+    The checkpoint (discovery result plus the loop state: best result,
+    previous shader and critique, last shader that compiled) is what lets an
+    interrupted run resume at its next iteration without redoing discovery
+    or earlier iterations.
+    """
+
+    def __init__(self, path: Path = RUNS_DB_PATH, max_entries: int = RUNS_MAX_ENTRIES) -> None:
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS runs ("
+            " run_id TEXT PRIMARY KEY, status TEXT NOT NULL, payload TEXT NOT NULL, input_image TEXT,"
+            " discovery TEXT, state TEXT, completed INTEGER NOT NULL DEFAULT 0, checkpoint_seq INTEGER NOT NULL DEFAULT 0,"
+            " error TEXT,"
+            " created REAL NOT NULL, updated REAL NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS events ("
+            " run_id TEXT NOT NULL, seq INTEGER NOT NULL, event TEXT NOT NULL, data TEXT NOT NULL,"
+            " PRIMARY KEY (run_id, seq))"
+        )
+        # Whatever was running when the last process exited can only be resumed now.
+        with self._lock:
+            stale = self._db.execute(
+                "UPDATE runs SET status = 'interrupted', updated = ? WHERE status = 'running'", (time.time(),)
+            ).rowcount
+        if stale:
+            print(f"[runs] marked {stale} unfinished run(s) interrupted")
+
+    def create(self, run_id: str, payload: dict[str, Any], input_image: str) -> None:
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO runs (run_id, status, payload, input_image, created, updated) VALUES (?, 'running', ?, ?, ?, ?)",
+                (run_id, json.dumps(payload), input_image, now, now),
+            )
+            old = [
+                row[0]
+                for row in self._db.execute(
+                    "SELECT run_id FROM runs ORDER BY created DESC LIMIT -1 OFFSET ?", (max(self.max_entries, 1),)
+                )
+            ]
+            for stale_id in old:
+                self._db.execute("DELETE FROM events WHERE run_id = ?", (stale_id,))
+                self._db.execute("DELETE FROM runs WHERE run_id = ?", (stale_id,))
+
+    def set_status(self, run_id: str, status: str, error: str = "") -> None:
+        with self._lock:
+            self._db.execute(
+                "UPDATE runs SET status = ?, error = ?, updated = ? WHERE run_id = ?", (status, error, time.time(), run_id)
+            )
+
+    def checkpoint(
+        self,
+        run_id: str,
+        seq: int,
+        *,
+        discovery: dict[str, Any] | None = None,
+        completed: int | None = None,
+        state: dict[str, Any] | None = None,
+    ) -> None:
+        """Save resumable state as of event `seq`; fields left as None keep their stored value."""
+        with self._lock:
+            self._db.execute(
+                "UPDATE runs SET checkpoint_seq = ?, discovery = COALESCE(?, discovery),"
+                " completed = COALESCE(?, completed), state = COALESCE(?, state), updated = ? WHERE run_id = ?",
+                (
+                    seq,
+                    json.dumps(discovery) if discovery is not None else None,
+                    completed,
+                    json.dumps(state) if state is not None else None,
+                    time.time(),
+                    run_id,
+                ),
+            )
+
+    def rewind(self, run_id: str) -> list[Event]:
+        """Drop events after the last checkpoint (a partly finished iteration) and return the rest."""
+        with self._lock:
+            self._db.execute(
+                "DELETE FROM events WHERE run_id = ? AND seq > (SELECT checkpoint_seq FROM runs WHERE run_id = ?)",
+                (run_id, run_id),
+            )
+        return self.events(run_id)
+
+    def append_event(self, run_id: str, seq: int, event: str, data: dict) -> None:
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO events (run_id, seq, event, data) VALUES (?, ?, ?, ?)",
+                (run_id, seq, event, json.dumps(data)),
+            )
+
+    def events(self, run_id: str, since: int = 0) -> list[Event]:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT seq, event, data FROM events WHERE run_id = ? AND seq > ? ORDER BY seq", (run_id, since)
+            ).fetchall()
+        return [(seq, event, json.loads(data)) for seq, event, data in rows]
+
+    def get(self, run_id: str) -> dict[str, Any] | None:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT status, payload, input_image, discovery, state, completed, error, created, updated,"
+                " (SELECT COUNT(*) FROM events WHERE events.run_id = runs.run_id)"
+                " FROM runs WHERE run_id = ?",
+                (run_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        status, payload, input_image, discovery, state, completed, error, created, updated, num_events = row
+        return {
+            "run_id": run_id,
+            "status": status,
+            "payload": json.loads(payload),
+            "input_image": input_image,
+            "discovery": json.loads(discovery) if discovery else None,
+            "state": json.loads(state) if state else None,
+            "completed": completed,
+            "error": error or "",
+            "created": created,
+            "updated": updated,
+            "events": num_events,
+        }
+
+    def snapshot(self) -> dict[str, int]:
+        with self._lock:
+            counts = dict(self._db.execute("SELECT status, COUNT(*) FROM runs GROUP BY status").fetchall())
+        return {status: counts.get(status, 0) for status in RUN_STATUSES}
+
+
+class RunJob:
+    """One run executing as a server-side task, independent of any SSE connection.
+
+    Events from `source` are numbered, appended to the store and kept in
+    memory; CHECKPOINT items are saved against the current sequence number.
+    Any number of followers can stream events from a sequence number and
+    then wait for new ones. The job ends with `done`, `failed` or, when
+    cancelled, `interrupted`.
+    """
+
+    def __init__(self, run_id: str, store: RunStore, history: list[Event] | None = None, detached: bool = False) -> None:
+        self.run_id = run_id
+        self.store = store
+        self.detached = detached
+        self.events: list[Event] = list(history or [])
+        self.status = "running"
+        self.task: asyncio.Task | None = None
+        self._changed = asyncio.Condition()
+
+    @property
+    def finished(self) -> bool:
+        return self.status != "running"
+
+    @property
+    def last_seq(self) -> int:
+        return self.events[-1][0] if self.events else 0
+
+    def start(self, source: AsyncIterator[tuple[str, dict]]) -> None:
+        register_job(self)
+        self.task = asyncio.ensure_future(self._drive(source))
+
+    async def append(self, event: str, data: dict) -> None:
+        seq = self.last_seq + 1
+        await asyncio.to_thread(self.store.append_event, self.run_id, seq, event, data)
+        async with self._changed:
+            self.events.append((seq, event, data))
+            self._changed.notify_all()
+
+    async def _drive(self, source: AsyncIterator[tuple[str, dict]]) -> None:
+        status, error = "done", ""
+        try:
+            async for event, data in source:
+                if event == CHECKPOINT:
+                    await asyncio.to_thread(self.store.checkpoint, self.run_id, self.last_seq, **data)
+                else:
+                    await self.append(event, data)
+        except asyncio.CancelledError:
+            status = "interrupted"
+            raise
+        except Exception as exc:
+            status, error = "failed", f"{type(exc).__name__}: {exc}"
+            print(f"[runs] {self.run_id} failed: {error}")
+            await self.append("error", {"run_id": self.run_id, "error": error})
+        finally:
+            await asyncio.to_thread(self.store.set_status, self.run_id, status, error)
+            unregister_job(self)
+            async with self._changed:
+                self.status = status
+                self._changed.notify_all()
+
+    def cancel(self) -> None:
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+
+    async def follow(self, since: int = 0, owner: bool = False) -> AsyncIterator[str]:
+        """SSE frames after `since`, live until the job finishes.
+
+        When the owning stream (the request that started the run) goes away
+        the job is cancelled, unless it was started detached.
+        """
+        cursor = next((k for k, (seq, _, _) in enumerate(self.events) if seq > since), len(self.events))
+        try:
+            while True:
+                while cursor < len(self.events):
+                    yield format_event(*self.events[cursor])
+                    cursor += 1
+                if self.finished:
+                    return
+                async with self._changed:
+                    await self._changed.wait_for(lambda: cursor < len(self.events) or self.finished)
+        finally:
+            if owner and not self.finished:
+                if self.detached:
+                    print(f"[runs] {self.run_id} detached; still running")
+                else:
+                    self.cancel()
+
+
+_store: RunStore | None = None
+_store_lock = threading.Lock()
+_jobs: dict[str, RunJob] = {}
+
+
+def get_run_store() -> RunStore:
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = RunStore()
+        return _store
+
+
+def register_job(job: RunJob) -> None:
+    with _store_lock:
+        _jobs[job.run_id] = job
+
+
+def unregister_job(job: RunJob) -> None:
+    with _store_lock:
+        if _jobs.get(job.run_id) is job:
+            del _jobs[job.run_id]
+
+
+def get_job(run_id: str) -> RunJob | None:
+    with _store_lock:
+        return _jobs.get(run_id)
+
+
+def runs_snapshot() -> dict[str, Any]:
+    with _store_lock:
+        live = len(_jobs)
+    return {"live": live, **get_run_store().snapshot()}
@@ -0,0 +1,455 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from typing import AsyncIterator, Iterator
+
+RUN_MAX_CONCURRENT = int(os.getenv("RUN_MAX_CONCURRENT", "4"))
+RUN_QUEUE_MAX = int(os.getenv("RUN_QUEUE_MAX", "16"))  # waiting runs beyond this get 429
+RUN_QUEUE_POLL_S = 5.0  # queued runs re-report their position at least this often
+
+# Per-stage concurrency across all runs; 0 leaves a stage unbounded.
+STAGE_LIMITS = {
+    "render": int(os.getenv("STAGE_RENDER_CONCURRENCY", "8")),
+    "lpips": int(os.getenv("STAGE_LPIPS_CONCURRENCY", "2")),
+    "llm": int(os.getenv("STAGE_LLM_CONCURRENCY", "8")),
+    "vlm": int(os.getenv("STAGE_VLM_CONCURRENCY", "4")),
+}
+
+OPENAI_RPM = float(os.getenv("OPENAI_RPM", "0"))  # requests per minute; 0 disables
+OPENAI_TPM = float(os.getenv("OPENAI_TPM", "0"))  # tokens per minute; 0 disables
+OPENAI_COMPLETION_ESTIMATE = 1024  # tokens reserved for a reply until the real usage is known
+_IMAGE_TOKENS = 800
+
+
+class QueueFull(Exception):
+    """The run queue is at RUN_QUEUE_MAX; the caller should back off (HTTP 429)."""
+
+    def __init__(self, retry_after: float) -> None:
+        super().__init__("run queue is full")
+        self.retry_after = retry_after
+
+
+class RunTicket:
+    """A run's place in the scheduler: queued until a slot frees up, then running until released."""
+
+    def __init__(self, scheduler: RunScheduler, run_id: str) -> None:
+        self.scheduler = scheduler
+        self.run_id = run_id
+        self.created = time.monotonic()
+        self.started: float | None = None
+        self.released = False
+        self._changed = asyncio.Event()
+
+    @property
+    def position(self) -> int:
+        """1-based place in the queue, 0 once running."""
+        return self.scheduler._position(self)
+
+    @property
+    def waited_ms(self) -> float:
+        return ((self.started or time.monotonic()) - self.created) * 1000
+
+    async def wait_changed(self, timeout: float = RUN_QUEUE_POLL_S) -> None:
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._changed.clear()
+
+    def release(self) -> None:
+        self.scheduler._release(self)
+
+
+class RunScheduler:
+    """FIFO admission for runs: at most `max_running` at once and `max_queued` waiting.
+
+    Admission is synchronous so the endpoint can answer 429 before it starts
+    streaming. Queued tickets are woken whenever the queue moves, so each
+    stream can report its position.
+    """
+
+    def __init__(self, max_running: int = RUN_MAX_CONCURRENT, max_queued: int = RUN_QUEUE_MAX) -> None:
+        self.max_running = max(max_running, 1)
+        self.max_queued = max(max_queued, 0)
+        self._lock = threading.Lock()
+        self._running: set[RunTicket] = set()
+        self._queue: deque[RunTicket] = deque()
+        self._run_ms: deque[float] = deque(maxlen=32)
+        self.stats = {"admitted": 0, "queued": 0, "rejected": 0, "completed": 0, "max_queue_depth": 0}
+
+    def admit(self, run_id: str) -> RunTicket:
+        ticket = RunTicket(self, run_id)
+        with self._lock:
+            if len(self._running) < self.max_running and not self._queue:
+                ticket.started = time.monotonic()
+                self._running.add(ticket)
+                self.stats["admitted"] += 1
+                return ticket
+            if len(self._queue) >= self.max_queued:
+                self.stats["rejected"] += 1
+                raise QueueFull(self._retry_after())
+            self._queue.append(ticket)
+            self.stats["queued"] += 1
+            self.stats["max_queue_depth"] = max(self.stats["max_queue_depth"], len(self._queue))
+        return ticket
+
+    def _retry_after(self) -> float:
+        """Rough seconds until a queue slot frees: recent mean run time over the number of run slots."""
+        mean_s = sum(self._run_ms) / len(self._run_ms) / 1000 if self._run_ms else 30.0
+        return round(max(mean_s / self.max_running, 1.0), 1)
+
+    def _position(self, ticket: RunTicket) -> int:
+        with self._lock:
+            if ticket in self._running or ticket.released:
+                return 0
+            try:
+                return self._queue.index(ticket) + 1
+            except ValueError:
+                return 0
+
+    def _release(self, ticket: RunTicket) -> None:
+        with self._lock:
+            if ticket.released:
+                return
+            ticket.released = True
+            if ticket in self._running:
+                self._running.discard(ticket)
+                self.stats["completed"] += 1
+                self._run_ms.append((time.monotonic() - (ticket.started or ticket.created)) * 1000)
+            else:
+                try:
+                    self._queue.remove(ticket)
+                except ValueError:
+                    pass
+            woken = []
+            while self._queue and len(self._running) < self.max_running:
+                nxt = self._queue.popleft()
+                nxt.started = time.monotonic()
+                self._running.add(nxt)
+                self.stats["admitted"] += 1
+                woken.append(nxt)
+            # Admitted tickets start; the rest move up a place.
+            woken.extend(self._queue)
+        for other in woken:
+            other._changed.set()
+
+    def snapshot(self) -> dict[str, object]:
+        with self._lock:
+            return {
+                **self.stats,
+                "running": len(self._running),
+                "queue_depth": len(self._queue),
+                "max_running": self.max_running,
+                "max_queued": self.max_queued,
+            }
+
+
+class _Slots:
+    """A counting semaphore shared by threads and by coroutines on any event loop.
+
+    Free slots are handed to waiters in arrival order, whether they block in
+    a thread (`acquire_sync`) or await on a loop (`acquire`), so one limit
+    covers both kinds of caller.
+    """
+
+    def __init__(self, limit: int) -> None:
+        self.free = limit
+        self._lock = threading.Lock()
+        self._waiters: deque[threading.Event | tuple[asyncio.AbstractEventLoop, asyncio.Future]] = deque()
+
+    def acquire_sync(self) -> None:
+        with self._lock:
+            if self.free > 0 and not self._waiters:
+                self.free -= 1
+                return
+            event = threading.Event()
+            self._waiters.append(event)
+        event.wait()  # set by release(), which hands its slot straight over
+
+    async def acquire(self) -> None:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self.free > 0 and not self._waiters:
+                self.free -= 1
+                return
+            waiter = (loop, loop.create_future())
+            self._waiters.append(waiter)
+        try:
+            await waiter[1]
+        except asyncio.CancelledError:
+            with self._lock:
+                queued = waiter in self._waiters
+                if queued:
+                    self._waiters.remove(waiter)
+            # A slot handed over before the cancellation landed goes back; one still in flight
+            # is returned by _grant when it finds the future cancelled.
+            if not queued and waiter[1].done() and not waiter[1].cancelled():
+                self.release()
+            raise
+
+    def _grant(self, future: asyncio.Future) -> None:
+        if future.cancelled():
+            self.release()
+        else:
+            future.set_result(None)
+
+    def release(self) -> None:
+        with self._lock:
+            while self._waiters:
+                waiter = self._waiters.popleft()
+                if isinstance(waiter, threading.Event):
+                    waiter.set()
+                    return
+                loop, future = waiter
+                try:
+                    loop.call_soon_threadsafe(self._grant, future)
+                    return
+                except RuntimeError:  # that loop has closed; try the next waiter
+                    continue
+            self.free += 1
+
+
+class StageLimiter:
+    """Named concurrency limits (render, lpips, llm, vlm) shared by every run.
+
+    `stage` is for coroutines and `stage_sync` for blocking callers in
+    threads; both draw from the same slots, so a limit holds across
+    event loops and threads together.
+    """
+
+    def __init__(self, limits: dict[str, int] = STAGE_LIMITS) -> None:
+        self.limits = dict(limits)
+        self._slots = {name: _Slots(limit) for name, limit in self.limits.items() if limit > 0}
+        self._lock = threading.Lock()
+        self._active = dict.fromkeys(self.limits, 0)
+        self._waits = {name: {"count": 0, "waited": 0, "wait_ms": 0.0} for name in self.limits}
+
+    def _enter(self, name: str, start: float) -> None:
+        wait_ms = (time.perf_counter() - start) * 1000
+        with self._lock:
+            self._active[name] = self._active.get(name, 0) + 1
+            waits = self._waits.setdefault(name, {"count": 0, "waited": 0, "wait_ms": 0.0})
+            waits["count"] += 1
+            waits["waited"] += int(wait_ms > 1.0)
+            waits["wait_ms"] += wait_ms
+
+    def _leave(self, name: str) -> None:
+        with self._lock:
+            self._active[name] -= 1
+
+    @asynccontextmanager
+    async def stage(self, name: str) -> AsyncIterator[None]:
+        slots = self._slots.get(name)
+        start = time.perf_counter()
+        if slots is not None:
+            await slots.acquire()
+        self._enter(name, start)
+        try:
+            yield
+        finally:
+            self._leave(name)
+            if slots is not None:
+                slots.release()
+
+    @contextmanager
+    def stage_sync(self, name: str) -> Iterator[None]:
+        slots = self._slots.get(name)
+        start = time.perf_counter()
+        if slots is not None:
+            slots.acquire_sync()
+        self._enter(name, start)
+        try:
+            yield
+        finally:
+            self._leave(name)
+            if slots is not None:
+                slots.release()
+
+    def snapshot(self) -> dict[str, dict[str, object]]:
+        with self._lock:
+            return {
+                name: {
+                    "limit": self.limits.get(name, 0) or None,
+                    "active": self._active.get(name, 0),
+                    "count": waits["count"],
+                    "waited": waits["waited"],
+                    "wait_ms": round(waits["wait_ms"], 1),
+                }
+                for name, waits in self._waits.items()
+            }
+
+
+class TokenBucket:
+    """Refills at `per_minute` / 60 per second up to one minute's worth.
+
+    `reserve` always succeeds and returns how long the caller must wait: the
+    balance may go negative, which queues later callers behind it in order.
+    `adjust` settles a reservation once the real cost is known.
+    """
+
+    def __init__(self, per_minute: float) -> None:
+        self.per_minute = per_minute
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.per_minute > 0
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.per_minute / 60.0)
+        self.updated = now
+
+    def reserve(self, amount: float) -> float:
+        if not self.enabled:
+            return 0.0
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens -= min(amount, self.capacity)
+            return 0.0 if self.tokens >= 0 else -self.tokens * 60.0 / self.per_minute
+
+    def adjust(self, delta: float) -> None:
+        """Charge (positive) or refund (negative) tokens after the fact."""
+        if not self.enabled or not delta:
+            return
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.capacity, self.tokens - delta)
+
+    def snapshot(self) -> dict[str, float] | None:
+        if not self.enabled:
+            return None
+        with self._lock:
+            self._refill(time.monotonic())
+            return {"per_minute": self.per_minute, "available": round(self.tokens, 1)}
+
+
+def estimate_tokens(messages: list[dict]) -> int:
+    """Prompt tokens at ~4 characters each plus a flat cost per image, and a reply allowance."""
+    chars, images = 0, 0
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, str):
+            chars += len(content)
+            continue
+        for part in content or []:
+            if part.get("type") == "image_url":
+                images += 1
+            else:
+                chars += len(part.get("text", ""))
+    return chars // 4 + images * _IMAGE_TOKENS + OPENAI_COMPLETION_ESTIMATE
+
+
+def has_image(messages: list[dict]) -> bool:
+    return any(
+        isinstance(m.get("content"), list) and any(p.get("type") == "image_url" for p in m["content"]) for m in messages
+    )
+
+
+class RateLimiter:
+    """OpenAI RPM + TPM buckets; `acquire` returns the token reservation to settle with `settle`."""
+
+    def __init__(self, rpm: float = OPENAI_RPM, tpm: float = OPENAI_TPM) -> None:
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self._lock = threading.Lock()
+        self.stats = {"calls": 0, "throttled": 0, "throttled_ms": 0.0}
+
+    def _reserve(self, estimate: int) -> float:
+        delay = max(self.requests.reserve(1), self.tokens.reserve(estimate))
+        with self._lock:
+            self.stats["calls"] += 1
+            if delay > 0:
+                self.stats["throttled"] += 1
+                self.stats["throttled_ms"] += delay * 1000
+        return delay
+
+    async def acquire(self, messages: list[dict]) -> int:
+        estimate = estimate_tokens(messages)
+        delay = self._reserve(estimate)
+        if delay > 0:
+            try:
+                await asyncio.sleep(delay)
+            except BaseException:  # cancelled while throttled: the call never happens
+                self.refund(estimate)
+                raise
+        return estimate
+
+    def acquire_sync(self, messages: list[dict]) -> int:
+        estimate = estimate_tokens(messages)
+        delay = self._reserve(estimate)
+        if delay > 0:
+            try:
+                time.sleep(delay)
+            except BaseException:
+                self.refund(estimate)
+                raise
+        return estimate
+
+    def settle(self, estimate: int, used: int | None) -> None:
+        if used:
+            self.tokens.adjust(used - estimate)
+
+    def refund(self, estimate: int) -> None:
+        """Give back a reservation whose request failed before any tokens were used."""
+        self.tokens.adjust(-estimate)
+
+    def snapshot(self) -> dict[str, object]:
+        with self._lock:
+            stats = {**self.stats, "throttled_ms": round(self.stats["throttled_ms"], 1)}
+        return {**stats, "rpm": self.requests.snapshot(), "tpm": self.tokens.snapshot()}
+
+
+_scheduler: RunScheduler | None = None
+_stages: StageLimiter | None = None
+_rate_limiter: RateLimiter | None = None
+_singletons_lock = threading.Lock()
+
+
+def get_run_scheduler() -> RunScheduler:
+    global _scheduler
+    with _singletons_lock:
+        if _scheduler is None:
+            _scheduler = RunScheduler()
+        return _scheduler
+
+
+def get_stage_limiter() -> StageLimiter:
+    global _stages
+    with _singletons_lock:
+        if _stages is None:
+            _stages = StageLimiter()
+        return _stages
+
+
+def get_rate_limiter() -> RateLimiter:
+    global _rate_limiter
+    with _singletons_lock:
+        if _rate_limiter is None:
+            _rate_limiter = RateLimiter()
+        return _rate_limiter
+
+
+def stage(name: str):
+    """`async with stage("render"): ...` — shorthand for the shared StageLimiter."""
+    return get_stage_limiter().stage(name)
+
+
+def stage_sync(name: str):
+    """`with stage_sync("llm"): ...` — the blocking counterpart of `stage`."""
+    return get_stage_limiter().stage_sync(name)
+
+
+def scheduler_snapshot() -> dict[str, object]:
+    return {
+        "runs": get_run_scheduler().snapshot(),
+        "stages": get_stage_limiter().snapshot(),
+        "rate_limit": get_rate_limiter().snapshot(),
+    }
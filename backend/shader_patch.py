@@ -0,0 +1,104 @@
+from __future__ import annotations
+
+import threading
+from dataclasses import dataclass, field
+from typing import Any
+
+EDIT_MODES = ("rewrite", "patch", "auto")
+
+_stats = {"attempts": 0, "applied": 0, "fallbacks": 0, "edits": 0}
+_stats_lock = threading.Lock()
+
+
+@dataclass
+class PatchResult:
+    source: str | None
+    applied: int = 0
+    failed: list[dict[str, Any]] = field(default_factory=list)
+
+    @property
+    def ok(self) -> bool:
+        return self.source is not None
+
+
+def normalize_edits(raw: object) -> list[dict[str, str]]:
+    """Keep only well-formed {search, replace} objects from the model's `edits` list."""
+    if not isinstance(raw, list):
+        return []
+    edits = []
+    for item in raw:
+        if isinstance(item, dict) and isinstance(item.get("search"), str) and isinstance(item.get("replace"), str):
+            edits.append({"search": item["search"], "replace": item["replace"]})
+    return edits
+
+
+def _indent(line: str) -> str:
+    return line[: len(line) - len(line.lstrip())]
+
+
+def _replace_lines(source: str, search: str, replace: str) -> str | None:
+    """Whitespace-tolerant fallback: match `search` line-by-line on stripped lines; must be unique."""
+    needle = [line.strip() for line in search.strip("\n").splitlines()]
+    if not needle or not any(needle):
+        return None
+    lines = source.splitlines()
+    stripped = [line.strip() for line in lines]
+    n = len(needle)
+    hits = [idx for idx in range(len(lines) - n + 1) if stripped[idx : idx + n] == needle]
+    if len(hits) != 1:
+        return None
+    idx = hits[0]
+    # Shift the replacement by however much indentation the model dropped from its search text.
+    given = search.strip("\n").splitlines()[0]
+    shift = _indent(lines[idx])[len(_indent(given)) :] if _indent(lines[idx]).startswith(_indent(given)) else ""
+    lines[idx : idx + n] = [shift + line if line.strip() else line for line in replace.strip("\n").splitlines()]
+    return "\n".join(lines) + ("\n" if source.endswith("\n") else "")
+
+
+def apply_edits(shader: str, edits: list[dict[str, str]]) -> PatchResult:
+    """Apply search/replace edits in order.
+
+    Each search must occur exactly once (exactly, or line-by-line ignoring
+    indentation). Any miss, ambiguity or a result without `#version` / `main`
+    rejects the whole patch so the caller can fall back to a full rewrite.
+    """
+    if not edits:
+        return PatchResult(source=None, failed=[{"reason": "no edits"}])
+    source = shader
+    result = PatchResult(source=None)
+    for idx, edit in enumerate(edits):
+        search, replace = edit["search"], edit["replace"]
+        count = source.count(search) if search else 0
+        if count == 1:
+            source = source.replace(search, replace, 1)
+        elif count > 1:
+            result.failed.append({"index": idx, "reason": "ambiguous"})
+            continue
+        else:
+            patched = _replace_lines(source, search, replace)
+            if patched is None:
+                result.failed.append({"index": idx, "reason": "not found"})
+                continue
+            source = patched
+        result.applied += 1
+    if result.failed:
+        return result
+    if source == shader:
+        result.failed.append({"reason": "no change"})
+    elif "#version" not in source or "main" not in source:
+        result.failed.append({"reason": "patch removed #version or main()"})
+    else:
+        result.source = source
+    return result
+
+
+def record_patch(result: PatchResult) -> None:
+    with _stats_lock:
+        _stats["attempts"] += 1
+        _stats["edits"] += result.applied
+        _stats["applied" if result.ok else "fallbacks"] += 1
+
+
+def patch_stats() -> dict[str, int]:
+    with _stats_lock:
+        return dict(_stats)
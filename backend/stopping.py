@@ -0,0 +1,160 @@
+from __future__ import annotations
+
+import os
+import re
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any
+
+# Defaults for the per-run stopping policy; 0 disables each one.
+STOP_LPIPS_TARGET = float(os.getenv("STOP_LPIPS_TARGET", "0"))  # stop once the best LPIPS is at or below this
+STOP_PATIENCE = int(os.getenv("STOP_PATIENCE", "0"))  # iterations without a STOP_MIN_DELTA improvement before stopping
+STOP_MIN_DELTA = float(os.getenv("STOP_MIN_DELTA", "0.005"))
+STOP_SIMILARITY_TARGET = float(os.getenv("STOP_SIMILARITY_TARGET", "0"))  # VLM "SIMILARITY SCORE" (1-10)
+RUN_TIME_BUDGET_S = float(os.getenv("RUN_TIME_BUDGET_S", "0"))
+RUN_TOKEN_BUDGET = int(os.getenv("RUN_TOKEN_BUDGET", "0"))
+
+STOP_REASONS = ("iterations", "lpips_target", "similarity_target", "plateau", "time_budget", "token_budget")
+
+_SIMILARITY = re.compile(r"SIMILARITY SCORE\W*(\d+(?:\.\d+)?)(?:\s*/\s*10)?", re.I)
+
+_stats = dict.fromkeys(STOP_REASONS, 0)
+_stats_lock = threading.Lock()
+
+
+def parse_similarity(critique: str | None) -> float | None:
+    """The 1-10 `SIMILARITY SCORE` from a critique_images reply, or None when it is missing or out of range."""
+    match = _SIMILARITY.search(critique or "")
+    if match is None:
+        return None
+    value = float(match.group(1))
+    return value if 0 <= value <= 10 else None
+
+
+@dataclass
+class StopPolicy:
+    lpips_target: float = 0.0
+    patience: int = 0
+    min_delta: float = STOP_MIN_DELTA
+    similarity_target: float = 0.0
+    time_budget_s: float = 0.0
+    token_budget: int = 0
+
+    @classmethod
+    def from_request(cls, **overrides: Any) -> StopPolicy:
+        """Env defaults with the request's non-None fields on top."""
+        policy = cls(
+            lpips_target=STOP_LPIPS_TARGET,
+            patience=STOP_PATIENCE,
+            min_delta=STOP_MIN_DELTA,
+            similarity_target=STOP_SIMILARITY_TARGET,
+            time_budget_s=RUN_TIME_BUDGET_S,
+            token_budget=RUN_TOKEN_BUDGET,
+        )
+        for name, value in overrides.items():
+            if value is not None:
+                setattr(policy, name, value)
+        return policy
+
+
+class StopTracker:
+    """Decides when a run has converged or spent its budget.
+
+    `observe` runs after each iteration with the run's best LPIPS and the
+    critique's similarity score. `before_iteration` runs before each one: it
+    stops once the time or token budget is spent (discovery alone can spend
+    it before the first iteration), and after the first iteration also when
+    the mean cost of an iteration so far would overrun it, so a budget ends
+    the run between iterations rather than halfway through one. Elapsed time
+    and tokens carry over a resume through `to_state`.
+    """
+
+    def __init__(self, policy: StopPolicy, state: dict[str, Any] | None = None) -> None:
+        state = state or {}
+        self.policy = policy
+        self.reference: float | None = state.get("reference")
+        self.stale: int = state.get("stale", 0)
+        self.iterations: int = state.get("iterations", 0)
+        self.reason: str | None = state.get("reason")
+        self.similarity: float | None = state.get("similarity")
+        self._elapsed_before = state.get("elapsed_s", 0.0)
+        self._tokens_before = state.get("tokens", 0)
+        self._started = time.monotonic()
+        self._tokens = 0
+
+    @property
+    def elapsed_s(self) -> float:
+        return self._elapsed_before + time.monotonic() - self._started
+
+    @property
+    def tokens(self) -> int:
+        return self._tokens_before + self._tokens
+
+    def set_tokens(self, used: int) -> None:
+        """Tokens spent since this tracker was created (i.e. in this execution of the run)."""
+        self._tokens = used
+
+    def _stop(self, reason: str) -> str:
+        self.reason = reason
+        return reason
+
+    def before_iteration(self) -> str | None:
+        if self.reason:
+            return self.reason
+        policy = self.policy
+        if policy.time_budget_s > 0:
+            per_iteration = self.elapsed_s / self.iterations if self.iterations else 0.0
+            if self.elapsed_s + per_iteration >= policy.time_budget_s:
+                return self._stop("time_budget")
+        if policy.token_budget > 0:
+            per_iteration = self.tokens / self.iterations if self.iterations else 0
+            if self.tokens + per_iteration >= policy.token_budget:
+                return self._stop("token_budget")
+        return None
+
+    def observe(self, best_score: float | None, critique: str | None) -> str | None:
+        self.iterations += 1
+        policy = self.policy
+        self.similarity = parse_similarity(critique)
+        if best_score is not None and (self.reference is None or best_score < self.reference - policy.min_delta):
+            self.reference, self.stale = best_score, 0
+        else:
+            self.stale += 1
+
+        if policy.lpips_target > 0 and best_score is not None and best_score <= policy.lpips_target:
+            return self._stop("lpips_target")
+        if policy.similarity_target > 0 and self.similarity is not None and self.similarity >= policy.similarity_target:
+            return self._stop("similarity_target")
+        if policy.patience > 0 and self.stale >= policy.patience:
+            return self._stop("plateau")
+        return None
+
+    def to_state(self) -> dict[str, Any]:
+        return {
+            "reference": self.reference,
+            "stale": self.stale,
+            "iterations": self.iterations,
+            "reason": self.reason,
+            "similarity": self.similarity,
+            "elapsed_s": round(self.elapsed_s, 3),
+            "tokens": self.tokens,
+        }
+
+    def to_event(self, max_iterations: int) -> dict[str, Any]:
+        reason = self.reason or "iterations"
+        with _stats_lock:
+            _stats[reason] += 1
+        return {
+            "stop_reason": reason,
+            "iterations": self.iterations,
+            "max_iterations": max_iterations,
+            "elapsed_s": round(self.elapsed_s, 1),
+            "tokens": self.tokens,
+            "similarity": self.similarity,
+        }
+
+
+def stop_stats() -> dict[str, int]:
+    with _stats_lock:
+        return dict(_stats)
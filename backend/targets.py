@@ -0,0 +1,92 @@
+from __future__ import annotations
+
+import base64
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from io import BytesIO
+from typing import Any, Callable
+
+import numpy as np
+from PIL import Image
+
+OUTPUT_SIZE = (256, 256)
+TARGET_CACHE_SIZE = int(os.getenv("TARGET_CACHE_SIZE", "16"))
+
+
+class PreparedTarget:
+    """A target image resized once to OUTPUT_SIZE, plus artifacts derived from it.
+
+    `key` is a content hash of the source pixels, so the renderer (GPU texture),
+    the LPIPS scorer (normalized tensor) and the VLM critique (PNG data URL) can
+    all cache their own encodings of the same target against it.
+    """
+
+    def __init__(self, key: str, image: Image.Image) -> None:
+        self.key = key
+        self.image = image
+        self.array = np.asarray(image, dtype=np.uint8)
+        self.array.flags.writeable = False
+        self._derived: dict[str, Any] = {}
+        self._lock = threading.RLock()
+
+    @property
+    def size(self) -> tuple[int, int]:
+        return self.image.size
+
+    def derive(self, name: str, build: Callable[[], Any]) -> Any:
+        """Return the cached artifact `name`, building it on first use."""
+        with self._lock:
+            if name not in self._derived:
+                self._derived[name] = build()
+            return self._derived[name]
+
+    @property
+    def data_url(self) -> str:
+        def build() -> str:
+            buf = BytesIO()
+            self.image.save(buf, format="PNG")
+            b64 = base64.b64encode(buf.getvalue()).decode("ascii")
+            return f"data:image/png;base64,{b64}"
+
+        return self.derive("data_url", build)
+
+
+_cache: "OrderedDict[str, PreparedTarget]" = OrderedDict()
+_cache_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0}
+
+
+def image_key(img: Image.Image) -> str:
+    h = hashlib.sha256()
+    h.update(f"{img.mode}:{img.size[0]}x{img.size[1]}:".encode("ascii"))
+    h.update(img.tobytes())
+    return h.hexdigest()
+
+
+def prepare_target(img: Image.Image | PreparedTarget) -> PreparedTarget:
+    """Resize `img` to OUTPUT_SIZE once per distinct content and cache the result."""
+    if isinstance(img, PreparedTarget):
+        return img
+
+    key = image_key(img)
+    with _cache_lock:
+        target = _cache.get(key)
+        if target is not None:
+            _cache.move_to_end(key)
+            _stats["hits"] += 1
+            return target
+        _stats["misses"] += 1
+
+    target = PreparedTarget(key, img.convert("RGB").resize(OUTPUT_SIZE))
+    with _cache_lock:
+        _cache[key] = target
+        while len(_cache) > max(TARGET_CACHE_SIZE, 1):
+            _cache.popitem(last=False)
+    return target
+
+
+def target_cache_stats() -> dict[str, int]:
+    with _cache_lock:
+        return {**_stats, "size": len(_cache)}
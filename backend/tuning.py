@@ -0,0 +1,296 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import re
+import threading
+import time
+from concurrent.futures import Executor
+from dataclasses import dataclass, field
+from typing import Any
+
+import numpy as np
+
+from backend.metrics import get_lpips_scorer
+from backend.prefilter import prefilter_frames
+from backend.render_pool import arender_frames_array, avalidate_shader
+from backend.scheduler import stage
+from backend.targets import PreparedTarget
+
+TUNE_ENABLED = os.getenv("TUNE_ENABLED") in {"1", "true", "TRUE"}
+TUNE_MAX_PARAMS = int(os.getenv("TUNE_MAX_PARAMS", "8"))
+TUNE_MAX_EVALS = int(os.getenv("TUNE_MAX_EVALS", "48"))
+TUNE_FRAMES = int(os.getenv("TUNE_FRAMES", "2"))
+TUNE_STEP = float(os.getenv("TUNE_STEP", "0.25"))  # initial simplex step, relative to each literal
+TUNE_MIN_GAIN = float(os.getenv("TUNE_MIN_GAIN", "0.002"))  # LPIPS drop needed to keep the tuned values
+TUNE_FTOL = 1e-4
+
+PARAM_UNIFORM = "u_params"
+
+_FLOAT = re.compile(r"(?<![\w.])(\d+\.\d*|\.\d+)(?![\w.])")
+_FUNCTION = re.compile(r"\b\w+\s+(\w+)\s*\([^;{}()]*\)\s*\{")
+_COMMENT = re.compile(r"//[^\n]*|/\*.*?\*/|^\s*#[^\n]*", re.S | re.M)
+_SKIP_FUNCTIONS = re.compile(r"hash|rand", re.I)
+
+_stats = {"attempts": 0, "improved": 0, "evals": 0}
+_stats_lock = threading.Lock()
+
+
+@dataclass
+class TunableParam:
+    start: int
+    end: int
+    value: float
+    function: str
+
+
+@dataclass
+class TuneResult:
+    source: str
+    improved: bool = False
+    params: int = 0
+    evals: int = 0
+    renders: int = 0
+    before: float | None = None
+    after: float | None = None
+    elapsed_ms: float = 0.0
+    reason: str = ""
+    values: list[dict[str, Any]] = field(default_factory=list)
+
+    def to_event(self) -> dict[str, Any]:
+        seconds = self.elapsed_ms / 1000
+        return {
+            "improved": self.improved,
+            "params": self.params,
+            "evals": self.evals,
+            "renders": self.renders,
+            "renders_per_s": round(self.renders / seconds, 1) if seconds > 0 else None,
+            "before": self.before,
+            "after": self.after,
+            "elapsed_ms": round(self.elapsed_ms, 1),
+            "reason": self.reason,
+            "values": self.values,
+        }
+
+
+def _mask(source: str) -> str:
+    """`source` with comments and preprocessor lines blanked out, offsets unchanged."""
+    return _COMMENT.sub(lambda m: re.sub(r"[^\n]", " ", m.group(0)), source)
+
+
+def _body_end(text: str, open_brace: int) -> int:
+    depth = 0
+    for idx in range(open_brace, len(text)):
+        if text[idx] == "{":
+            depth += 1
+        elif text[idx] == "}":
+            depth -= 1
+            if depth == 0:
+                return idx
+    return len(text)
+
+
+def _tunable(text: str, pos: int, body_start: int) -> bool:
+    """Leave const initializers, for-loop headers and array indices alone (they must stay constant)."""
+    block = max(text.rfind("{", body_start, pos), text.rfind("}", body_start, pos)) + 1
+    stmt, parens = block, []  # parens: one entry per unclosed "(", True when it opens a for header
+    for i in range(block, pos):
+        ch = text[i]
+        if ch == "(":
+            parens.append(bool(re.search(r"\bfor\s*$", text[stmt:i])))
+        elif ch == ")" and parens:
+            parens.pop()
+        elif ch == ";" and not parens:
+            stmt = i + 1
+    head = text[stmt:pos]
+    if any(parens) or re.search(r"\bconst\b", head):
+        return False
+    return head.count("[") <= head.count("]")
+
+
+def extract_params(source: str, max_params: int = TUNE_MAX_PARAMS) -> list[TunableParam]:
+    """Float literals inside function bodies that can become uniforms, main() first.
+
+    0 and 1 (usually structural: alpha, identity mixes) and large magic
+    numbers in hash/rand helpers are skipped.
+    """
+    text = _mask(source)
+    found: list[TunableParam] = []
+    for fn in _FUNCTION.finditer(text):
+        name = fn.group(1)
+        if _SKIP_FUNCTIONS.search(name):
+            continue
+        start = fn.end() - 1
+        end = _body_end(text, start)
+        for lit in _FLOAT.finditer(text, start, end):
+            value = float(lit.group(1))
+            if value in (0.0, 1.0) or value >= 100.0 or not _tunable(text, lit.start(), start):
+                continue
+            found.append(TunableParam(lit.start(), lit.end(), value, name))
+    found.sort(key=lambda p: (p.function != "main", p.start))
+    return sorted(found[: max(max_params, 0)], key=lambda p: p.start)
+
+
+def _insert_uniform(source: str, decl: str) -> str:
+    lines = source.splitlines(keepends=True)
+    at = next((i + 1 for i, line in enumerate(lines) if line.lstrip().startswith("#version")), 0)
+    lines.insert(at, decl + "\n")
+    return "".join(lines)
+
+
+def _substitute(source: str, params: list[TunableParam], texts: list[str]) -> str:
+    out, last = [], 0
+    for param, text in zip(params, texts):
+        out.append(source[last : param.start])
+        out.append(text)
+        last = param.end
+    out.append(source[last:])
+    return "".join(out)
+
+
+def parametrize(source: str, params: list[TunableParam]) -> str:
+    """Replace each tunable literal with u_params[i] and declare the uniform array."""
+    body = _substitute(source, params, [f"{PARAM_UNIFORM}[{i}]" for i in range(len(params))])
+    return _insert_uniform(body, f"uniform float {PARAM_UNIFORM}[{len(params)}];")
+
+
+def _literal(value: float) -> str:
+    text = f"{value:.4f}"
+    # Parenthesized so `x - 0.5` tuned negative never becomes the `--` operator.
+    return f"({text})" if value < 0 else text
+
+
+def bake(source: str, params: list[TunableParam], values: np.ndarray) -> str:
+    """Write tuned values back as literals in the original source."""
+    return _substitute(source, params, [_literal(float(v)) for v in values])
+
+
+def _objective(target: PreparedTarget, frames: np.ndarray, per_candidate: int) -> list[float]:
+    """Best-frame score per candidate: LPIPS in one batch, or the prefilter score when LPIPS is unavailable."""
+    scorer = get_lpips_scorer(target)
+    if scorer is not None:
+        scores = np.asarray(scorer.score(frames))
+    else:
+        scores = np.asarray(prefilter_frames(target, frames, top_k=0).score)
+    return scores.reshape(-1, per_candidate).min(axis=1).tolist()
+
+
+async def atune_shader(
+    target: PreparedTarget,
+    source: str,
+    *,
+    num_frames: int = TUNE_FRAMES,
+    max_evals: int = TUNE_MAX_EVALS,
+    max_params: int = TUNE_MAX_PARAMS,
+    executor: Executor | None = None,
+) -> TuneResult:
+    """Nelder–Mead over the shader's float literals, with no LLM calls.
+
+    The literals become a `u_params` uniform array, so the program compiles
+    once and every evaluation is just a render on the pool with new uniform
+    values. Each step evaluates reflection, expansion and both contractions
+    as one batch (parallel renders, one batched LPIPS pass) and then applies
+    the usual Nelder–Mead rules. Search runs in coordinates scaled by
+    TUNE_STEP times each literal.
+    """
+    start = time.perf_counter()
+    result = TuneResult(source=source)
+    params = extract_params(source, max_params)
+    if not params or PARAM_UNIFORM in source:
+        result.reason = "no tunable literals" if not params else f"{PARAM_UNIFORM} already declared"
+        return _finish(result, start)
+    result.params = len(params)
+
+    param_source = parametrize(source, params)
+    check = await avalidate_shader(param_source)
+    if not check.ok:
+        result.reason = "parametrized shader did not compile"
+        return _finish(result, start)
+
+    loop = asyncio.get_running_loop()
+    x0 = np.array([p.value for p in params], dtype=np.float64)
+    scale = np.maximum(np.abs(x0) * TUNE_STEP, 0.05)
+
+    async def evaluate(points: list[np.ndarray]) -> np.ndarray:
+        renders = await asyncio.gather(
+            *(
+                arender_frames_array(
+                    input_img=target,
+                    fragment_shader=param_source,
+                    num_frames=num_frames,
+                    uniforms={PARAM_UNIFORM: x0 + z * scale},
+                )
+                for z in points
+            ),
+            return_exceptions=True,
+        )
+        values = np.full(len(points), np.inf)
+        ok = [k for k, r in enumerate(renders) if not isinstance(r, BaseException)]
+        if ok:
+            batch = np.concatenate([renders[k] for k in ok])
+            async with stage("lpips"):
+                scores = await loop.run_in_executor(executor, _objective, target, batch, num_frames)
+            values[ok] = scores
+        result.evals += len(points)
+        result.renders += len(points) * num_frames
+        return values
+
+    n = len(params)
+    simplex = np.vstack([np.zeros(n), np.eye(n)])
+    fs = await evaluate(list(simplex))
+    f0 = float(fs[0])
+    while result.evals + 4 <= max_evals:
+        order = np.argsort(fs)
+        simplex, fs = simplex[order], fs[order]
+        if fs[-1] - fs[0] < TUNE_FTOL:
+            break
+        centroid = simplex[:-1].mean(axis=0)
+        d = centroid - simplex[-1]
+        points = [centroid + d, centroid + 2 * d, centroid + 0.5 * d, centroid - 0.5 * d]
+        fr, fe, foc, fic = await evaluate(points)
+        if fr < fs[0]:
+            accepted = (points[1], fe) if fe < fr else (points[0], fr)
+        elif fr < fs[-2]:
+            accepted = (points[0], fr)
+        elif fr < fs[-1]:
+            accepted = (points[2], foc) if foc <= fr else None
+        else:
+            accepted = (points[3], fic) if fic < fs[-1] else None
+        if accepted is not None:
+            simplex[-1], fs[-1] = accepted
+            continue
+        if result.evals + n > max_evals:
+            break
+        simplex[1:] = simplex[0] + 0.5 * (simplex[1:] - simplex[0])
+        fs[1:] = await evaluate(list(simplex[1:]))
+
+    best = int(np.argmin(fs))
+    result.before, result.after = f0, float(fs[best])
+    if not np.isfinite(f0) or result.after > f0 - TUNE_MIN_GAIN:
+        result.reason = "no gain above TUNE_MIN_GAIN"
+        return _finish(result, start)
+
+    tuned = x0 + simplex[best] * scale
+    baked = bake(source, params, tuned)
+    if not (await avalidate_shader(baked)).ok:
+        result.reason = "baked shader did not compile"
+        return _finish(result, start)
+    result.source, result.improved = baked, True
+    result.values = [
+        {"function": p.function, "before": round(p.value, 4), "after": round(float(v), 4)} for p, v in zip(params, tuned)
+    ]
+    return _finish(result, start)
+
+
+def _finish(result: TuneResult, start: float) -> TuneResult:
+    result.elapsed_ms = (time.perf_counter() - start) * 1000
+    with _stats_lock:
+        _stats["attempts"] += 1
+        _stats["evals"] += result.evals
+        _stats["improved"] += int(result.improved)
+    return result
+
+
+def tune_stats() -> dict[str, int]:
+    with _stats_lock:
+        return dict(_stats)
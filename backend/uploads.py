@@ -0,0 +1,265 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import os
+import re
+import threading
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any
+
+from fastapi import UploadFile
+from fastapi.responses import JSONResponse
+from PIL import Image
+
+from backend.targets import PreparedTarget, prepare_target
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+UPLOADS_DIR = BASE_DIR / "assets" / "uploads"
+UPLOADS_URL = "/assets/uploads"
+
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(20 * 1024 * 1024)))
+UPLOAD_MAX_PIXELS = int(os.getenv("UPLOAD_MAX_PIXELS", str(40_000_000)))
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+UPLOAD_FORM_OVERHEAD = 64 * 1024  # multipart boundaries and headers on top of the file itself
+UPLOAD_DECODE_CACHE_SIZE = int(os.getenv("UPLOAD_DECODE_CACHE_SIZE", "8"))
+
+_FORMATS = {"PNG": ".png", "JPEG": ".jpg", "WEBP": ".webp", "GIF": ".gif", "BMP": ".bmp"}
+_IMAGE_ID = re.compile(r"[0-9a-f]{32}")
+
+
+class UploadError(Exception):
+    """Rejected upload; `status_code` is the HTTP status to return."""
+
+    def __init__(self, message: str, status_code: int = 400) -> None:
+        super().__init__(message)
+        self.status_code = status_code
+
+
+@dataclass
+class StoredUpload:
+    image_id: str
+    path: Path
+    size: int
+    deduplicated: bool = False
+
+    @property
+    def url(self) -> str:
+        return f"{UPLOADS_URL}/{self.path.name}"
+
+
+@dataclass
+class DecodedUpload:
+    upload: StoredUpload
+    image: Image.Image
+    target: PreparedTarget
+
+
+def _check_image(path: Path) -> str:
+    """Format of the image at `path`; raises UploadError for anything PIL can't decode or that is too large."""
+    try:
+        with Image.open(path) as img:
+            fmt = img.format or ""
+            width, height = img.size
+            img.verify()
+    except Exception as exc:
+        raise UploadError("not a readable image") from exc
+    if fmt not in _FORMATS:
+        raise UploadError(f"unsupported image format: {fmt or 'unknown'}", status_code=415)
+    if width * height > UPLOAD_MAX_PIXELS:
+        raise UploadError(f"image too large: {width}x{height} exceeds {UPLOAD_MAX_PIXELS} pixels", status_code=413)
+    return fmt
+
+
+class UploadStore:
+    """Uploads stored on disk under their content hash.
+
+    The image id is the first 32 hex characters of the SHA-256 of the bytes,
+    so concurrent users never overwrite each other, re-uploading the same
+    file is free, and the file is served as a static asset. Decoded images
+    and their resized targets are kept in a small LRU so repeat runs on an
+    upload skip decoding and resizing.
+    """
+
+    def __init__(self, root: Path = UPLOADS_DIR, max_bytes: int = UPLOAD_MAX_BYTES) -> None:
+        self.root = root
+        self.max_bytes = max_bytes
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._decoded: OrderedDict[str, DecodedUpload] = OrderedDict()
+        self.stats = {"uploads": 0, "deduplicated": 0, "rejected": 0, "bytes": 0, "decode_hits": 0, "decode_misses": 0}
+
+    def _count(self, name: str, value: int = 1) -> None:
+        with self._lock:
+            self.stats[name] += value
+
+    def reject(self) -> None:
+        """Count an upload turned away before it reached `save` (see UploadLimitMiddleware)."""
+        self._count("rejected")
+
+    async def save(self, file: UploadFile) -> StoredUpload:
+        """Stream `file` to disk in chunks while hashing it; no full copy is held in memory."""
+        digest = hashlib.sha256()
+        size = 0
+        tmp = self.root / f".{uuid.uuid4().hex}.part"
+        try:
+            with tmp.open("wb") as out:
+                while chunk := await file.read(UPLOAD_CHUNK_BYTES):
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise UploadError(f"upload exceeds {self.max_bytes} bytes", status_code=413)
+                    digest.update(chunk)
+                    await asyncio.to_thread(out.write, chunk)
+            if size == 0:
+                raise UploadError("empty upload")
+            fmt = await asyncio.to_thread(_check_image, tmp)
+            image_id = digest.hexdigest()[:32]
+            path = self.root / f"{image_id}{_FORMATS[fmt]}"
+            deduplicated = path.exists()
+            if deduplicated:
+                tmp.unlink()
+            else:
+                os.replace(tmp, path)
+        except UploadError:
+            self._count("rejected")
+            raise
+        finally:
+            tmp.unlink(missing_ok=True)
+        self._count("deduplicated" if deduplicated else "uploads")
+        self._count("bytes", 0 if deduplicated else size)
+        return StoredUpload(image_id=image_id, path=path, size=size, deduplicated=deduplicated)
+
+    def import_file(self, source: Path) -> StoredUpload:
+        """Copy a local image into the store under the same limits as an upload (used by batches)."""
+        digest = hashlib.sha256()
+        size = 0
+        tmp = self.root / f".{uuid.uuid4().hex}.part"
+        try:
+            with source.open("rb") as src, tmp.open("wb") as out:
+                while chunk := src.read(UPLOAD_CHUNK_BYTES):
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise UploadError(f"{source.name} exceeds {self.max_bytes} bytes", status_code=413)
+                    digest.update(chunk)
+                    out.write(chunk)
+            if size == 0:
+                raise UploadError(f"{source.name} is empty")
+            fmt = _check_image(tmp)
+            image_id = digest.hexdigest()[:32]
+            path = self.root / f"{image_id}{_FORMATS[fmt]}"
+            deduplicated = path.exists()
+            if not deduplicated:
+                os.replace(tmp, path)
+        except UploadError:
+            self._count("rejected")
+            raise
+        finally:
+            tmp.unlink(missing_ok=True)
+        self._count("deduplicated" if deduplicated else "uploads")
+        self._count("bytes", 0 if deduplicated else size)
+        return StoredUpload(image_id=image_id, path=path, size=size, deduplicated=deduplicated)
+
+    def get(self, image_id: str) -> StoredUpload | None:
+        if not _IMAGE_ID.fullmatch(image_id or ""):
+            return None
+        for ext in _FORMATS.values():
+            path = self.root / f"{image_id}{ext}"
+            if path.exists():
+                return StoredUpload(image_id=image_id, path=path, size=path.stat().st_size)
+        return None
+
+    def decode(self, image_id: str) -> DecodedUpload | None:
+        """The decoded image and its PreparedTarget, decoded once per upload while it stays in the LRU."""
+        with self._lock:
+            cached = self._decoded.get(image_id)
+            if cached is not None:
+                self._decoded.move_to_end(image_id)
+                self.stats["decode_hits"] += 1
+                return cached
+        upload = self.get(image_id)
+        if upload is None:
+            return None
+        with Image.open(upload.path) as img:
+            image = img.convert("RGB")
+        decoded = DecodedUpload(upload=upload, image=image, target=prepare_target(image))
+        with self._lock:
+            self.stats["decode_misses"] += 1
+            self._decoded[image_id] = decoded
+            while len(self._decoded) > max(UPLOAD_DECODE_CACHE_SIZE, 1):
+                self._decoded.popitem(last=False)
+        return decoded
+
+    def snapshot(self) -> dict[str, int]:
+        with self._lock:
+            return {**self.stats, "decoded": len(self._decoded)}
+
+
+_store: UploadStore | None = None
+_store_lock = threading.Lock()
+
+
+def get_upload_store() -> UploadStore:
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = UploadStore()
+        return _store
+
+
+class UploadLimitMiddleware:
+    """Reject an oversized upload body before FastAPI parses the form and spools it to disk.
+
+    A declared Content-Length over the limit is answered with 413 without
+    reading the body; a body without one (chunked) is counted as it arrives
+    and cut off at the limit. UploadStore.save still enforces the exact
+    per-file UPLOAD_MAX_BYTES on what gets through.
+    """
+
+    def __init__(self, app: Any, path: str = "/api/upload") -> None:
+        self.app = app
+        self.path = path
+
+    async def __call__(self, scope: dict, receive: Any, send: Any) -> None:
+        if scope["type"] != "http" or scope["path"] != self.path:
+            await self.app(scope, receive, send)
+            return
+        store = get_upload_store()
+        limit = store.max_bytes + UPLOAD_FORM_OVERHEAD
+        declared = dict(scope["headers"]).get(b"content-length", b"")
+        if declared.isdigit() and int(declared) > limit:
+            await self._reject(store, scope, receive, send)
+            return
+
+        received = 0
+        exceeded = False
+
+        async def limited_receive() -> dict:
+            nonlocal received, exceeded
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    exceeded = True
+                    raise UploadError(f"upload exceeds {store.max_bytes} bytes", status_code=413)
+            return message
+
+        async def guarded_send(message: dict) -> None:
+            if not exceeded:  # the app's own error response for the aborted form is replaced by the 413
+                await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except Exception:
+            if not exceeded:
+                raise
+        if exceeded:
+            await self._reject(store, scope, receive, send)
+
+    @staticmethod
+    async def _reject(store: UploadStore, scope: dict, receive: Any, send: Any) -> None:
+        store.reject()
+        response = JSONResponse({"error": f"upload exceeds {store.max_bytes} bytes"}, status_code=413)
+        await response(scope, receive, send)
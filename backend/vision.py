@@ -6,30 +6,32 @@ from io import BytesIO
 from typing import Optional
 
 import weave
-from openai import OpenAI
 from PIL import Image
 
+from backend.llm_client import ChatCall, acomplete, complete
+from backend.targets import PreparedTarget
 
-def _image_to_data_url(img: Image.Image) -> str:
+
+def _image_to_data_url(img: Image.Image | PreparedTarget) -> str:
+    if isinstance(img, PreparedTarget):
+        return img.data_url
     buf = BytesIO()
     img.save(buf, format="PNG")
     b64 = base64.b64encode(buf.getvalue()).decode("ascii")
     return f"data:image/png;base64,{b64}"
 
 
-@weave.op()
-def critique_images(
+def _critique_call(
     *,
-    target_img: Image.Image,
+    target_img: Image.Image | PreparedTarget,
     output_img: Image.Image,
     prompt_override: Optional[str] = None,
-) -> str:
+) -> ChatCall | str:
     api_key = os.getenv("OPENAI_API_KEY")
     if not api_key or os.getenv("VISION_DISABLED") in {"1", "true", "TRUE"}:
         return "VLM critique unavailable; using stub critique."
 
     model = os.getenv("OPENAI_VISION_MODEL", "gpt-4o-mini")
-    client = OpenAI(api_key=api_key)
 
     prompt = prompt_override or (
         "Compare these two images:\n"
@@ -56,7 +58,7 @@ def critique_images(
     target_url = _image_to_data_url(target_img)
     output_url = _image_to_data_url(output_img)
 
-    response = client.chat.completions.create(
+    return ChatCall(
         model=model,
         messages=[
             {
@@ -69,6 +71,29 @@ def critique_images(
             }
         ],
         temperature=0.2,
+        json_mode=False,
+        parse=lambda text: text or "No critique returned.",
+        kind="critique",
     )
 
-    return response.choices[0].message.content or "No critique returned."
+
+@weave.op()
+def critique_images(
+    *,
+    target_img: Image.Image | PreparedTarget,
+    output_img: Image.Image,
+    prompt_override: Optional[str] = None,
+) -> str:
+    call = _critique_call(target_img=target_img, output_img=output_img, prompt_override=prompt_override)
+    return call if isinstance(call, str) else complete(call)
+
+
+@weave.op()
+async def acritique_images(
+    *,
+    target_img: Image.Image | PreparedTarget,
+    output_img: Image.Image,
+    prompt_override: Optional[str] = None,
+) -> str:
+    call = _critique_call(target_img=target_img, output_img=output_img, prompt_override=prompt_override)
+    return call if isinstance(call, str) else await acomplete(call)
@@ -10,6 +10,7 @@ const originalImage = document.getElementById("originalImage");
 const discoveryNotesEl = document.getElementById("discoveryNotes");
 const agentNotesEl = document.getElementById("agentNotes");
 const numFramesInput = document.getElementById("numFramesInput");
+const beamWidthInput = document.getElementById("beamWidthInput");
 const referenceShaderInput = document.getElementById("referenceShaderInput");
 const progressBar = document.getElementById("progressBar");
 const modal = document.getElementById("modal");
@@ -84,10 +85,16 @@ uploadBtn.addEventListener("click", async () => {
 
   const res = await fetch("/api/upload", { method: "POST", body: form });
   const data = await res.json();
+  if (!res.ok) {
+    uploadStatus.textContent = `Upload failed: ${data.error || res.status}`;
+    return;
+  }
   imageId = data.image_id;
 
-  originalImage.src = URL.createObjectURL(file);
-  uploadStatus.textContent = "Uploaded to memory. Ready to run.";
+  originalImage.src = data.url;
+  uploadStatus.textContent = data.deduplicated
+    ? "Already uploaded. Ready to run."
+    : "Uploaded. Ready to run.";
 });
 
 const addIterationCard = (iter) => {
@@ -160,10 +167,12 @@ runBtn.addEventListener("click", async () => {
     Math.min(20, Number(iterationsInput?.value || 8))
   );
   const numFramesValue = Math.max(1, Math.min(30, Number(numFramesInput?.value || 1)));
+  const beamWidthValue = Math.max(1, Math.min(8, Number(beamWidthInput?.value || 1)));
   const payload = {
     image_id: imageId,
     iterations: iterationsValue,
     num_frames: numFramesValue,
+    beam_width: beamWidthValue,
     reference_text: referenceShaderInput?.value || null,
   };
 
@@ -185,10 +194,26 @@ runBtn.addEventListener("click", async () => {
     return;
   }
 
+  if (!res.ok) {
+    const data = await res.json().catch(() => ({}));
+    runStatus.textContent = res.status === 429
+      ? `Server busy, try again in ${data.retry_after || res.headers.get("Retry-After")}s.`
+      : `Run failed: ${data.error || res.status}`;
+    runStatus.classList.remove("running");
+    if (progressBar) {
+      progressBar.classList.remove("running");
+      progressBar.style.width = "0%";
+    }
+    return;
+  }
+
   const reader = res.body.getReader();
   const decoder = new TextDecoder();
   let buffer = "";
   let iterCount = 0;
+  let runId = null;
+  let finished = false;
+  let doneText = "Run complete.";
 
   while (true) {
     const { done, value } = await reader.read();
@@ -211,7 +236,11 @@ runBtn.addEventListener("click", async () => {
       let data;
       try { data = JSON.parse(dataStr); } catch { continue; }
 
-      if (eventType === "input_image") {
+      if (eventType === "run") {
+        runId = data.run_id;
+      } else if (eventType === "error") {
+        runStatus.textContent = `Run failed: ${data.error}`;
+      } else if (eventType === "input_image") {
         if (data.input_image) originalImage.src = data.input_image;
       } else if (eventType === "discovery") {
         runStatus.textContent = `Running iteration 1 of ${iterationsValue}...`;
@@ -237,6 +266,20 @@ runBtn.addEventListener("click", async () => {
         block.className = "note-item discovery-card";
         block.innerHTML = gapHtml;
         discoveryNotesEl.appendChild(block);
+      } else if (eventType === "queue") {
+        runStatus.textContent = data.position > 0
+          ? `Queued: position ${data.position} (${data.running} running)...`
+          : "Running discovery...";
+      } else if (eventType === "render") {
+        runStatus.textContent = data.beam_width > 1
+          ? `Iteration ${data.iteration}: rendered ${data.beam_width} candidates, ranking...`
+          : `Iteration ${data.iteration}: rendered, scoring and critiquing...`;
+      } else if (eventType === "score") {
+        if (data.lpips_score != null) {
+          runStatus.textContent = `Iteration ${data.iteration}: LPIPS ${data.lpips_score.toFixed(4)}, waiting for critique...`;
+        }
+      } else if (eventType === "critique") {
+        runStatus.textContent = `Iteration ${data.iteration}: critique ready...`;
       } else if (eventType === "iteration") {
         iterCount++;
         runStatus.textContent = iterCount < iterationsValue
@@ -251,6 +294,10 @@ runBtn.addEventListener("click", async () => {
           <pre>${data.agent_notes || "No notes."}</pre>
         `;
         agentNotesEl.appendChild(noteItem);
+      } else if (eventType === "tune") {
+        runStatus.textContent = data.accepted
+          ? `Iteration ${data.iteration}: tuned ${data.params} constants, LPIPS ${data.lpips_score.toFixed(4)}`
+          : `Iteration ${data.iteration}: tuning kept the edit as is (${data.reason || "no gain"})`;
       } else if (eventType === "best") {
         if (data.render_path) {
           bestEl.innerHTML = `
@@ -261,7 +308,11 @@ runBtn.addEventListener("click", async () => {
           `;
         }
       } else if (eventType === "done") {
-        runStatus.textContent = "Run complete.";
+        finished = true;
+        if (data.stop_reason && data.stop_reason !== "iterations") {
+          doneText = `Run complete: stopped after ${data.iterations} of ${data.max_iterations} iterations (${data.stop_reason.replace("_", " ")}).`;
+        }
+        runStatus.textContent = doneText;
         runStatus.classList.remove("running");
         if (progressBar) {
           progressBar.classList.remove("running");
@@ -271,8 +322,10 @@ runBtn.addEventListener("click", async () => {
     }
   }
 
-  // Ensure we mark complete even if done event was missed
-  runStatus.textContent = "Run complete.";
+  // Ensure we mark complete even if done event was missed; an unfinished run stays resumable server-side.
+  runStatus.textContent = finished || !runId
+    ? doneText
+    : `Stream ended early; run ${runId} can be resumed (POST /api/runs/${runId}/resume).`;
   runStatus.classList.remove("running");
   if (progressBar) {
     progressBar.classList.remove("running");